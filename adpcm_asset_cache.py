@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+"""
+On-disk cache of fully framed ADPCM packets for the WAV clips used as voice sources.
+
+A clip is encoded once per (path, mtime, size, sample rate, frame format) and stored as a
+flat file of fixed-size frames, which is memory-mapped on load. Sending a cached clip is
+then just slicing the mapping and notifying, no WAV parsing or encoding on the hot path.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import wave
+from adpcm_codec import AdpcmEncoder, ADPCM_SAMPLE_WIDTH
+
+logger = logging.getLogger(__name__)
+
+ADPCM_FRAME_PAYLOAD_SIZE = 128
+
+# Sharp: raw 128 bytes ADPCM per notification.
+FRAME_FORMAT_SHARP = 'sharp_raw128'
+# TiVo: 6 bytes header [seq hi, seq lo, rcuid, pre predict hi, pre predict lo, pre index] + 128 bytes ADPCM.
+FRAME_FORMAT_TIVO = 'tivo_hdr6_raw128'
+
+FRAME_FORMATS = {
+    FRAME_FORMAT_SHARP: 0,
+    FRAME_FORMAT_TIVO: 6,
+}
+
+# bump when the encoder output or the framing changes, so stale cache files are not reused
+CACHE_VERSION = 1
+CACHE_MAGIC = b'RCUADPCM'
+# magic, version, header size, frame size, frame count, sample rate
+CACHE_HEADER = struct.Struct('<8sHHHII')
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ble-rcu-simu', 'adpcm')
+
+_lock = threading.Lock()
+# {cache key: AdpcmAsset}, mapped assets are shared by every voice injection of the process
+_loaded_assets = {}
+
+
+class AdpcmAsset:
+    """
+    Read-only view of a cached clip, frames are memoryview slices of the mapping.
+    """
+
+    def __init__(self, path, mapping, frame_size, frame_count, sample_rate):
+        self.path = path
+        self.mapping = mapping
+        self.view = memoryview(mapping)
+        self.frame_size = frame_size
+        self.frame_count = frame_count
+        self.sample_rate = sample_rate
+
+    def __len__(self):
+        return self.frame_count
+
+    def frame(self, index):
+        begin = CACHE_HEADER.size + index * self.frame_size
+        return self.view[begin:begin + self.frame_size]
+
+    def __iter__(self):
+        for index in range(self.frame_count):
+            yield self.frame(index)
+
+    def get_frame_duration(self):
+        return ADPCM_FRAME_PAYLOAD_SIZE * 2 / self.sample_rate
+
+
+def _cache_key(wave_file, frame_format, sample_rate):
+    st = os.stat(wave_file)
+    key = f'{os.path.abspath(wave_file)}|{st.st_mtime_ns}|{st.st_size}|{sample_rate}|{frame_format}|{CACHE_VERSION}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def encode_wave_frames(wave_file, frame_format):
+    # Returns (sample rate, [framed packet, ...]), encoded from a fresh codec state exactly like
+    # the voice services do for one utterance.
+    header_size = FRAME_FORMATS[frame_format]
+    with wave.open(wave_file, 'rb') as f:
+        if f.getsampwidth() != ADPCM_SAMPLE_WIDTH or f.getnchannels() != 1:
+            raise ValueError(
+                f'{wave_file}: only 16 bit mono WAV can be cached, got {f.getsampwidth()} bytes x {f.getnchannels()} channels')
+        sample_rate = f.getframerate()
+        pcm = f.readframes(f.getnframes())
+
+    frames = []
+    encoder = AdpcmEncoder()
+    for seq, (state, adpcm_data) in enumerate(encoder.encode_frames(pcm, ADPCM_FRAME_PAYLOAD_SIZE)):
+        if header_size:
+            header = struct.pack('>HBhB', seq & 0xFFFF, 0x00, state[0], state[1])
+            frames.append(header + adpcm_data)
+        else:
+            frames.append(adpcm_data)
+    return sample_rate, frames
+
+
+def _write_cache_file(cache_path, sample_rate, frame_size, frames):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # private to the writer, concurrent first uses each write their own file, the last
+    # replace wins and every one of them holds the same bytes
+    tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION,
+                CACHE_HEADER.size, frame_size, len(frames), sample_rate))
+        f.write(b''.join(frames))
+    os.replace(tmp_path, cache_path)
+
+
+def _map_cache_file(cache_path, frame_size):
+    with open(cache_path, 'rb') as f:
+        header = f.read(CACHE_HEADER.size)
+        if len(header) < CACHE_HEADER.size:
+            return None
+        magic, version, header_size, cached_frame_size, frame_count, sample_rate = CACHE_HEADER.unpack(header)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or header_size != CACHE_HEADER.size \
+                or cached_frame_size != frame_size:
+            return None
+        if os.fstat(f.fileno()).st_size != CACHE_HEADER.size + frame_size * frame_count:
+            return None
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return AdpcmAsset(cache_path, mapping, frame_size, frame_count, sample_rate)
+
+
+def load_asset(wave_file, frame_format, cache_dir=DEFAULT_CACHE_DIR):
+    # Returns the AdpcmAsset for the clip, encoding and storing it on the first use.
+    # Returns None if the clip can not be cached, the caller falls back to encoding on the fly.
+    if frame_format not in FRAME_FORMATS:
+        raise ValueError(f'unknown frame format: {frame_format}')
+    frame_size = FRAME_FORMATS[frame_format] + ADPCM_FRAME_PAYLOAD_SIZE
+    try:
+        with wave.open(wave_file, 'rb') as f:
+            sample_rate = f.getframerate()
+        key = _cache_key(wave_file, frame_format, sample_rate)
+    except (OSError, EOFError, wave.Error) as e:
+        logger.warning('load_asset, can not open %s: %s', wave_file, e)
+        return None
+
+    with _lock:
+        asset = _loaded_assets.get(key, None)
+    if asset is not None:
+        return asset
+
+    # the lock is not held while encoding, the voice injections of the other remotes keep
+    # getting their cached clips meanwhile
+    cache_path = os.path.join(cache_dir, f'{key}.adpcm')
+    try:
+        if os.path.exists(cache_path):
+            asset = _map_cache_file(cache_path, frame_size)
+        if asset is None:
+            sample_rate, frames = encode_wave_frames(wave_file, frame_format)
+            _write_cache_file(cache_path, sample_rate, frame_size, frames)
+            asset = _map_cache_file(cache_path, frame_size)
+            logger.info('load_asset, encoded %s into %s, frames = %s', wave_file, cache_path, len(frames))
+    except (OSError, ValueError, wave.Error) as e:
+        logger.warning('load_asset, caching %s failed: %s', wave_file, e)
+        return None
+
+    if asset is None:
+        return None
+    with _lock:
+        # the first one loaded is shared, a concurrent first use drops its own mapping
+        return _loaded_assets.setdefault(key, asset)
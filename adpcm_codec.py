@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+"""
+IMA-ADPCM (DVI4) codec shared by the voice services and the voice receiver.
+
+The bitstream and the (predicted value, step index) state are byte-exact with
+what audioop.lin2adpcm / audioop.adpcm2lin produce for 16 bit mono samples,
+so it can be used as a drop in replacement now that audioop is gone from
+Python 3.13.
+
+PCM input may be any C-contiguous buffer of native int16 samples: bytes,
+bytearray, memoryview, array('h') or a NumPy int16 array.
+"""
+ADPCM_SAMPLE_WIDTH = 2
+ADPCM_MAX_INDEX = 88
+
+INDEX_TABLE = (
+    -1, -1, -1, -1, 2, 4, 6, 8,
+    -1, -1, -1, -1, 2, 4, 6, 8,
+)
+
+STEP_SIZE_TABLE = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767,
+)
+
+# {(step index << 8) | adpcm byte: (vpdiff of high nibble, vpdiff of low nibble, next step index)},
+# built on first use, so decoding costs one lookup per byte instead of per nibble.
+_decode_byte_table = None
+
+
+def _next_index(index, delta):
+    index += INDEX_TABLE[delta]
+    if index < 0:
+        return 0
+    if index > ADPCM_MAX_INDEX:
+        return ADPCM_MAX_INDEX
+    return index
+
+
+def _vpdiff(step, delta):
+    vpdiff = step >> 3
+    if delta & 4:
+        vpdiff += step
+    if delta & 2:
+        vpdiff += step >> 1
+    if delta & 1:
+        vpdiff += step >> 2
+    return -vpdiff if delta & 8 else vpdiff
+
+
+def _build_decode_byte_table():
+    table = [None] * ((ADPCM_MAX_INDEX + 1) << 8)
+    for index in range(ADPCM_MAX_INDEX + 1):
+        for byte in range(256):
+            hi = byte >> 4
+            lo = byte & 0x0f
+            diff_hi = _vpdiff(STEP_SIZE_TABLE[index], hi)
+            mid_index = _next_index(index, hi)
+            diff_lo = _vpdiff(STEP_SIZE_TABLE[mid_index], lo)
+            table[(index << 8) | byte] = (diff_hi, diff_lo,
+                                          _next_index(mid_index, lo))
+    return table
+
+
+def _check_state(state):
+    if state is None:
+        return 0, 0
+    valpred, index = state
+    if not -0x8000 <= valpred <= 0x7fff or not 0 <= index <= ADPCM_MAX_INDEX:
+        raise ValueError(f'bad ADPCM state: {state}')
+    return int(valpred), int(index)
+
+
+def _check_width(width):
+    if width != ADPCM_SAMPLE_WIDTH:
+        raise ValueError(f'only {ADPCM_SAMPLE_WIDTH} bytes sample width is supported, got {width}')
+
+
+def as_samples(pcm):
+    # view any int16 buffer as a sequence of samples without copying it
+    view = memoryview(pcm)
+    if view.format == 'h' and view.ndim == 1:
+        return view
+    view = view.cast('B')
+    if len(view) % ADPCM_SAMPLE_WIDTH:
+        raise ValueError('PCM buffer length is not a multiple of the sample width')
+    return view.cast('h')
+
+
+class AdpcmEncoder:
+    """
+    Stateful 16 bit PCM to IMA-ADPCM encoder, two samples per output byte with
+    the first sample in the high nibble.
+    """
+
+    def __init__(self, state=None):
+        self.reset(state)
+
+    def reset(self, state=None):
+        self.valpred, self.index = _check_state(state)
+
+    def get_state(self):
+        return self.valpred, self.index
+
+    def encode(self, pcm):
+        samples = as_samples(pcm)
+        out = bytearray(len(samples) >> 1)
+        valpred = self.valpred
+        index = self.index
+        step = STEP_SIZE_TABLE[index]
+        index_table = INDEX_TABLE
+        step_table = STEP_SIZE_TABLE
+        high_nibble = 0
+        pos = 0
+        first = True
+        for val in samples:
+            diff = val - valpred
+            if diff < 0:
+                sign = 8
+                diff = -diff
+            else:
+                sign = 0
+
+            delta = 0
+            vpdiff = step >> 3
+            if diff >= step:
+                delta = 4
+                diff -= step
+                vpdiff += step
+            half = step >> 1
+            if diff >= half:
+                delta |= 2
+                diff -= half
+                vpdiff += half
+            quarter = step >> 2
+            if diff >= quarter:
+                delta |= 1
+                vpdiff += quarter
+
+            if sign:
+                valpred -= vpdiff
+                if valpred < -32768:
+                    valpred = -32768
+            else:
+                valpred += vpdiff
+                if valpred > 32767:
+                    valpred = 32767
+
+            delta |= sign
+            index += index_table[delta]
+            if index < 0:
+                index = 0
+            elif index > 88:
+                index = 88
+            step = step_table[index]
+
+            if first:
+                high_nibble = delta << 4
+            else:
+                out[pos] = high_nibble | delta
+                pos += 1
+            first = not first
+
+        self.valpred = valpred
+        self.index = index
+        return bytes(out)
+
+    def encode_frames(self, pcm, frame_size):
+        # Split the PCM buffer into frames producing frame_size ADPCM bytes each and
+        # return [(state before the frame, adpcm frame), ...]. A trailing partial frame
+        # is dropped, the same as the voice sources do.
+        samples = as_samples(pcm)
+        samples_per_frame = frame_size * 2
+        frames = []
+        for begin in range(0, len(samples) - samples_per_frame + 1, samples_per_frame):
+            state = self.get_state()
+            frames.append(
+                (state, self.encode(samples[begin:begin + samples_per_frame])))
+        return frames
+
+
+class AdpcmDecoder:
+    """
+    Stateful IMA-ADPCM to 16 bit PCM decoder, the counterpart of AdpcmEncoder.
+    """
+
+    def __init__(self, state=None):
+        self.reset(state)
+
+    def reset(self, state=None):
+        self.valpred, self.index = _check_state(state)
+
+    def get_state(self):
+        return self.valpred, self.index
+
+    def decode_into(self, adpcm, out):
+        # Decode into a writable buffer holding at least 2 * len(adpcm) int16 samples,
+        # e.g. a preallocated bytearray or NumPy int16 array. Returns the sample count.
+        global _decode_byte_table
+        if _decode_byte_table is None:
+            _decode_byte_table = _build_decode_byte_table()
+        table = _decode_byte_table
+
+        data = memoryview(adpcm).cast('B')
+        samples = as_samples(out)
+        if len(samples) < len(data) * 2:
+            raise ValueError('output buffer is too small')
+
+        valpred = self.valpred
+        index = self.index
+        pos = 0
+        for byte in data:
+            diff_hi, diff_lo, index_next = table[(index << 8) | byte]
+            valpred += diff_hi
+            if valpred > 32767:
+                valpred = 32767
+            elif valpred < -32768:
+                valpred = -32768
+            samples[pos] = valpred
+            valpred += diff_lo
+            if valpred > 32767:
+                valpred = 32767
+            elif valpred < -32768:
+                valpred = -32768
+            samples[pos + 1] = valpred
+            pos += 2
+            index = index_next
+
+        self.valpred = valpred
+        self.index = index
+        return pos
+
+    def decode(self, adpcm):
+        out = bytearray(len(adpcm) * 2 * ADPCM_SAMPLE_WIDTH)
+        self.decode_into(adpcm, out)
+        return bytes(out)
+
+
+# audioop compatible helpers
+def lin2adpcm(fragment, width, state):
+    _check_width(width)
+    encoder = AdpcmEncoder(state)
+    return encoder.encode(fragment), encoder.get_state()
+
+
+def adpcm2lin(fragment, width, state):
+    _check_width(width)
+    decoder = AdpcmDecoder(state)
+    return decoder.decode(fragment), decoder.get_state()
+
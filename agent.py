@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 import dbus.service
 import bluetooth_constants
+import bluetooth_utils
 
 
 def ask(prompt):
@@ -21,8 +22,7 @@ class Agent(dbus.service.Object):
 
     def set_trusted(self, device):
         print(f"Agent.set_trusted, device = {device}")
-        props = dbus.Interface(self.bus.get_object(
-            bluetooth_constants.BLUEZ_SERVICE_NAME, device), bluetooth_constants.DBUS_PROPERTIES)
+        props = bluetooth_utils.get_object_interface(device, bluetooth_constants.DBUS_PROPERTIES, self.bus)
         props.Set("org.bluez.Device1", "Trusted", True)
         print("Agent.set_trusted ok")
 
@@ -55,7 +55,7 @@ class Advertisement(dbus.service.Object):
 
     def get_advertisement_info(self):
         advertisement_info = "{} [{}]".format(
-            self.DISCOVERABLE_NAME, self.mac_address)
+            self.local_name, self.mac_address)
         return advertisement_info
 
     def add_service_uuid(self, uuid):
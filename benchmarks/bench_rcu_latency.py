@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+"""
+End-to-end latency benchmark of the RCU GATT objects, no Bluetooth hardware needed.
+
+A private dbus-daemon is started, the real RCU service (HIDService, ReportCharacteristic,
+VoiceService, headless) is exported on one connection and registered with a fake org.bluez,
+and a second connection plays the BlueZ side: it subscribes to PropertiesChanged and time
+stamps every notification. Reported per scenario: p50/p99/max latency and throughput.
+
+    keys_sequential  onKeyEvent() to the report characteristic's PropertiesChanged, one key
+                     event in flight at a time
+    keys_burst       the same with all key events issued back to back
+    voice_frames     voice RX characteristic emit to PropertiesChanged for every frame of an
+                     utterance started the way the TV starts it, or to the read of the
+                     notify socket with --acquire-notify
+    registration     RegisterApplication round trip (GetManagedObjects of the application)
+
+Run from anywhere, exits with 1 when a --max-*-p99-ms budget is exceeded:
+
+    python3 benchmarks/bench_rcu_latency.py -rc 1 -n 2000 --json bench.json --max-key-p99-ms 5
+"""
+import argparse
+import collections
+import json
+import os
+import socket
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+import dbus
+import dbus.mainloop.glib
+from gi.repository import GLib
+import bluetooth_constants
+from benchmarks.private_bus import PrivateBus
+from benchmarks.fake_bluez import FakeBluez, FAKE_ADAPTER_PATH
+from rcu_instance import KeyEventRouter, RC_TYPE_SHARP, RC_TYPE_TIVO
+from voice_pacer import PACING_FAST, PACING_MODES
+
+AUDIO_END = 0x00
+TIVO_MIC_OPEN_8K = [0x0C, 0x00, 0x01]
+
+
+def run_until(predicate, timeout):
+    # Iterate the GLib main context until predicate() is true, returns False on timeout.
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        context.iteration(False) or time.sleep(0.0001)
+    return True
+
+
+def summarize(name, latencies, duration):
+    result = {'scenario': name, 'count': len(latencies)}
+    if latencies:
+        ordered = sorted(latencies)
+
+        def percentile(fraction):
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+        result.update({
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99),
+            'max_ms': ordered[-1] * 1000,
+            'mean_ms': sum(ordered) / len(ordered) * 1000,
+        })
+    result['throughput_per_s'] = len(latencies) / duration if duration > 0 else 0.0
+    return result
+
+
+class SignalProbe:
+    """
+    Time stamps the PropertiesChanged 'Value' notifications of one object path.
+    """
+
+    def __init__(self, bus, path):
+        self.times = []
+        self.values = []
+        self.match = bus.add_signal_receiver(self.onPropertiesChanged,
+                                             dbus_interface=bluetooth_constants.DBUS_PROPERTIES,
+                                             signal_name='PropertiesChanged',
+                                             path=path,
+                                             byte_arrays=True)
+
+    def onPropertiesChanged(self, interface, changed, invalidated):
+        if 'Value' in changed:
+            self.times.append(time.perf_counter())
+            self.values.append(bytes(changed['Value']))
+
+    def __len__(self):
+        return len(self.times)
+
+    def remove(self):
+        self.match.remove()
+
+
+class SocketProbe:
+    """
+    Acquires the notifications of a characteristic the way bluetoothd does and time stamps the
+    packets read from the socket, same interface as SignalProbe.
+    """
+
+    def __init__(self, bus, bus_name, path, mtu, timeout):
+        self.times = []
+        self.values = []
+        self.mtu = mtu
+        chrc = dbus.Interface(bus.get_object(bus_name, path, introspect=False),
+                              bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+        reply = []
+        # the service is served from this loop, the call must not block it
+        chrc.AcquireNotify({'mtu': dbus.UInt16(mtu)},
+                           reply_handler=lambda fd, acquired_mtu: reply.append(fd),
+                           error_handler=lambda e: reply.append(e))
+        if not run_until(lambda: reply, timeout) or isinstance(reply[0], Exception):
+            raise RuntimeError(f'AcquireNotify failed: {reply}')
+        self.socket = socket.socket(fileno=reply[0].take())
+        self.watch = GLib.io_add_watch(self.socket.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.onReadable)
+
+    def onReadable(self, fd, condition):
+        value = self.socket.recv(self.mtu)
+        self.times.append(time.perf_counter())
+        self.values.append(value)
+        return True
+
+    def __len__(self):
+        return len(self.times)
+
+    def remove(self):
+        GLib.source_remove(self.watch)
+        self.socket.close()
+
+
+def make_rcu_service(bus, rc_type, voice_pacing):
+    # headless and without keyboard hook, the router is never started
+    if rc_type == RC_TYPE_TIVO:
+        from tivo_rcu.tivo_rcu_service import TivoRCUService
+        return TivoRCUService(bus, lambda: None, voice_pacing, key_events=KeyEventRouter(), headless=True)
+    from sharp_rcu.sharp_rcu_service import SharpRCUService
+    return SharpRCUService(bus, lambda: None, voice_pacing, key_events=KeyEventRouter(), headless=True)
+
+
+def bench_registration(rcu_service, rounds, timeout):
+    # the fake BlueZ calls back GetManagedObjects of the application before replying
+    rcu_gatt_manager = dbus.Interface(
+        rcu_service.connection.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, FAKE_ADAPTER_PATH),
+        bluetooth_constants.GATT_MANAGER_INTERFACE)
+    latencies = []
+    begin = time.perf_counter()
+    for i in range(rounds):
+        done = []
+        start = time.perf_counter()
+        rcu_gatt_manager.RegisterApplication(rcu_service.get_path(), {},
+                                             reply_handler=lambda: done.append(time.perf_counter()),
+                                             error_handler=lambda e: done.append(e))
+        if not run_until(lambda: done, timeout) or not isinstance(done[0], float):
+            raise RuntimeError(f'RegisterApplication failed: {done}')
+        latencies.append(done[0] - start)
+        if i < rounds - 1:
+            rcu_gatt_manager.UnregisterApplication(rcu_service.get_path(),
+                                                   reply_handler=lambda: done.append(True),
+                                                   error_handler=lambda e: done.append(e))
+            run_until(lambda: len(done) > 1, timeout)
+    return summarize('registration', latencies, time.perf_counter() - begin)
+
+
+def bench_keys(hid_service, probe, key_name, count, burst, timeout):
+    send_times = []
+    begin = time.perf_counter()
+    for i in range(count):
+        received = len(probe)
+        send_times.append(time.perf_counter())
+        hid_service.onKeyEvent(key_name, i % 2 == 0)
+        if not burst and not run_until(lambda: len(probe) > received, timeout):
+            raise RuntimeError(f'no notification for key event {i}')
+    if burst and not run_until(lambda: len(probe) >= count, timeout):
+        raise RuntimeError(f'{len(probe)} of {count} key notifications received')
+    latencies = [received - sent for sent, received in zip(send_times, probe.times)]
+    duration = probe.times[count - 1] - begin
+    return summarize('keys_burst' if burst else 'keys_sequential', latencies, duration)
+
+
+def bench_voice(rcu_service, rc_type, client_bus, rcu_bus_name, rx_probe, ctl_probe, timeout):
+    voice_service = rcu_service.voice_service
+    if rc_type == RC_TYPE_TIVO:
+        rx_char, tx_char = voice_service.tivo_tv_rx_char, voice_service.tivo_tv_tx_char
+    else:
+        rx_char, tx_char = voice_service.tv_rx_char, voice_service.tv_tx_char
+
+    # time stamp every frame right before the emit, frames are sent from the voice threads
+    send_times = collections.deque()
+    notify_value = rx_char.NotifyValue
+
+    def timed_notify_value(value):
+        send_times.append(time.perf_counter())
+        notify_value(value)
+
+    rx_char.NotifyValue = timed_notify_value
+
+    ctl_count = len(ctl_probe)
+    begin = time.perf_counter()
+    if rc_type == RC_TYPE_TIVO:
+        # the TV opens the mic with a write on the TX characteristic, the call must not block
+        # the loop the service is served from
+        tx = dbus.Interface(client_bus.get_object(rcu_bus_name, tx_char.get_path(), introspect=False),
+                            bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+        tx.WriteValue(dbus.ByteArray(bytes(TIVO_MIC_OPEN_8K)), {},
+                      reply_handler=lambda: None, error_handler=lambda e: print(f'WriteValue failed: {e}'))
+    else:
+        voice_service.simulatingHTT()
+
+    def audio_ended():
+        return any(value[:1] == bytes([AUDIO_END]) for value in ctl_probe.values[ctl_count:])
+
+    if not run_until(audio_ended, timeout):
+        raise RuntimeError('no audio end notification')
+    # frames sent right before the audio end may still be queued
+    run_until(lambda: len(rx_probe) >= len(send_times), 1.0)
+    rx_char.NotifyValue = notify_value
+
+    latencies = [received - sent for sent, received in zip(send_times, rx_probe.times)]
+    duration = (rx_probe.times[-1] - begin) if rx_probe.times else 0.0
+    return summarize('voice_frames', latencies, duration)
+
+
+def print_report(results):
+    print(f"{'scenario':<16} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'mean ms':>9} {'per s':>10}")
+    for r in results:
+        print(f"{r['scenario']:<16} {r['count']:>7} {r.get('p50_ms', 0):>9.3f} {r.get('p99_ms', 0):>9.3f} "
+              f"{r.get('max_ms', 0):>9.3f} {r.get('mean_ms', 0):>9.3f} {r['throughput_per_s']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RCU key/voice latency benchmark on a private D-Bus')
+    parser.add_argument('-rc', dest='rc_type', type=int, default=RC_TYPE_TIVO,
+                        help='Specify RCU type, 0: Sharp, 1: TiVo Remote')
+    parser.add_argument('-n', dest='key_count', type=int, default=1000,
+                        help='Specify the number of key events per key scenario')
+    parser.add_argument('-k', dest='key_name', type=str, default='KEY_UP',
+                        help='Specify the key to send')
+    parser.add_argument('-r', dest='registration_rounds', type=int, default=20,
+                        help='Specify the number of RegisterApplication rounds')
+    parser.add_argument('-vp', dest='voice_pacing', type=str, default=PACING_FAST, choices=PACING_MODES,
+                        help='Specify how the voice frames are released')
+    parser.add_argument('--no-voice', dest='voice', action='store_false',
+                        help='Skip the voice scenario')
+    parser.add_argument('--acquire-notify', dest='acquire_mtu', type=int, default=None,
+                        help='Acquire the voice notifications through a socket with this MTU, as bluetoothd does')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=30.0,
+                        help='Specify the timeout of each scenario, in seconds')
+    parser.add_argument('--json', dest='json_path', type=str, default=None,
+                        help='Write the results to this file as JSON')
+    parser.add_argument('--max-key-p99-ms', dest='max_key_p99_ms', type=float, default=None,
+                        help='Fail when the sequential key p99 latency exceeds this budget')
+    parser.add_argument('--max-voice-p99-ms', dest='max_voice_p99_ms', type=float, default=None,
+                        help='Fail when the voice frame p99 latency exceeds this budget')
+    args = parser.parse_args()
+
+    # the services load their descriptors and audio clips relative to the repository
+    os.chdir(REPO_ROOT)
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    results = []
+    with PrivateBus() as private_bus:
+        bluez_bus = dbus.bus.BusConnection(private_bus.address)
+        rcu_bus = dbus.bus.BusConnection(private_bus.address)
+        fake_bluez = FakeBluez(bluez_bus)
+        rcu_service = make_rcu_service(rcu_bus, args.rc_type, args.voice_pacing)
+        rcu_bus_name = rcu_bus.get_unique_name()
+
+        results.append(bench_registration(rcu_service, args.registration_rounds, args.timeout))
+        print(f'fake BlueZ GetManagedObjects mean = '
+              f'{sum(fake_bluez.adapter.registration_times) / len(fake_bluez.adapter.registration_times) * 1000:.3f} ms')
+
+        hid_service = rcu_service.hid_service
+        if args.key_name not in hid_service.key_dispatch:
+            print(f'unknown key {args.key_name}')
+            return 2
+        report_char = hid_service.key_dispatch[args.key_name][0]
+        for burst in (False, True):
+            probe = SignalProbe(bluez_bus, report_char.get_path())
+            results.append(bench_keys(hid_service, probe, args.key_name, args.key_count, burst, args.timeout))
+            probe.remove()
+
+        if args.voice:
+            voice_service = rcu_service.voice_service
+            rx_char = voice_service.tivo_tv_rx_char if args.rc_type == RC_TYPE_TIVO else voice_service.tv_rx_char
+            ctl_char = voice_service.tivo_tv_ctl_char if args.rc_type == RC_TYPE_TIVO else voice_service.tv_ctl_char
+            if args.acquire_mtu is not None:
+                rx_probe = SocketProbe(bluez_bus, rcu_bus_name, rx_char.get_path(), args.acquire_mtu, args.timeout)
+            else:
+                rx_probe = SignalProbe(bluez_bus, rx_char.get_path())
+            ctl_probe = SignalProbe(bluez_bus, ctl_char.get_path())
+            results.append(bench_voice(rcu_service, args.rc_type, bluez_bus, rcu_bus_name,
+                                       rx_probe, ctl_probe, args.timeout))
+
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    budgets = {'keys_sequential': args.max_key_p99_ms, 'voice_frames': args.max_voice_p99_ms}
+    for r in results:
+        budget = budgets.get(r['scenario'], None)
+        if budget is not None and r.get('p99_ms', 0) > budget:
+            print(f"{r['scenario']} p99 {r['p99_ms']:.3f} ms is over the budget of {budget} ms")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
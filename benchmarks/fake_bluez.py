@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""
+Minimal org.bluez stand-in for the benchmarks: one adapter object with the Adapter1
+properties, GattManager1 and LEAdvertisingManager1, enough for the RCU services to register
+as they do against the real daemon.
+"""
+import time
+import dbus
+import dbus.service
+import bluetooth_constants
+import bluetooth_exceptions
+
+FAKE_ADAPTER_PATH = bluetooth_constants.BLUEZ_NAMESPACE + bluetooth_constants.ADAPTER_NAME
+FAKE_ADAPTER_ADDRESS = '00:00:00:00:B1:E0'
+
+
+class FakeObjectManager(dbus.service.Object):
+    def __init__(self, bus, adapter):
+        self.adapter = adapter
+        dbus.service.Object.__init__(self, bus, '/')
+
+    @dbus.service.method(bluetooth_constants.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return {self.adapter.get_path(): self.adapter.get_interfaces()}
+
+
+class FakeAdapter(dbus.service.Object):
+    def __init__(self, bus, path=FAKE_ADAPTER_PATH):
+        self.bus = bus
+        self.path = path
+        self.properties = {
+            bluetooth_constants.ADAPTER_PROP_MAC_ADDRESS: dbus.String(FAKE_ADAPTER_ADDRESS),
+            bluetooth_constants.ADAPTER_PROP_ALIAS: dbus.String('fake'),
+            bluetooth_constants.ADAPTER_PROP_POWER: dbus.Boolean(False),
+            bluetooth_constants.ADAPTER_PROP_DISCOVERABLE: dbus.Boolean(False),
+            bluetooth_constants.ADAPTER_PROP_PAIRABLE: dbus.Boolean(False),
+        }
+        # {app path: (owner, {obj path: interfaces})}
+        self.applications = {}
+        self.advertisements = set()
+        # seconds taken by the GetManagedObjects call of each RegisterApplication
+        self.registration_times = []
+        dbus.service.Object.__init__(self, bus, path)
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def get_interfaces(self):
+        return {
+            bluetooth_constants.ADAPTER_INTERFACE: self.properties,
+            bluetooth_constants.GATT_MANAGER_INTERFACE: {},
+            bluetooth_constants.ADVERTISING_MANAGER_INTERFACE: {},
+        }
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES, in_signature='ss', out_signature='v')
+    def Get(self, interface, name):
+        if interface != bluetooth_constants.ADAPTER_INTERFACE or name not in self.properties:
+            raise bluetooth_exceptions.InvalidArgsException()
+        return self.properties[name]
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface != bluetooth_constants.ADAPTER_INTERFACE:
+            raise bluetooth_exceptions.InvalidArgsException()
+        self.properties[name] = value
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != bluetooth_constants.ADAPTER_INTERFACE:
+            raise bluetooth_exceptions.InvalidArgsException()
+        return self.properties
+
+    # BlueZ reads the whole object tree of the application before replying
+    @dbus.service.method(bluetooth_constants.GATT_MANAGER_INTERFACE, in_signature='oa{sv}',
+                         sender_keyword='sender', async_callbacks=('reply', 'error'))
+    def RegisterApplication(self, application, options, sender=None, reply=None, error=None):
+        app_om = dbus.Interface(self.bus.get_object(sender, application, introspect=False),
+                                bluetooth_constants.DBUS_OM_IFACE)
+        start_time = time.perf_counter()
+
+        def on_objects(objects):
+            self.registration_times.append(time.perf_counter() - start_time)
+            self.applications[str(application)] = (sender, objects)
+            reply()
+
+        app_om.GetManagedObjects(reply_handler=on_objects, error_handler=error)
+
+    @dbus.service.method(bluetooth_constants.GATT_MANAGER_INTERFACE, in_signature='o')
+    def UnregisterApplication(self, application):
+        if self.applications.pop(str(application), None) is None:
+            raise bluetooth_exceptions.InvalidArgsException()
+
+    @dbus.service.method(bluetooth_constants.ADVERTISING_MANAGER_INTERFACE, in_signature='oa{sv}')
+    def RegisterAdvertisement(self, advertisement, options):
+        self.advertisements.add(str(advertisement))
+
+    @dbus.service.method(bluetooth_constants.ADVERTISING_MANAGER_INTERFACE, in_signature='o')
+    def UnregisterAdvertisement(self, advertisement):
+        self.advertisements.discard(str(advertisement))
+
+
+class FakeBluez:
+    def __init__(self, bus):
+        self.bus_name = dbus.service.BusName(bluetooth_constants.BLUEZ_SERVICE_NAME, bus)
+        self.adapter = FakeAdapter(bus)
+        self.object_manager = FakeObjectManager(bus, self.adapter)
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+"""
+A throw-away dbus-daemon for the benchmarks, so they run without the system bus, BlueZ or
+any Bluetooth hardware.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+
+BUS_CONFIG = '''<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:dir={socket_dir}</listen>
+  <auth>EXTERNAL</auth>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+'''
+
+
+class PrivateBus:
+    def __init__(self):
+        self.tmp_dir = None
+        self.process = None
+        self.address = None
+
+    def start(self):
+        dbus_daemon = shutil.which('dbus-daemon')
+        if dbus_daemon is None:
+            raise RuntimeError('dbus-daemon is not installed')
+        self.tmp_dir = tempfile.mkdtemp(prefix='rcu-bench-bus-')
+        config_path = os.path.join(self.tmp_dir, 'bus.conf')
+        with open(config_path, 'w') as f:
+            f.write(BUS_CONFIG.format(socket_dir=self.tmp_dir))
+        self.process = subprocess.Popen(
+            [dbus_daemon, f'--config-file={config_path}', '--print-address', '--nofork', '--nopidfile'],
+            stdout=subprocess.PIPE, text=True)
+        self.address = self.process.stdout.readline().strip()
+        if not self.address:
+            self.stop()
+            raise RuntimeError('dbus-daemon did not report its address')
+        return self.address
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -2,6 +2,52 @@
 import dbus.service
 import bluetooth_constants
 import bluetooth_exceptions
+import logging
+import socket
+import threading
+from gi.repository import GLib
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS_SENT = REGISTRY.counter('rcu_gatt_notifications_total',
+                                      'GATT notifications sent', ['characteristic', 'path'])
+NOTIFICATION_BYTES_SENT = REGISTRY.counter('rcu_gatt_notification_bytes_total',
+                                           'GATT notification payload bytes sent', ['characteristic', 'path'])
+FD_NOTIFICATIONS_SENT = REGISTRY.counter('rcu_gatt_fd_notifications_total',
+                                         'GATT notifications written to an acquired notify socket',
+                                         ['characteristic', 'path'])
+FD_NOTIFICATIONS_DROPPED = REGISTRY.counter('rcu_gatt_fd_notifications_dropped_total',
+                                            'GATT notifications dropped, the acquired notify socket was full',
+                                            ['characteristic', 'path'])
+
+
+# Wrap a notification payload for PropertiesChanged without building a dbus.Byte per byte.
+# bytes/bytearray/memoryview are marshalled as one 'ay' blob, ready-made dbus.ByteArray or
+# dbus.Array(signature='y') values are passed through untouched.
+def to_dbus_bytes(value):
+    if isinstance(value, (dbus.ByteArray, dbus.Array)):
+        return value
+    return dbus.ByteArray(bytes(value))
+
+
+# Build the ObjectManager tree of the GATT application once: every level is a typed dbus
+# container with an explicit signature, so dbus-python marshals it without guessing types and
+# the same object can be returned from every GetManagedObjects call.
+def build_managed_objects(services):
+    def freeze(properties):
+        return dbus.Dictionary(
+            {interface: dbus.Dictionary(values, signature='sv') for interface, values in properties.items()},
+            signature='sa{sv}')
+
+    response = dbus.Dictionary({}, signature='oa{sa{sv}}')
+    for service in services:
+        response[service.get_path()] = freeze(service.get_properties())
+        for chrc in service.get_characteristics():
+            response[chrc.get_path()] = freeze(chrc.get_properties())
+            for desc in chrc.get_descriptors():
+                response[desc.get_path()] = freeze(desc.get_properties())
+    return response
 
 class Descriptor(dbus.service.Object):
     """
@@ -40,12 +86,12 @@ class Descriptor(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print ('Default ReadValue called, returning error')
+        logger.warning('Default ReadValue called, returning error')
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.GATT_DESCRIPTOR_INTERFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        logger.warning('Default WriteValue called, returning error')
         raise bluetooth_exceptions.NotSupportedException()
 class Characteristic(dbus.service.Object):
     """
@@ -58,6 +104,8 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.notify_counter = NOTIFICATIONS_SENT.labels(self.__class__.__name__, self.path)
+        self.notify_bytes_counter = NOTIFICATION_BYTES_SENT.labels(self.__class__.__name__, self.path)
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -98,32 +146,145 @@ class Characteristic(dbus.service.Object):
 
     @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, in_signature='a{sv}', out_signature='ay')
     def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
+        logger.warning('Default ReadValue called, returning error')
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        logger.warning('Default WriteValue called, returning error')
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
     def StartNotify(self):
-        print('Default StartNotify called, returning error')
+        logger.warning('Default StartNotify called, returning error')
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
     def StopNotify(self):
-        print('Default StopNotify called, returning error')
+        logger.warning('Default StopNotify called, returning error')
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.signal(bluetooth_constants.DBUS_PROPERTIES, signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
+
+    # Notify the value to the subscribed central, value could be bytes, bytearray, memoryview,
+    # dbus.ByteArray or dbus.Array(signature='y').
+    def NotifyValue(self, value):
+        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                               {'Value': to_dbus_bytes(value)}, [])
+        self.notify_counter.inc()
+        self.notify_bytes_counter.inc(len(value))
         
     @dbus.service.signal(bluetooth_constants.DBUS_PROPERTIES, signature='ay')
     def ReportValueChanged(self, reportValue):
         pass
 
+
+class AcquireNotifyCharacteristic(Characteristic):
+    """
+    Characteristic whose notifications bluetoothd can acquire: with the NotifyAcquired property
+    present, it calls AcquireNotify when the central subscribes and reads the notifications from
+    the returned socket, without a PropertiesChanged signal to marshal and parse per packet.
+    NotifyValue falls back to the signal while nothing is acquired.
+    """
+    def __init__(self, bus, index, uuid, flags, service):
+        # NotifyValue is called from the voice threads, the socket is swapped from the GLib loop
+        self.notify_lock = threading.Lock()
+        self.notify_socket = None
+        self.notify_watch = None
+        self.notify_mtu = bluetooth_constants.ATT_DEFAULT_MTU
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.fd_notify_counter = FD_NOTIFICATIONS_SENT.labels(self.__class__.__name__, self.path)
+        self.fd_drop_counter = FD_NOTIFICATIONS_DROPPED.labels(self.__class__.__name__, self.path)
+
+    def get_properties(self):
+        properties = Characteristic.get_properties(self)
+        properties[bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE][
+            bluetooth_constants.GATT_PROP_NOTIFY_ACQUIRED] = dbus.Boolean(self.notify_socket is not None)
+        return properties
+
+    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, in_signature='a{sv}', out_signature='hq')
+    def AcquireNotify(self, options):
+        self.releaseNotify()
+        mtu = int(options.get('mtu', bluetooth_constants.ATT_DEFAULT_MTU))
+        own_socket, bluez_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        # never blocks, a full socket (congested link, central gone before the HUP) drops the
+        # packet instead of stalling the voice thread and the loop waiting for notify_lock
+        own_socket.setblocking(False)
+        # UnixFd keeps a duplicate, sent with the reply
+        fd = dbus.types.UnixFd(bluez_socket)
+        bluez_socket.close()
+        with self.notify_lock:
+            self.notify_mtu = mtu
+            self.notify_socket = own_socket
+            # bluetoothd closes its end when the central unsubscribes or disconnects
+            self.notify_watch = GLib.io_add_watch(own_socket.fileno(), GLib.PRIORITY_DEFAULT,
+                                                  GLib.IO_HUP | GLib.IO_ERR, self.onNotifySocketClosed)
+        logger.info('%s.AcquireNotify, mtu = %s, device = %s', self.__class__.__name__, mtu,
+                    options.get('device', None))
+        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                               {bluetooth_constants.GATT_PROP_NOTIFY_ACQUIRED: dbus.Boolean(True)}, [])
+        self.onNotifyAcquired(mtu)
+        return fd, dbus.UInt16(mtu)
+
+    # called once the notifications are acquired, with the MTU of the link
+    def onNotifyAcquired(self, mtu):
+        pass
+
+    def _detachNotifySocket(self):
+        # with notify_lock held
+        detached = (self.notify_socket, self.notify_watch)
+        self.notify_socket = None
+        self.notify_watch = None
+        return detached
+
+    def _closeNotifySocket(self, notify_socket, watch_id):
+        # from the GLib loop, also as an idle callback
+        if watch_id is not None:
+            GLib.source_remove(watch_id)
+        notify_socket.close()
+        logger.info('%s, notify socket released', self.__class__.__name__)
+        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                               {bluetooth_constants.GATT_PROP_NOTIFY_ACQUIRED: dbus.Boolean(False)}, [])
+        return False
+
+    def releaseNotify(self):
+        with self.notify_lock:
+            notify_socket, watch_id = self._detachNotifySocket()
+        if notify_socket is not None:
+            self._closeNotifySocket(notify_socket, watch_id)
+
+    def onNotifySocketClosed(self, fd, condition):
+        with self.notify_lock:
+            if self.notify_socket is None or self.notify_socket.fileno() != fd:
+                return False
+            notify_socket, _ = self._detachNotifySocket()
+        # the watch is removed by returning False
+        self._closeNotifySocket(notify_socket, None)
+        return False
+
+    def NotifyValue(self, value):
+        with self.notify_lock:
+            notify_socket = self.notify_socket
+            if notify_socket is not None:
+                try:
+                    notify_socket.send(value if isinstance(value, (bytes, bytearray, memoryview)) else bytes(value))
+                except BlockingIOError:
+                    # bluetoothd is behind, a signal now would overtake the queued packets
+                    self.fd_drop_counter.inc()
+                    logger.debug('%s, notify socket full, packet dropped', self.__class__.__name__)
+                    return
+                except OSError as e:
+                    logger.warning('%s, notify socket send failed: %s, back to signals', self.__class__.__name__, e)
+                    GLib.idle_add(self._closeNotifySocket, *self._detachNotifySocket())
+                else:
+                    self.fd_notify_counter.inc()
+                    self.notify_counter.inc()
+                    self.notify_bytes_counter.inc(len(value))
+                    return
+        Characteristic.NotifyValue(self, value)
+
 class Service(dbus.service.Object):
     """
     org.bluez.GattService1 interface implementation
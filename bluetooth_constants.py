@@ -24,6 +24,8 @@ GATT_MANAGER_INTERFACE = BLUEZ_SERVICE_NAME + ".GattManager1"
 GATT_SERVICE_INTERFACE = BLUEZ_SERVICE_NAME + ".GattService1"
 GATT_CHARACTERISTIC_INTERFACE = BLUEZ_SERVICE_NAME + ".GattCharacteristic1"
 GATT_DESCRIPTOR_INTERFACE = BLUEZ_SERVICE_NAME + ".GattDescriptor1"
+GATT_PROP_NOTIFY_ACQUIRED = "NotifyAcquired"
+ATT_DEFAULT_MTU = 23
 ADVERTISEMENT_INTERFACE = BLUEZ_SERVICE_NAME + ".LEAdvertisement1"
 ADVERTISING_MANAGER_INTERFACE = BLUEZ_SERVICE_NAME + ".LEAdvertisingManager1"
 
@@ -1,22 +1,144 @@
 #!/usr/bin/python3
+"""
+D-Bus proxies of the BlueZ objects, cached per bus connection.
+
+Proxies are built without introspection, the interface is always named, so getting one costs
+no round trip. The cache of a bus is keyed by (object path, interface) and drops the entries
+of an object, and of the objects below it, when BlueZ sends InterfacesRemoved for it. It is
+cleared when org.bluez changes owner, proxies are bound to the unique name of the bluetoothd
+they were created for.
+
+    device = get_object_interface(path, bluetooth_constants.DEVICE_INTERFACE)
+    get_device_property_async(path, 'Connected', on_connected, on_error)
+"""
+import logging
+import threading
+import time
 import bluetooth_constants
 import dbus
+from metrics import REGISTRY, DBUS_CALL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+PROXY_CACHE_LOOKUPS = REGISTRY.counter('rcu_dbus_proxy_cache_lookups_total',
+                                       'D-Bus proxy cache lookups', ['result'])
+PROXY_CACHE_HITS = PROXY_CACHE_LOOKUPS.labels('hit')
+PROXY_CACHE_MISSES = PROXY_CACHE_LOOKUPS.labels('miss')
+DEVICE_GET_SECONDS = DBUS_CALL_SECONDS.labels('Device1.Get')
+
+# {bus: ProxyCache}
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class ProxyCache:
+    """
+    {(object path, interface): dbus.Interface} of one bus connection. Lookups may come from any
+    thread, the invalidation runs from the GLib loop.
+    """
+
+    def __init__(self, bus, service_name=bluetooth_constants.BLUEZ_SERVICE_NAME):
+        self.bus = bus
+        self.service_name = service_name
+        self.lock = threading.Lock()
+        self.proxies = {}
+        self.interfaces = {}
+        # unique name of the service, the watch reports the current one first
+        self.owner = None
+        self.removed_match = bus.add_signal_receiver(self.onInterfacesRemoved,
+                                                     dbus_interface=bluetooth_constants.DBUS_OM_IFACE,
+                                                     signal_name='InterfacesRemoved',
+                                                     bus_name=service_name)
+        self.owner_watch = bus.watch_name_owner(service_name, self.onNameOwnerChanged)
+
+    def get_interface(self, path, interface_name):
+        key = (str(path), interface_name)
+        with self.lock:
+            interface = self.interfaces.get(key, None)
+            if interface is not None:
+                PROXY_CACHE_HITS.inc()
+                return interface
+            proxy = self.proxies.get(key[0], None)
+            if proxy is None:
+                proxy = self.bus.get_object(self.service_name, path, introspect=False)
+                self.proxies[key[0]] = proxy
+            interface = dbus.Interface(proxy, interface_name)
+            self.interfaces[key] = interface
+        PROXY_CACHE_MISSES.inc()
+        return interface
+
+    def invalidate(self, path):
+        # drops path and the objects below it, e.g. the GATT objects of a device
+        path = str(path)
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for cached_path in [p for p in self.proxies if p == path or p.startswith(prefix)]:
+                del self.proxies[cached_path]
+            for key in [k for k in self.interfaces if k[0] == path or k[0].startswith(prefix)]:
+                del self.interfaces[key]
+
+    def clear(self):
+        with self.lock:
+            self.proxies.clear()
+            self.interfaces.clear()
+
+    def close(self):
+        self.removed_match.remove()
+        self.owner_watch.cancel()
+        self.clear()
 
+    def onInterfacesRemoved(self, path, interfaces):
+        self.invalidate(path)
 
-def get_device_property(path, property_name):
+    def onNameOwnerChanged(self, owner):
+        previous, self.owner = self.owner, owner
+        if previous is None:
+            return
+        logger.info('ProxyCache, %s owner changed from %s to %r, cache cleared', self.service_name, previous, owner)
+        self.clear()
+
+
+def get_proxy_cache(bus=None):
+    # The cache of bus, the shared system bus by default, created on first use
+    bus = bus if bus is not None else dbus.SystemBus()
+    with _caches_lock:
+        cache = _caches.get(bus, None)
+        if cache is None:
+            cache = ProxyCache(bus)
+            _caches[bus] = cache
+    return cache
+
+
+def get_object_interface(path, interface_name, bus=None):
+    return get_proxy_cache(bus).get_interface(path, interface_name)
+
+
+def get_device_property(path, property_name, bus=None):
     prop_state = False
     try:
-        properties_in_path = dbus.Interface(dbus.SystemBus().get_object(
-            bluetooth_constants.BLUEZ_SERVICE_NAME, path), bluetooth_constants.DBUS_PROPERTIES)
-        prop_state = properties_in_path.Get(
-            bluetooth_constants.DEVICE_INTERFACE, property_name)
+        properties_in_path = get_object_interface(path, bluetooth_constants.DBUS_PROPERTIES, bus)
+        with DEVICE_GET_SECONDS.time():
+            prop_state = properties_in_path.Get(
+                bluetooth_constants.DEVICE_INTERFACE, property_name)
     except Exception as e:
-        print(f"get_device_property, exception occurs with :{e}")
+        logger.warning('get_device_property, exception occurs with :%s', e)
     return prop_state
 
-def get_object_interface(path, interface_name):
-    bus = dbus.SystemBus()
-    device_proxy = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, path)
-    device_interface = dbus.Interface(device_proxy, interface_name)
-    return device_interface
-    
+
+def get_device_property_async(path, property_name, reply_handler, error_handler, bus=None):
+    # get_device_property() without blocking the GLib loop, reply_handler(value)
+    properties_in_path = get_object_interface(path, bluetooth_constants.DBUS_PROPERTIES, bus)
+    start_time = time.perf_counter()
+
+    def on_reply(value):
+        DEVICE_GET_SECONDS.observe(time.perf_counter() - start_time)
+        reply_handler(value)
+
+    properties_in_path.Get(bluetooth_constants.DEVICE_INTERFACE, property_name,
+                           reply_handler=on_reply, error_handler=error_handler)
+
+
+def call_method_async(path, interface_name, method_name, *args, reply_handler, error_handler, bus=None):
+    # e.g. call_method_async(device_path, DEVICE_INTERFACE, 'Disconnect', reply_handler=.., error_handler=..)
+    interface = get_object_interface(path, interface_name, bus)
+    getattr(interface, method_name)(*args, reply_handler=reply_handler, error_handler=error_handler)
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+"""
+Start-up sequence of main.py as a state machine on the GLib loop. Steps that do not depend
+on each other run at the same time, the D-Bus calls use reply handlers and the blocking
+shell steps run on worker threads:
+
+    clear_devices -> find_adapters -> adapter_setup[hci] --> advertise[i], register_gatt[i]
+                                  -> create_remotes ----/
+                                  -> register_agent
+    ssh_probe[ip] (and clear_devices) -> auto_connect[ip]
+
+Each phase is timed from the launch of the process, the table is printed once every remote
+advertises and is registered, and the durations go to the rcu_bringup_phase_seconds metric.
+"""
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+import dbus
+from gi.repository import GLib
+import bluetooth_constants
+from bluetooth_utils import get_object_interface
+from metrics import REGISTRY
+from rcu_instance import find_adapters_async, get_discoverable_name
+from tv_provisioning import TvProvisioner, SshTransport, ProvisioningError, HostKeyVerificationError, \
+    clear_local_devices
+
+# time.monotonic() when the process started, close enough to the launch for the phase table
+LAUNCH_TIME = time.monotonic()
+
+BRINGUP_PHASE_SECONDS = REGISTRY.histogram('rcu_bringup_phase_seconds', 'Duration of a start-up phase', ['phase'])
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='Bringup')
+# several ssh probes may ask for a host key at the same time
+_prompt_lock = threading.Lock()
+
+
+def run_in_thread(on_done, function, *args, **kwargs):
+    # Runs function(*args, **kwargs) on a worker thread, on_done(result, error) is called on the
+    # GLib loop
+    def deliver(future):
+        error = future.exception()
+        on_done(None if error is not None else future.result(), error)
+        return False
+
+    future = _executor.submit(function, *args, **kwargs)
+    future.add_done_callback(lambda f: GLib.idle_add(deliver, f))
+
+
+def checkSshConnection(provisioner):
+    # Opens the SSH master connection to a TV, asks whether to accept an unknown host key
+    target_ip = provisioner.transport.host
+    TRY_TIMES = 2
+    for i in range(TRY_TIMES):
+        try:
+            provisioner.open()
+            print(f"SSH connection to {target_ip} successful.")
+            return True
+        except HostKeyVerificationError:
+            print(f"SSH connection fail with key verification!")
+            with _prompt_lock:
+                answer = input(f"Do you want to accept the new RSA key fingerprint of {target_ip}? (yes/no): ")
+            if answer.lower() == "yes":
+                # 接受新的 RSA 密钥指纹
+                known_hosts_path = os.path.expanduser("~/.ssh/known_hosts")
+                os.system(f"ssh-keyscan -H {target_ip} >> {known_hosts_path}")
+                print("RSA key fingerprint accepted.")
+                continue
+            else:
+                print("User chose not to accept the new RSA key fingerprint. Exiting script.")
+                return False
+        except (ProvisioningError, OSError, subprocess.SubprocessError) as e:
+            print(f"SSH connection to {target_ip} failed: {e}")
+            return False
+    return False
+
+
+class PhaseTimer:
+
+    def __init__(self, launch_time=LAUNCH_TIME):
+        self.launch_time = launch_time
+        # {name: [start, end or None]}, in start order
+        self.phases = {}
+
+    def begin(self, name):
+        self.phases[name] = [time.monotonic(), None]
+
+    def end(self, name):
+        phase = self.phases[name]
+        phase[1] = time.monotonic()
+        # ssh_probe[10.0.0.1] and ssh_probe[10.0.0.2] are one series
+        BRINGUP_PHASE_SECONDS.labels(name.split('[', 1)[0]).observe(phase[1] - phase[0])
+
+    def report(self):
+        lines = [f"{'phase':<32} {'start s':>8} {'took ms':>9}"]
+        for name, (start, end) in self.phases.items():
+            took = f'{(end - start) * 1000:9.1f}' if end is not None else f"{'-':>9}"
+            lines.append(f'{name:<32} {start - self.launch_time:8.3f} {took}')
+        lines.append(f"{'total':<32} {time.monotonic() - self.launch_time:8.3f}")
+        return '\n'.join(lines)
+
+
+class Join:
+    # Calls callback() once done() has been called count times
+    def __init__(self, count, callback):
+        self.count = count
+        self.callback = callback
+        if self.count == 0:
+            GLib.idle_add(self.fire)
+
+    def done(self):
+        self.count -= 1
+        if self.count == 0:
+            self.fire()
+
+    def fire(self):
+        self.callback()
+        return False
+
+
+class Bringup:
+    """
+    create_instance(index, adapter_path, mac_address) returns the RcuInstance of a remote,
+    on_ready() is called once every remote advertises and its GATT application is registered,
+    on_fatal_error() when a step fails; nothing is started after a failure.
+    """
+
+    def __init__(self, bus, rc_type, instance_count, ip_addresses, wanted_adapters, agent_path, io_capability,
+                 create_instance, on_ready, on_fatal_error):
+        self.bus = bus
+        self.rc_type = rc_type
+        self.instance_count = instance_count
+        self.single = instance_count == 1
+        self.ip_addresses = ip_addresses[:instance_count]
+        self.wanted_adapters = wanted_adapters
+        self.agent_path = agent_path
+        self.io_capability = io_capability
+        self.create_instance = create_instance
+        self.on_ready = on_ready
+        self.on_fatal_error = on_fatal_error
+        self.timer = PhaseTimer()
+        self.failed = False
+        self.instances = []
+        # {adapter path: dbus.Interface(Properties)}, the adapters that were powered on
+        self.adapter_props = {}
+        self.mac_addresses = {}
+        self.devices_cleared = False
+        # {ip: TvProvisioner} of the TVs whose SSH connection is up
+        self.provisioners = {}
+
+    def start(self):
+        self.timer.begin('clear_devices')
+        run_in_thread(self.onDevicesCleared, clear_local_devices)
+        for target_ip in self.ip_addresses:
+            name = f'ssh_probe[{target_ip}]'
+            self.timer.begin(name)
+            provisioner = TvProvisioner(SshTransport(target_ip))
+            run_in_thread(lambda ok, error, target_ip=target_ip, provisioner=provisioner:
+                          self.onSshProbed(target_ip, provisioner, ok, error),
+                          checkSshConnection, provisioner)
+        return False
+
+    def fail(self, message):
+        if self.failed:
+            return
+        self.failed = True
+        print(f"Bring-up failed: {message}")
+        print(self.timer.report())
+        self.on_fatal_error()
+
+    def phaseErrorHandler(self, phase):
+        return lambda error: self.fail(f'{phase}: {error}')
+
+    def onDevicesCleared(self, result, error):
+        self.timer.end('clear_devices')
+        if self.failed:
+            return
+        if error is not None:
+            self.fail(f"clear_aml_devices fail {error}")
+            return
+        print("clear_aml_devices ok")
+        self.devices_cleared = True
+        # bluetoothd was restarted by the script, the adapters can be looked up now
+        self.timer.begin('find_adapters')
+        find_adapters_async(self.bus, self.onAdaptersFound, self.phaseErrorHandler('find_adapters'))
+        for target_ip in self.provisioners:
+            self.startAutoConnect(target_ip)
+
+    def onSshProbed(self, target_ip, provisioner, ok, error):
+        self.timer.end(f'ssh_probe[{target_ip}]')
+        if self.failed:
+            provisioner.close()
+            return
+        if not ok:
+            self.fail(f"checkSshConnection fail, ip_address = {target_ip} {error if error is not None else ''}")
+            return
+        self.provisioners[target_ip] = provisioner
+        if self.devices_cleared:
+            self.startAutoConnect(target_ip)
+
+    def startAutoConnect(self, target_ip):
+        # the TV of the n-th ip address pairs with the n-th remote, over the connection of the probe
+        index = self.ip_addresses.index(target_ip)
+        discover_devices_name = get_discoverable_name(self.rc_type, index, self.single)
+        name = f'auto_connect[{target_ip}]'
+        print(f"auto connect {target_ip} to {discover_devices_name}")
+        self.timer.begin(name)
+        run_in_thread(lambda address, error: self.onAutoConnected(name, target_ip, address, error),
+                      self.provisioners[target_ip].provision, discover_devices_name)
+
+    def onAutoConnected(self, name, target_ip, address, error):
+        self.timer.end(name)
+        if error is not None:
+            print(f"auto connect {target_ip} fail: {error}")
+        else:
+            print(f"auto connect {target_ip} to {address} ok")
+
+    def onAdaptersFound(self, adapter_objs):
+        self.timer.end('find_adapters')
+        if self.failed:
+            return
+        if self.wanted_adapters:
+            missing = [adapter for adapter in self.wanted_adapters if adapter not in adapter_objs]
+            if missing:
+                self.fail(f'adapter_obj not found: {missing}')
+                return
+            adapter_objs = self.wanted_adapters
+        if not adapter_objs:
+            self.fail('adapter_obj not found')
+            return
+        adapter_objs = adapter_objs[:self.instance_count]
+
+        # remotes advertise and register once every one of them is built and its adapter is set up
+        self.ready_join = Join(2 * self.instance_count + 1, self.onReady)
+        self.remotes_created_join = Join(len(adapter_objs), lambda: self.createRemotes(adapter_objs))
+        self.adapter_powered = {}
+        for index, adapter_obj in enumerate(adapter_objs):
+            self.setupAdapter(index, adapter_obj)
+        self.registerAgent()
+
+    def setupAdapter(self, index, adapter_obj):
+        print(f"1. Power on the bluetooth adapter {adapter_obj}..")
+        name = f'adapter_setup[{os.path.basename(adapter_obj)}]'
+        self.timer.begin(name)
+        adapter_props = get_object_interface(adapter_obj, bluetooth_constants.DBUS_PROPERTIES, self.bus)
+        self.adapter_props[adapter_obj] = adapter_props
+        on_error = self.phaseErrorHandler(name)
+
+        # Discoverable needs a powered adapter, the other properties are independent. The
+        # adapter alias follows the first remote on it.
+        setup_join = Join(4, lambda: self.onAdapterReady(name, adapter_obj))
+
+        def on_powered():
+            adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
+                              bluetooth_constants.ADAPTER_PROP_DISCOVERABLE, dbus.Boolean(1),
+                              reply_handler=setup_join.done, error_handler=on_error)
+
+        def on_address(address):
+            self.mac_addresses[adapter_obj] = address
+            self.remotes_created_join.done()
+            setup_join.done()
+
+        adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
+                          bluetooth_constants.ADAPTER_PROP_POWER, dbus.Boolean(1),
+                          reply_handler=on_powered, error_handler=on_error)
+        adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
+                          bluetooth_constants.ADAPTER_PROP_PAIRABLE, dbus.Boolean(1),
+                          reply_handler=setup_join.done, error_handler=on_error)
+        adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
+                          bluetooth_constants.ADAPTER_PROP_ALIAS, dbus.String(
+                              get_discoverable_name(self.rc_type, index, self.single)),
+                          reply_handler=setup_join.done, error_handler=on_error)
+        adapter_props.Get(bluetooth_constants.ADAPTER_INTERFACE, bluetooth_constants.ADAPTER_PROP_MAC_ADDRESS,
+                          reply_handler=on_address, error_handler=on_error)
+
+    def onAdapterReady(self, name, adapter_obj):
+        self.timer.end(name)
+        self.adapter_powered[adapter_obj] = True
+        self.startRemotes(adapter_obj)
+
+    def createRemotes(self, adapter_objs):
+        # in index order once every adapter address is known, the control socket addresses the
+        # remotes by index
+        if self.failed:
+            return
+        self.timer.begin('create_remotes')
+        for index in range(self.instance_count):
+            adapter_obj = adapter_objs[index % len(adapter_objs)]
+            instance = self.create_instance(index, adapter_obj, self.mac_addresses[adapter_obj])
+            instance.prepare_application()
+            self.instances.append(instance)
+            print(f"Create {instance.get_name()}")
+        self.timer.end('create_remotes')
+        for adapter_obj in adapter_objs:
+            self.startRemotes(adapter_obj)
+
+    def startRemotes(self, adapter_obj):
+        # called when the adapter is set up and when the remotes are created, runs after both
+        if self.failed or not self.instances or not self.adapter_powered.get(adapter_obj, False):
+            return
+        for instance in self.instances:
+            if instance.adapter_path != adapter_obj:
+                continue
+            advertise_name = f'advertise[{instance.index}]'
+            register_name = f'register_gatt[{instance.index}]'
+            self.timer.begin(advertise_name)
+            self.timer.begin(register_name)
+            instance.start_advertising(self.on_fatal_error,
+                                       lambda name=advertise_name: self.onPhaseDone(name))
+            instance.register_application(self.on_fatal_error,
+                                          lambda name=register_name: self.onPhaseDone(name))
+
+    def registerAgent(self):
+        print(f"2. Agent procedure, register with io: {self.io_capability}")
+        self.timer.begin('register_agent')
+        agent_manager = get_object_interface('/org/bluez', bluetooth_constants.AGENT_MANAGER_INTERFACE, self.bus)
+        on_error = self.phaseErrorHandler('register_agent')
+        agent_manager.RegisterAgent(
+            self.agent_path, self.io_capability,
+            reply_handler=lambda: agent_manager.RequestDefaultAgent(
+                self.agent_path, reply_handler=lambda: self.onPhaseDone('register_agent'), error_handler=on_error),
+            error_handler=on_error)
+
+    def onPhaseDone(self, name):
+        self.timer.end(name)
+        self.ready_join.done()
+
+    def onReady(self):
+        if self.failed:
+            return
+        print("Bring-up done")
+        print(self.timer.report())
+        self.on_ready()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+"""
+Line based command socket on a Unix stream socket.
+
+Each line is "<command> [args..]", the reply is one line "OK [result]" or "ERR <reason>".
+Commands are registered with add_command(name, handler, usage), handler(args) returns the
+result text and raises ValueError for bad arguments.
+
+The socket is served from its own threads, one per client. A handler runs on the GLib main
+loop and the client thread waits for its result, unless it is registered with on_loop=False:
+those run on the client thread and still answer while the loop is stalled.
+
+    $ echo "key KEY_HOME click" | socat - UNIX-CONNECT:/tmp/ble-rcu-simu.sock
+"""
+import os
+import socketserver
+import threading
+from gi.repository import GLib
+
+DEFAULT_CONTROL_SOCKET_PATH = '/tmp/ble-rcu-simu.sock'
+MAX_LINE_LENGTH = 4096
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_LINE_LENGTH + 1)
+            if not line or not line.endswith(b'\n') and len(line) > MAX_LINE_LENGTH:
+                return
+            reply = self.server.control_socket.execute(line.decode(errors='replace').strip())
+            if reply is not None:
+                try:
+                    self.wfile.write((reply + '\n').encode())
+                except OSError:
+                    return
+
+
+class _ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlSocket:
+
+    def __init__(self, path=DEFAULT_CONTROL_SOCKET_PATH):
+        self.path = path
+        # {name: (handler, usage, on_loop)}
+        self.commands = {}
+        self.server = None
+        self.add_command('help', self.onHelp, 'help', on_loop=False)
+
+    def add_command(self, name, handler, usage=None, on_loop=True):
+        # on_loop=False for the handlers that are thread safe and must not wait for the loop
+        self.commands[name] = (handler, usage or name, on_loop)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = _ThreadingUnixStreamServer(self.path, _ControlHandler)
+        self.server.control_socket = self
+        threading.Thread(target=self.server.serve_forever, name='ControlSocket', daemon=True).start()
+        print(f'ControlSocket, listening on {self.path}')
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def runOnLoop(self, handler, args):
+        # the handlers drive the D-Bus objects, they run on the loop and the client waits
+        done = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = handler(args)
+            except Exception as e:
+                outcome['error'] = e
+            done.set()
+            return False
+
+        GLib.idle_add(run)
+        done.wait()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def execute(self, line):
+        # Returns the reply line, None for an empty line.
+        if not line:
+            return None
+        name, *args = line.split()
+        command = self.commands.get(name, None)
+        if command is None:
+            return f'ERR unknown command: {name}'
+        handler, _, on_loop = command
+        try:
+            result = self.runOnLoop(handler, args) if on_loop else handler(args)
+        except ValueError as e:
+            return f'ERR {e}'
+        except Exception as e:
+            print(f'ControlSocket, command "{line}" failed: {e}')
+            return f'ERR {e}'
+        return 'OK' if not result else f'OK {result}'
+
+    def onHelp(self, args):
+        return '; '.join(usage for _, usage, _ in self.commands.values())
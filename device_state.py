@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+"""
+Cache of the BlueZ device properties the connection state machine needs, fed from the
+PropertiesChanged and InterfacesAdded payloads. Missing values are fetched with one
+asynchronous Properties.GetAll per device, nothing here blocks the GLib loop.
+"""
+import logging
+import time
+import bluetooth_constants
+from bluetooth_utils import get_object_interface
+from metrics import DBUS_CALL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+GET_ALL_SECONDS = DBUS_CALL_SECONDS.labels('Device1.GetAll')
+
+TRACKED_PROPERTIES = (bluetooth_constants.DEVICE_PROP_PAIRED,
+                      bluetooth_constants.DEVICE_PROP_CONNECTED,
+                      bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED)
+
+
+class DeviceStateCache:
+    """
+    {obj path: {"Paired": True/False/None, "Connected": ..., "ServicesResolved": ...}}, None
+    until the value is known. on_state_changed(path, state) is called from the GLib loop once
+    all the tracked properties of a device are known and whenever one of them changes.
+    """
+
+    def __init__(self, bus, on_state_changed):
+        self.bus = bus
+        self.on_state_changed = on_state_changed
+        self.states = {}
+        # device paths with a GetAll in flight
+        self.pending = set()
+
+    def get_state(self, path):
+        return self.states.get(path, None)
+
+    def _merge(self, path, properties):
+        state = self.states.get(path, None)
+        if state is None:
+            state = dict.fromkeys(TRACKED_PROPERTIES)
+            self.states[path] = state
+        changed = False
+        for name in TRACKED_PROPERTIES:
+            if name in properties:
+                value = bool(properties[name])
+                if state[name] != value:
+                    state[name] = value
+                    changed = True
+        return state, changed
+
+    def _is_complete(self, state):
+        return all(state[name] is not None for name in TRACKED_PROPERTIES)
+
+    def update(self, path, properties):
+        # properties is the changed dict of PropertiesChanged or the Device1 dict of InterfacesAdded
+        if path not in self.states and not any(name in properties for name in TRACKED_PROPERTIES):
+            # e.g. RSSI updates of a device nearby, not a connection event
+            return
+        state, changed = self._merge(path, properties)
+        if not self._is_complete(state):
+            self._fetch(path)
+        elif changed:
+            self.on_state_changed(path, state)
+
+    def remove(self, path):
+        self.states.pop(path, None)
+
+    def _fetch(self, path):
+        if path in self.pending:
+            return
+        self.pending.add(path)
+        device_props = get_object_interface(path, bluetooth_constants.DBUS_PROPERTIES, self.bus)
+        start_time = time.perf_counter()
+        device_props.GetAll(bluetooth_constants.DEVICE_INTERFACE,
+                            reply_handler=lambda properties: self._on_fetched(path, properties, start_time),
+                            error_handler=lambda error: self._on_fetch_error(path, error))
+
+    def _on_fetched(self, path, properties, start_time):
+        GET_ALL_SECONDS.observe(time.perf_counter() - start_time)
+        self.pending.discard(path)
+        if path not in self.states:
+            # removed while the call was in flight
+            return
+        # the reply is at least as recent as every signal received before it
+        state, changed = self._merge(path, properties)
+        if self._is_complete(state) and changed:
+            self.on_state_changed(path, state)
+
+    def _on_fetch_error(self, path, error):
+        self.pending.discard(path)
+        logger.warning('DeviceStateCache, GetAll failed, path = %s: %s', path, error)
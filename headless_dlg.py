@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+"""
+Stand-in for SharpRcuDlg / TivoRcuDlg when running without a display: same calls as seen by
+the RCU and voice services, with keys and voice settings driven programmatically (e.g. by the
+control socket) instead of by widgets. Does not import PyQt5.
+"""
+import os
+
+
+class HeadlessRcuDlg:
+    def __init__(self, key_event_listener, capture_keyboard_listener, key_descriptor_obj, key_exit_listener=None):
+        self.key_event_listener = key_event_listener
+        self.capture_keyboard_listener = capture_keyboard_listener
+        self.key_exit_listener = key_exit_listener
+        self.key_descriptor_obj = key_descriptor_obj
+        current_dir = os.getcwd()
+        self.path_to_8k_file = os.path.join(
+            current_dir, "./audio/find_spiderman_8k.wav")
+        self.path_to_16k_file = os.path.join(
+            current_dir, "./audio/find_spiderman_16k.wav")
+        self.capture_by_file = True
+        self.visible = False
+
+    def show(self):
+        self.visible = True
+
+    def hide(self):
+        self.visible = False
+
+    def isVisible(self):
+        return self.visible
+
+    def get_8k_file_path(self):
+        return self.path_to_8k_file
+
+    def get_16k_file_path(self):
+        return self.path_to_16k_file
+
+    def set_8k_file_path(self, file_path):
+        self.path_to_8k_file = file_path
+
+    def set_16k_file_path(self, file_path):
+        self.path_to_16k_file = file_path
+
+    def setCaptureByFile(self, capture_by_file):
+        self.capture_by_file = capture_by_file
+
+    def getCaptureByFile(self):
+        return self.capture_by_file
+
+    def pressKey(self, key_name):
+        self.key_event_listener(key_name, True)
+
+    def releaseKey(self, key_name):
+        self.key_event_listener(key_name, False)
+
+    def clickKey(self, key_name):
+        self.key_event_listener(key_name, True)
+        self.key_event_listener(key_name, False)
@@ -1,50 +1,59 @@
 #!/usr/bin/python3
-from threading import Timer
+import threading
+from timer_scheduler import get_default_scheduler
+import logging
+
+logger = logging.getLogger(__name__)
 
 KEY_STATE_TO_DETERMINE = 'KEY_STATE_TO_DETERMINE'
 KEY_STATE_PRESSED = 'KEY_STATE_PRESSED'
 
 
 class KeyDetector():
-    def __init__(self, handlePress, handleRelease, handleClick):
+    def __init__(self, handlePress, handleRelease, handleClick, scheduler=None):
         self.handlePress = handlePress
         self.handleRelease = handleRelease
         self.handleClick = handleClick
-        self.key_state_keeper = None
-        self.detect_key_timer = None
+        # the click-or-hold timeouts of every detector share one scheduler, no thread per key press
+        self.scheduler = scheduler if scheduler is not None else get_default_scheduler()
+        self.lock = threading.Lock()
+        # {key name: key state} of the keys currently held down
+        self.key_state_keeper = {}
+        # {key name: TimerHandle} of the keys still to be determined
+        self.detect_key_timers = {}
         # threshold to determine if a key press-release is a click or or press/hold, in seconds
         self.detect_key_threshold = 0.5
 
     def detectKeyTimeout(self, key_name):
-        print(f'KeyDetector.detectKeyTimeout: {key_name}')
-        if self.key_state_keeper is None or key_name not in self.key_state_keeper:
-            print(f'KeyDetector.detectKeyTimeout is not valid with {key_name}')
-            return
-        key_state = self.key_state_keeper[key_name]
-        if key_state == KEY_STATE_TO_DETERMINE:
-            self.handlePress(key_name)
+        logger.debug('KeyDetector.detectKeyTimeout: %s', key_name)
+        with self.lock:
+            self.detect_key_timers.pop(key_name, None)
+            key_state = self.key_state_keeper.get(key_name, None)
+            if key_state != KEY_STATE_TO_DETERMINE:
+                logger.warning('KeyDetector.detectKeyTimeout, %s with state: %s is not valid',
+                               key_name, key_state)
+                return
             self.key_state_keeper[key_name] = KEY_STATE_PRESSED
-        else:
-            print(
-                f'KeyDetector.detectKeyTimeout, {key_name} with state: {key_state} is not valid')
+        self.handlePress(key_name)
 
     def onPressed(self, key_name):
-        if self.key_state_keeper == None:
-            self.key_state_keeper = {key_name: KEY_STATE_TO_DETERMINE}
-            self.detect_key_timer = Timer(
-                self.detect_key_threshold, self.detectKeyTimeout, args=(key_name,))
-            self.detect_key_timer.start()
-        else:
-            print(
-                f'KeyDetector.onPressed error: previous {key_name} onPressed has not get onReleased yet, ignore!')
+        with self.lock:
+            if key_name in self.key_state_keeper:
+                # auto repeat of a key already held down
+                return
+            self.key_state_keeper[key_name] = KEY_STATE_TO_DETERMINE
+            self.detect_key_timers[key_name] = self.scheduler.call_later(
+                self.detect_key_threshold, self.detectKeyTimeout, key_name)
 
     def onReleased(self, key_name):
-        self.detect_key_timer.cancel()
-        self.detect_key_timer = None
-
-        key_state = self.key_state_keeper[key_name]
+        with self.lock:
+            timer = self.detect_key_timers.pop(key_name, None)
+            if timer is not None:
+                timer.cancel()
+            key_state = self.key_state_keeper.pop(key_name, None)
         if key_state == KEY_STATE_TO_DETERMINE:
             self.handleClick(key_name)
         elif key_state == KEY_STATE_PRESSED:
             self.handleRelease(key_name)
-        self.key_state_keeper = None
+        else:
+            logger.warning('KeyDetector.onReleased, %s was not pressed, ignore!', key_name)
@@ -3,10 +3,14 @@ import keyboard
 import threading
 
 from key_detector import KeyDetector
+import logging
+
+logger = logging.getLogger(__name__)
+
 
 class KeyEventMonitor(threading.Thread):
     def __init__(self, key_event_listener, key_exit_listener):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='KeyEventMonitor')
         self.key_event_listener = key_event_listener
         self.key_exit_listener = key_exit_listener
         self.b_capture_keyboard = False
@@ -17,15 +21,15 @@ class KeyEventMonitor(threading.Thread):
         self.b_capture_keyboard = bCaptureKeyboard
 
     def handlePress(self, key_name):
-        print(f'KeyEventMonitor.handlePress, key_name = {key_name}')
+        logger.debug('KeyEventMonitor.handlePress, key_name = %s', key_name)
         self.key_event_listener(key_name, True)
 
     def handleRelease(self, key_name):
-        print(f'KeyEventMonitor.handleRelease, key_name = {key_name}')
+        logger.debug('KeyEventMonitor.handleRelease, key_name = %s', key_name)
         self.key_event_listener(key_name, False)
 
     def handleClick(self, key_name):
-        print(f'KeyEventMonitor.handleClick, key_name = {key_name}')
+        logger.debug('KeyEventMonitor.handleClick, key_name = %s', key_name)
         self.key_event_listener(key_name, True)
         self.key_event_listener(key_name, False)
     
@@ -33,12 +37,12 @@ class KeyEventMonitor(threading.Thread):
         keyboard.press(key_name)
 
     def run(self):
-        print('KeyEventMonitor thread start to run')
+        logger.info('KeyEventMonitor thread start to run')
         while True:
             # Wait for the next event.
             event = keyboard.read_event()
             if event.event_type == keyboard.KEY_DOWN and event.name == 'esc':
-                print('stop monitor key events')
+                logger.info('stop monitor key events')
                 break
 
             if self.b_capture_keyboard:
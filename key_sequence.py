@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+"""
+Scripted key injection for stress tests: plays (key, hold, gap) steps straight into
+HIDService.onKeyEvent from the shared timer scheduler, without a thread or timer per key.
+
+Script format, one step per line, times in milliseconds, '#' starts a comment:
+
+    KEY_HOME                # click with the default hold and gap
+    KEY_RIGHT 30 20         # hold 30 ms, then wait 20 ms before the next step
+    repeat 500
+        KEY_VOLUP 10 10
+        KEY_VOLDW 10 10
+    end
+    KEY_SEL 2000 500        # long press
+"""
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOLD_MS = 50
+DEFAULT_GAP_MS = 50
+
+KeyStep = collections.namedtuple('KeyStep', ['key_name', 'hold', 'gap'])
+
+
+def parse_key_script(text, key_table=None):
+    # Returns [KeyStep, ...] with times in seconds, repeat blocks unrolled. Key names are checked
+    # against key_table (the KEY_TABLE of the RCU descriptor) when given.
+    stack = [(0, [])]
+    for line_no, raw_line in enumerate(text.splitlines(), 1):
+        line = raw_line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        words = line.split()
+        try:
+            if words[0] == 'repeat':
+                stack.append((int(words[1]), []))
+            elif words[0] == 'end':
+                if len(stack) == 1:
+                    raise ValueError('end without repeat')
+                count, steps = stack.pop()
+                stack[-1][1].extend(steps * count)
+            else:
+                key_name = words[0]
+                if key_table is not None and key_name not in key_table:
+                    raise ValueError(f'unknown key {key_name}')
+                hold = float(words[1]) if len(words) > 1 else DEFAULT_HOLD_MS
+                gap = float(words[2]) if len(words) > 2 else DEFAULT_GAP_MS
+                if hold < 0 or gap < 0:
+                    raise ValueError('negative duration')
+                stack[-1][1].append(KeyStep(key_name, hold / 1000, gap / 1000))
+        except (IndexError, ValueError) as e:
+            raise ValueError(f'line {line_no}: {raw_line.strip()}: {e}')
+    if len(stack) != 1:
+        raise ValueError('repeat without end')
+    return stack[0][1]
+
+
+def load_key_script(path, key_table=None):
+    with open(path, 'r') as f:
+        return parse_key_script(f.read(), key_table)
+
+
+class KeySequencePlayer:
+    """
+    Plays key steps on absolute deadlines from the start of the sequence, so the callback
+    latency of one event does not shift the following ones. Only one timer is pending at a
+    time, whatever the length of the sequence. The scheduler rounds its GLib timeouts up to
+    the millisecond and never blocks the loop, an event is at most about 1 ms late.
+    """
+
+    def __init__(self, key_event_listener, scheduler=None):
+        self.key_event_listener = key_event_listener
+        if scheduler is None:
+            # GLib is only needed to play, a script can be parsed and checked without it
+            from timer_scheduler import get_default_scheduler
+            scheduler = get_default_scheduler()
+        self.scheduler = scheduler
+        self.events = []
+        self.next_event = 0
+        self.start_time = None
+        self.timer = None
+        self.held_key = None
+        self.on_done = None
+        self.late_sum = 0.0
+        self.late_max = 0.0
+
+    def is_playing(self):
+        return self.timer is not None
+
+    def play(self, steps, repeat=1, on_done=None):
+        # Must be called from the GLib main loop thread.
+        self.stop()
+        # (offset from the start, key name, pressed)
+        self.events = []
+        offset = 0.0
+        for _ in range(repeat):
+            for step in steps:
+                self.events.append((offset, step.key_name, True))
+                offset += step.hold
+                self.events.append((offset, step.key_name, False))
+                offset += step.gap
+        self.next_event = 0
+        self.late_sum = 0.0
+        self.late_max = 0.0
+        self.on_done = on_done
+        self.start_time = time.monotonic()
+        logger.info('KeySequencePlayer, play %s keys over %.3f s', len(self.events) // 2, offset)
+        self.schedule()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.held_key is not None:
+            # never leave a key stuck down on the TV side
+            self.key_event_listener(self.held_key, False)
+            self.held_key = None
+
+    def schedule(self):
+        if self.next_event >= len(self.events):
+            self.timer = None
+            self.finish()
+            return
+        deadline = self.start_time + self.events[self.next_event][0]
+        self.timer = self.scheduler.call_at(deadline, self.onTimeout)
+
+    def onTimeout(self):
+        # fire every event already due on the monotonic clock, then re-arm a single timer
+        now = time.monotonic()
+        while self.next_event < len(self.events):
+            offset, key_name, pressed = self.events[self.next_event]
+            deadline = self.start_time + offset
+            if deadline > now:
+                break
+            late = now - deadline
+            self.late_sum += late
+            self.late_max = max(self.late_max, late)
+            self.key_event_listener(key_name, pressed)
+            self.held_key = key_name if pressed else None
+            self.next_event += 1
+        self.schedule()
+
+    def get_stats(self):
+        fired = self.next_event
+        return {'events': fired,
+                'late_mean_ms': self.late_sum / fired * 1000 if fired else 0.0,
+                'late_max_ms': self.late_max * 1000}
+
+    def finish(self):
+        stats = self.get_stats()
+        logger.info('KeySequencePlayer, done, events = %s, late mean = %.3f ms, max = %.3f ms',
+                    stats['events'], stats['late_mean_ms'], stats['late_max_ms'])
+        if self.on_done is not None:
+            self.on_done()
@@ -1,92 +1,50 @@
 #!/usr/bin/python3
-import subprocess
-import os
 import bluetooth_constants
 import dbus.mainloop.glib
 from gi.repository import GLib
 import dbus
 import dbus.exceptions
 import dbus.service
-from sharp_rcu.advertise import SharpRCUAdvertisement
-from sharp_rcu.sharp_rcu_service import SharpRCUService
-from tivo_rcu.advertise import TiVoS4KRCUAdvertisement
-from tivo_rcu.tivo_rcu_service import TivoRCUService
 from agent import Agent
+from rcu_instance import RcuInstance, KeyEventRouter, route_device, add_control_commands
+from bringup import Bringup
+from control_socket import ControlSocket, DEFAULT_CONTROL_SOCKET_PATH
+from voice_pacer import PACING_MODES, PACING_REALTIME
 import argparse
-import bluetooth_utils
-from PyQt5 import QtCore, QtWidgets
-
-g_core_application = None
-g_ad_manager = None
-g_gatt_service_manager = None
-g_rcu_advertisement = None
-g_rcu_service = None
-# {obj path: {"Paired": True/False, "Connected": True/False, "ServiceResolved": True/False},
-g_tivo_tv_dict = {}
-#  obj path2: {"Paired": True/False, "Connected": True/False, "ServiceResolved": True/False}, ...}
-# ex: {"/org/bluez/hci0/dev_00_11_22_33_44_55": {"Paired": False, "Connected": False, "ServiceResolved": False},
-#      "/org/bluez/hci0/dev_00_11_22_33_44_56": {"Paired": True, "Connected": True, "ServiceResolved": True}}
-
-
-def register_ad_cb():
-    print(
-        f"{g_rcu_advertisement.get_advertisement_info()} start advertising.. (press esc to exit")
-
-
-def register_ad_error_cb(error):
-    if "AlreadyExists" in str(error):
-        print(
-            f"{g_rcu_advertisement.get_advertisement_info()} has already registered, keep advertising.. (press esc to exit")
-    else:
-        print(f"Failed to register RCUAdvertisement: {str(error)}, exit!")
-        closeAll()
+from device_state import DeviceStateCache
+from rcu_log import setup_logging, ENV_LOG_LEVEL
+import metrics
+import sampling_profiler
+import threading
+import logging
 
+logger = logging.getLogger(__name__)
 
-def register_app_cb():
-    print('4. Registered GATT application ok')
-
-
-def register_app_error_cb(error):
-    print('4. Failed to register GATT application: ' + str(error))
-    closeAll()
-
-
-def update_state(path):
-    global g_tivo_tv_dict
-    tv_status = g_tivo_tv_dict.get(path, None)
-    if tv_status is None:
-        tv_status = {bluetooth_constants.DEVICE_PROP_PAIRED: None,
-                     bluetooth_constants.DEVICE_PROP_CONNECTED: None,
-                     bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED: None}
-        g_tivo_tv_dict[path] = tv_status
+# QtWidgets.QApplication, or GLib.MainLoop in headless mode, both are stopped by quit()
+g_core_application = None
+# [RcuInstance, ...], one per simulated remote
+g_rcu_instances = []
+g_closing = False
+# DeviceStateCache, {obj path: {"Paired": True/False, "Connected": True/False, "ServicesResolved": True/False}, ...}
+# ex: {"/org/bluez/hci0/dev_00_11_22_33_44_55": {"Paired": False, "Connected": False, "ServicesResolved": False},
+#      "/org/bluez/hci0/dev_00_11_22_33_44_56": {"Paired": True, "Connected": True, "ServicesResolved": True}}
+g_device_states = None
 
-    paired = bluetooth_utils.get_device_property(
-        path, bluetooth_constants.DEVICE_PROP_PAIRED)
-    connected = bluetooth_utils.get_device_property(
-        path, bluetooth_constants.DEVICE_PROP_CONNECTED)
-    service_resolved = bluetooth_utils.get_device_property(
-        path, bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED)
 
-    tv_status[bluetooth_constants.DEVICE_PROP_PAIRED] = paired
-    tv_status[bluetooth_constants.DEVICE_PROP_CONNECTED] = connected
-    tv_status[bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED] = service_resolved
+# Called by g_device_states once the tracked properties of a device are known and when they change.
+def update_state(path, tv_status):
+    paired = tv_status[bluetooth_constants.DEVICE_PROP_PAIRED]
+    connected = tv_status[bluetooth_constants.DEVICE_PROP_CONNECTED]
+    service_resolved = tv_status[bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED]
 
     print(
         f"update_state ok, path = {path}, tv_status: \r\nPaired=>{tv_status[bluetooth_constants.DEVICE_PROP_PAIRED]}\r\nConnected=>{tv_status[bluetooth_constants.DEVICE_PROP_CONNECTED]}\r\nServiceResolved=>{tv_status[bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED]}")
 
-    global g_rcu_service
-    if paired and connected and service_resolved:
-        stop_advertising()
-        g_rcu_service.set_connected_device(path)
-        print(
-            f"{path} connected! {g_rcu_service.get_name()} is ready, press any key to send the events.. (press esc to exit")
-    else:
-        connected_device_path = g_rcu_service.get_connected_device()
-        if connected_device_path == path:
-            print(
-                f"{path} disconnected, {g_rcu_service.get_name()} is not ready, into advertising state")
-            start_advertising()
-            g_rcu_service.set_connected_device(None)
+    instance = route_device(g_rcu_instances, path, paired and connected and service_resolved)
+    if instance is None:
+        print(f"update_state, no remote is waiting for {path}, ignored")
+        return
+    instance.update_state(path, paired, connected, service_resolved, closeAll)
 
 
 """
@@ -118,19 +76,17 @@ member=PropertiesChanged
 
 def properties_changed(interface, changed, invalidated, path):
     if interface == bluetooth_constants.DEVICE_INTERFACE:
-        print(
-            f"[[Properties changed, path = {path}")
+        # every Device1 change of every device in range, the RSSI updates included
+        logger.debug('[[Properties changed, path = %s', path)
         if bluetooth_constants.DEVICE_PROP_PAIRED in changed:
-            print(
-                f"[[Properties changed, Paired:{changed[bluetooth_constants.DEVICE_PROP_PAIRED]}")
+            logger.debug('[[Properties changed, Paired:%s', changed[bluetooth_constants.DEVICE_PROP_PAIRED])
         if bluetooth_constants.DEVICE_PROP_CONNECTED in changed:
-            print(
-                f"[[Properties changed, Connected:{changed[bluetooth_constants.DEVICE_PROP_CONNECTED]}")
+            logger.debug('[[Properties changed, Connected:%s', changed[bluetooth_constants.DEVICE_PROP_CONNECTED])
         if bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED in changed:
-            print(
-                f"[[Properties changed, ServiceResolved:{changed[bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED]}")
+            logger.debug('[[Properties changed, ServiceResolved:%s',
+                         changed[bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED])
 
-        update_state(path)
+        g_device_states.update(path, changed)
 
 
 """
@@ -177,99 +133,62 @@ def interfaces_added(path, interfaces):
         if (bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED in properties):
             print(
                 f"Receive device interfaces added signal, ServiceResolved:{properties[bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED]}")
-        update_state(path)
-
-
-"""
-Returns the first object that the bluez service has that has a GattManager1 interface,
-which is suppose to be the bluetooth adapter 'org/bluez/hci0'.
-"""
-
+        g_device_states.update(path, properties)
 
-def find_adapter(bus):
-    remote_om = dbus.Interface(bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, '/'),
-                               bluetooth_constants.DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
 
-    for o, props in objects.items():
-        if bluetooth_constants.GATT_MANAGER_INTERFACE in props.keys():
-            return o
-
-    return None
-
-
-def start_advertising():
-    global g_ad_manager
-    global g_rcu_advertisement
-    # This causes BlueZ to instruct the controller to start advertising
-    g_ad_manager.RegisterAdvertisement(
-        g_rcu_advertisement.get_path(),
-        {},
-        reply_handler=register_ad_cb,
-        error_handler=register_ad_error_cb,
-    )
-
-
-def stop_advertising():
-    global g_ad_manager
-    global g_rcu_advertisement
-    try:
-        g_ad_manager.UnregisterAdvertisement(g_rcu_advertisement.get_path())
-    except:
-        dbus.exceptions.DBusException
-        pass
-    print(f"{g_rcu_advertisement.get_advertisement_info()} stop advertising")
+def interfaces_removed(path, interfaces):
+    if bluetooth_constants.DEVICE_INTERFACE in interfaces:
+        g_device_states.remove(path)
 
 
 def closeAll():
-    stop_advertising()
+    global g_closing
+    if g_closing:
+        return
+    g_closing = True
+    for instance in g_rcu_instances:
+        instance.stop_advertising()
     global g_core_application
     if g_core_application != None:
         g_core_application.quit()
 
-def checkSshConnection(ssh_user, target_ip):
-    try:
-        TRY_TIMES = 2
-        for i in range(TRY_TIMES):
-            result = subprocess.run(["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=5", f"{ssh_user}@{target_ip}", "echo 1"], 
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    text=True,
-                                    check=False)
-            output = result.stdout
-            error_output = result.stderr
-            if "Host key verification failed" in error_output:
-                print(f"SSH connection fail with key verification!")
-                answer = input("Do you want to accept the new RSA key fingerprint? (yes/no): ")
-                if answer.lower() == "yes":
-                    # 接受新的 RSA 密钥指纹
-                    known_hosts_path = os.path.expanduser("~/.ssh/known_hosts")
-                    os.system(f"ssh-keyscan -H {target_ip} >> {known_hosts_path}")
-                    print("RSA key fingerprint accepted.")
-                    continue
-                else:
-                    print("User chose not to accept the new RSA key fingerprint. Exiting script.")
-                    return False
-            elif result.returncode == 0:
-                print("SSH connection successful.")
-                return True
-            else:
-                print("SSH connection failed. Check the error output.")
-                print("Error Output:", error_output)
-                return False
-
-    except subprocess.CalledProcessError as error:
-        return False
-
 def main():
     parser = argparse.ArgumentParser(description='RCU tool parameters')
     parser.add_argument('-ip', dest='ip_address', nargs='?', type=str, default='10.82.83.8',
-                    help='Specify IPv4 address')
+                    help='Specify IPv4 address, a comma separated list gives one TV per remote')
     parser.add_argument('-io', dest='io_capability_type', nargs='?', type=int, default=0,
                         help='Specify the IO capability of the device, 0: NoInputNoOutput, 1: DisplayYesNo, 2: KeyboardDisplay, 3: DisplayOnly, 4:  KeyboardOnly')
     parser.add_argument('-rc', dest='rc_type', nargs='?', type=int, default=0,
                         help='Specify RCU type, 0: Sharp, 1: TiVo Remote')
+    parser.add_argument('-vp', dest='voice_pacing', nargs='?', type=str, default=PACING_REALTIME, choices=PACING_MODES,
+                        help='Specify how file sourced voice frames are released, realtime: at the codec rate, fast: as fast as possible')
+    parser.add_argument('-n', dest='instance_count', nargs='?', type=int, default=1,
+                        help='Specify the number of remotes to simulate')
+    parser.add_argument('-a', dest='adapters', nargs='?', type=str, default=None,
+                        help='Specify the adapters as a comma separated list, ex: hci0,hci1, default: all of them. Remotes are assigned to the adapters round robin')
+    parser.add_argument('--headless', dest='headless', action='store_true',
+                        help='Run without the Qt dialogs and keyboard hook, control the remotes through the control socket')
+    parser.add_argument('-cs', dest='control_socket', nargs='?', type=str, default=None,
+                        help=f'Specify the path of the control socket, default: {DEFAULT_CONTROL_SOCKET_PATH} in headless mode, none otherwise')
+    parser.add_argument('-log', dest='log_level', nargs='?', type=str, default=None,
+                        help=f'Specify the log levels, e.g. INFO,tivo_rcu.voice_source=DEBUG, default: ${ENV_LOG_LEVEL} or INFO')
+    parser.add_argument('-mh', dest='metrics_http', nargs='?', type=str, default=None,
+                        help='Serve the metrics in the Prometheus text format on [host:]port, host defaults to 127.0.0.1')
+    parser.add_argument('-ms', dest='metrics_socket', nargs='?', type=str, default=None,
+                        help='Serve the metrics in the Prometheus text format on this Unix socket')
+    parser.add_argument('-md', dest='metrics_dump', nargs='?', type=str, default=None,
+                        help='Write the metrics to this file on exit, default: print them')
+    parser.add_argument('-dle', dest='dle', action='store_true',
+                        help='Report LE Data Length Extension in the Sharp voice capabilities, enable it only when the adapter and the TV support it')
+    parser.add_argument('-pd', dest='profile_duration', nargs='?', type=float, default=sampling_profiler.DEFAULT_DURATION,
+                        help='Specify the seconds sampled by the profiler started with SIGUSR1 or the profile command')
     args = parser.parse_args()
+    # before setup_logging starts the first thread, every thread inherits the blocked SIGUSR1
+    profiler = sampling_profiler.SamplingProfiler()
+    sampling_profiler.install_signal_handler(profiler, duration=args.profile_duration)
+    setup_logging(args.log_level)
+    # the main thread runs the GLib (or Qt) loop, named so in the log and the profiles
+    threading.main_thread().name = 'MainLoop'
 
     io_capability_type = args.io_capability_type
     io_capability = "NoInputNoOutput"
@@ -283,41 +202,27 @@ def main():
         io_capability = "KeyboardOnly"
 
     rc_type = args.rc_type
-
-    # handle clearing cache
-    clear_aml_devices_script_path = "./clear_aml_devices.sh"
-    return_code = subprocess.call([clear_aml_devices_script_path], shell=True)
-    if return_code == 0:
-        print("clear_aml_devices ok")
-    else:
-        print("clear_aml_devices fail", return_code)
+    instance_count = args.instance_count
+    if instance_count < 1:
+        print(f"instance_count should be at least 1, got {instance_count}")
         return
-    # Handle device discovery
-    discover_devices_name = "Unknown Device Name"
-    if rc_type == 1:
-        discover_devices_name = TiVoS4KRCUAdvertisement.DISCOVERABLE_NAME
-    elif rc_type == 0:
-        discover_devices_name = SharpRCUAdvertisement.DISCOVERABLE_NAME
+    single = instance_count == 1
 
     ip_address = args.ip_address
     if ip_address == None or ip_address == "":
         print("ip_address is None or empty")
         return
+    ip_addresses = [ip.strip() for ip in ip_address.split(',') if ip.strip()]
+    wanted_adapters = None
+    if args.adapters:
+        wanted_adapters = [bluetooth_constants.BLUEZ_NAMESPACE + name.strip() for name in args.adapters.split(',')]
 
-    if not checkSshConnection("root", ip_address):
-        print(f"checkSshConnection fail, ip_address = {ip_address}")
-        return
-
-    discover_devices_script_path = f"./aml_device_auto_connect.sh \"{discover_devices_name}\" \"{ip_address}\""
-    print(f"discover_devices_script_path = {discover_devices_script_path}")
-    p = subprocess.Popen(
-        [discover_devices_script_path], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    print("aml_device_auto_connect ok")
-    
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     bus = dbus.SystemBus()
 
     # handle connections status
+    global g_device_states
+    g_device_states = DeviceStateCache(bus, update_state)
     bus.add_signal_receiver(properties_changed,
                             dbus_interface=bluetooth_constants.DBUS_PROPERTIES,
                             signal_name="PropertiesChanged",
@@ -327,78 +232,71 @@ def main():
                             dbus_interface=bluetooth_constants.DBUS_OM_IFACE,
                             signal_name="InterfacesAdded")
 
-    # require bluetooth adapter
-    adapter_obj = find_adapter(bus)
-    if not adapter_obj:
-        print('adapter_obj not found')
-        return
+    bus.add_signal_receiver(interfaces_removed,
+                            dbus_interface=bluetooth_constants.DBUS_OM_IFACE,
+                            signal_name="InterfacesRemoved")
 
     global g_core_application
-    g_core_application = QtWidgets.QApplication([])
-
-    print("1. Power on the bluetooth adapter..")
-    adapter_props = dbus.Interface(bus.get_object(
-        bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_obj), bluetooth_constants.DBUS_PROPERTIES)
-    adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
-                      bluetooth_constants.ADAPTER_PROP_POWER, dbus.Boolean(1))
-    adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
-                      bluetooth_constants.ADAPTER_PROP_DISCOVERABLE, dbus.Boolean(1))
-    adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
-                      bluetooth_constants.ADAPTER_PROP_PAIRABLE, dbus.Boolean(1))
-    mac_address = adapter_props.Get(
-        bluetooth_constants.ADAPTER_INTERFACE, bluetooth_constants.ADAPTER_PROP_MAC_ADDRESS)
-    
-    global g_rcu_advertisement
-    global g_rcu_service
-    
-    
-    if rc_type == 1:
-        g_rcu_advertisement = TiVoS4KRCUAdvertisement(bus, mac_address, 0)
-        g_rcu_service = TivoRCUService(bus, closeAll) # Fix me, factory to get TivoRCUService
-        adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
-                      bluetooth_constants.ADAPTER_PROP_ALIAS, dbus.String(
-                          TiVoS4KRCUAdvertisement.DISCOVERABLE_NAME))
-    elif rc_type == 0:
-        g_rcu_advertisement = SharpRCUAdvertisement(bus, mac_address, 0)
-        g_rcu_service = SharpRCUService(bus, closeAll) # Fix me, factory to get SharpRCUService
-        adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
-                      bluetooth_constants.ADAPTER_PROP_ALIAS, dbus.String(
-                          SharpRCUAdvertisement.DISCOVERABLE_NAME))
+    if args.headless:
+        g_core_application = GLib.MainLoop()
+    else:
+        # PyQt5 is only loaded when the dialogs are wanted
+        from PyQt5 import QtWidgets
+        g_core_application = QtWidgets.QApplication([])
+
+    key_events = KeyEventRouter()
+
+    def create_instance(index, adapter_obj, mac_address):
+        instance = RcuInstance(bus, index, adapter_obj, mac_address, rc_type,
+                               args.voice_pacing, key_events, closeAll, single, args.headless, args.dle)
+        g_rcu_instances.append(instance)
+        return instance
+
+    def on_ready():
+        if not args.headless:
+            key_events.start()
 
-    print(f"2. Agent procedure, register with io: {io_capability}")
     AGENT_PATH = bluetooth_constants.BLUEZ_OBJ_ROOT + "agent"
     agent = Agent(bus, AGENT_PATH)
-    agent_manager = dbus.Interface(bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, '/org/bluez'),
-                                   bluetooth_constants.AGENT_MANAGER_INTERFACE)
-    agent_manager.RegisterAgent(AGENT_PATH, io_capability)
-    agent_manager.RequestDefaultAgent(AGENT_PATH)
-
-    print("3. Advertise procedure")
-    global g_ad_manager
-    g_ad_manager = dbus.Interface(bus.get_object(
-        bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_obj), bluetooth_constants.ADVERTISING_MANAGER_INTERFACE)
-    start_advertising()
-
-    print('4. Registering GATT procedure')
-    global g_gatt_service_manager
-    g_gatt_service_manager = dbus.Interface(
-        bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_obj),
-        bluetooth_constants.GATT_MANAGER_INTERFACE)
-
-    g_gatt_service_manager.RegisterApplication(g_rcu_service.get_path(), {},
-                                               reply_handler=register_app_cb,
-                                               error_handler=register_app_error_cb)
-
-    g_core_application.exec_()
-    if g_gatt_service_manager != None:
-        g_gatt_service_manager.UnregisterApplication(
-            g_rcu_service.get_path())
-        print('4-1. g_gatt_service_manager.UnregisterApplication(g_rcu_service.get_path()) ok')
+
+    # clearing the cache, the ssh probes, the adapter setup, the agent, advertising and the
+    # GATT registration run from the loop, see bringup.py
+    bringup = Bringup(bus, rc_type, instance_count, ip_addresses, wanted_adapters, AGENT_PATH, io_capability,
+                      create_instance, on_ready, closeAll)
+    GLib.idle_add(bringup.start)
+
+    control_socket = None
+    control_socket_path = args.control_socket
+    if control_socket_path is None and args.headless:
+        control_socket_path = DEFAULT_CONTROL_SOCKET_PATH
+    if control_socket_path:
+        control_socket = ControlSocket(control_socket_path)
+        add_control_commands(control_socket, g_rcu_instances, closeAll)
+        sampling_profiler.add_control_commands(control_socket, profiler, args.profile_duration)
+        control_socket.start()
+
+    metrics_server = metrics.MetricsServer()
+    if args.metrics_http:
+        host, _, port = args.metrics_http.rpartition(':')
+        metrics_server.start_http(host or '127.0.0.1', int(port))
+    if args.metrics_socket:
+        metrics_server.start_unix(args.metrics_socket)
+
+    if args.headless:
+        g_core_application.run()
+    else:
+        g_core_application.exec_()
+    if control_socket is not None:
+        control_socket.stop()
+    metrics_server.stop()
+    for instance in g_rcu_instances:
+        instance.unregister_application()
     print('4-2. Apapter power off')
-    adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
-                      bluetooth_constants.ADAPTER_PROP_POWER, dbus.Boolean(0))
+    for adapter_props in bringup.adapter_props.values():
+        adapter_props.Set(bluetooth_constants.ADAPTER_INTERFACE,
+                          bluetooth_constants.ADAPTER_PROP_POWER, dbus.Boolean(0))
+    metrics.dump(args.metrics_dump)
     print('5. Process end')
 
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+"""
+Process wide counters, gauges and latency histograms for the long running simulators,
+rendered in the Prometheus text format.
+
+Metrics are declared once at module level and the hot paths keep a child per label set, so
+recording a sample is one lock and an addition:
+
+    NOTIFICATIONS = REGISTRY.counter('rcu_notifications_total', 'GATT notifications sent', ['characteristic'])
+    self.notify_counter = NOTIFICATIONS.labels('ReportCharacteristic')
+    self.notify_counter.inc()
+
+The text is served over HTTP (GET /metrics) and a Unix socket (connect and read) by
+MetricsServer, from its own threads, and can be written out with dump().
+"""
+import bisect
+import http.server
+import math
+import os
+import socketserver
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from the 20 us of a frame encode to the seconds of a D-Bus timeout
+DEFAULT_BUCKETS = (0.00002, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + '}'
+
+
+class CounterChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name):
+        yield name, (), self.value
+
+
+class GaugeChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        # the gauge reads function() when rendered, for values owned by someone else
+        self.function = function
+
+    def samples(self, name):
+        yield name, (), self.function() if self.function is not None else self.value
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if index < len(self.counts):
+                self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield name + '_bucket', (('le', _format_value(bound)),), cumulative
+        yield name + '_bucket', (('le', '+Inf'),), count
+        yield name + '_sum', (), total
+        yield name + '_count', (), count
+
+
+class _Timer:
+    # with histogram.time(): ... observes the elapsed seconds
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    def __init__(self, metric_type, name, documentation, label_names, child_factory):
+        self.type = metric_type
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.child_factory = child_factory
+        self.lock = threading.Lock()
+        self.children = {}
+        if not self.label_names:
+            self.default_child = self.labels()
+
+    def labels(self, *values):
+        if len(values) != len(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, got {values}')
+        key = tuple(str(v) for v in values)
+        with self.lock:
+            child = self.children.get(key, None)
+            if child is None:
+                child = self.child_factory()
+                self.children[key] = child
+        return child
+
+    # shortcuts of the child of a metric without labels
+    def __getattr__(self, attr):
+        if attr in ('inc', 'dec', 'set', 'set_function', 'observe', 'time') and 'default_child' in self.__dict__:
+            return getattr(self.__dict__['default_child'], attr)
+        raise AttributeError(attr)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            children = sorted(self.children.items())
+        for label_values, child in children:
+            for sample_name, extra_labels, value in child.samples(self.name):
+                lines.append(f'{sample_name}{_format_labels(self.label_names, label_values, extra_labels)} '
+                             f'{_format_value(value)}')
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _register(self, metric_type, name, documentation, label_names, child_factory):
+        # declaring the same metric twice returns the first one, modules may be imported twice
+        # (as __main__ and by name)
+        with self.lock:
+            metric = self.metrics.get(name, None)
+            if metric is None:
+                metric = Metric(metric_type, name, documentation, label_names, child_factory)
+                self.metrics[name] = metric
+            elif metric.type != metric_type or metric.label_names != tuple(label_names):
+                raise ValueError(f'metric {name} is already declared differently')
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register('counter', name, documentation, label_names, CounterChild)
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register('gauge', name, documentation, label_names, GaugeChild)
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        return self._register('histogram', name, documentation, label_names, lambda: HistogramChild(buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+PROCESS_START_TIME = REGISTRY.gauge('rcu_process_start_time_seconds', 'Start time of the simulator since the epoch')
+PROCESS_START_TIME.set(time.time())
+# shared by every module calling BlueZ, synchronous calls block the GLib loop for this long
+DBUS_CALL_SECONDS = REGISTRY.histogram('rcu_dbus_call_seconds', 'D-Bus method call round trip', ['method'])
+
+
+class _MetricsHttpHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _MetricsUnixHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.sendall(self.server.registry.render().encode('utf-8'))
+
+
+class _ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """
+    Serves a registry over HTTP and/or a Unix socket, each from a daemon thread so a scrape
+    never runs on the GLib loop.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self.servers = []
+        self.unix_path = None
+
+    def start_http(self, host, port):
+        server = http.server.ThreadingHTTPServer((host, port), _MetricsHttpHandler)
+        self._serve(server)
+        print(f'MetricsServer, serving http://{host}:{server.server_address[1]}/metrics')
+
+    def start_unix(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = _ThreadingUnixStreamServer(path, _MetricsUnixHandler)
+        self.unix_path = path
+        self._serve(server)
+        print(f'MetricsServer, serving unix socket {path}')
+
+    def _serve(self, server):
+        server.registry = self.registry
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        self.servers.append(server)
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
+        self.unix_path = None
+
+
+def dump(path=None, registry=REGISTRY):
+    # Writes the current values to path, or prints them when path is None
+    text = registry.render()
+    if path is None:
+        print(text, end='')
+        return
+    with open(path, 'w') as f:
+        f.write(text)
@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+"""
+Multi-remote runtime of main.py: every RcuInstance is one simulated remote with its own object
+path namespace, advertisement, GATT application and connection state. Instances share the
+process, the D-Bus connection, the Qt application and a single keyboard monitor.
+"""
+import os
+import time
+import dbus
+import dbus.exceptions
+from gi.repository import GLib
+import bluetooth_constants
+from bluetooth_utils import get_object_interface
+from sharp_rcu.advertise import SharpRCUAdvertisement
+from sharp_rcu.sharp_rcu_service import SharpRCUService
+from tivo_rcu.advertise import TiVoS4KRCUAdvertisement
+from tivo_rcu.tivo_rcu_service import TivoRCUService
+import sharp_rcu.key_table_constants as ktc
+from key_sequence import KeySequencePlayer, load_key_script
+from metrics import REGISTRY, DBUS_CALL_SECONDS
+from voice_codecs import parse_codec_names
+
+ADVERTISEMENT_REGISTER_SECONDS = REGISTRY.histogram('rcu_advertisement_register_seconds',
+                                                    'RegisterAdvertisement call to reply', ['rcu'])
+UPDATE_STATE_SECONDS = REGISTRY.histogram('rcu_update_state_seconds',
+                                          'Handling of a device state change, D-Bus calls included', ['rcu'])
+UNREGISTER_ADVERTISEMENT_SECONDS = DBUS_CALL_SECONDS.labels('UnregisterAdvertisement')
+
+RC_TYPE_SHARP = 0
+RC_TYPE_TIVO = 1
+
+
+def find_adapters(bus):
+    # Returns the paths of the adapters with a GattManager1 interface, sorted by name (hci0, hci1, ..)
+    remote_om = dbus.Interface(bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, '/'),
+                               bluetooth_constants.DBUS_OM_IFACE)
+    return select_adapters(remote_om.GetManagedObjects())
+
+
+def find_adapters_async(bus, reply_handler, error_handler):
+    # find_adapters() without blocking the GLib loop, reply_handler(adapter paths)
+    remote_om = dbus.Interface(bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, '/', introspect=False),
+                               bluetooth_constants.DBUS_OM_IFACE)
+    remote_om.GetManagedObjects(reply_handler=lambda objects: reply_handler(select_adapters(objects)),
+                                error_handler=error_handler)
+
+
+def select_adapters(objects):
+    adapters = [o for o, props in objects.items() if bluetooth_constants.GATT_MANAGER_INTERFACE in props.keys()]
+    return sorted(adapters, key=lambda path: (len(path), path))
+
+
+def get_discoverable_name(rc_type, index=0, single=True):
+    # Several remotes advertise as "<name> <index>" so every TV can be told which one to pair with.
+    if rc_type == RC_TYPE_TIVO:
+        name = TiVoS4KRCUAdvertisement.DISCOVERABLE_NAME
+    else:
+        name = SharpRCUAdvertisement.DISCOVERABLE_NAME
+    return name if single else f"{name} {index}"
+
+
+class KeyEventTarget:
+    """
+    What a RCU service sees of the shared keyboard monitor, same calls as KeyEventMonitor.
+    """
+
+    def __init__(self, router, key_event_listener, key_exit_listener):
+        self.router = router
+        self.key_event_listener = key_event_listener
+        self.key_exit_listener = key_exit_listener
+
+    def setCaptureKeyboard(self, bCaptureKeyboard):
+        self.router.setCapture(self, bCaptureKeyboard)
+
+    def fireKey(self, key_name):
+        self.router.fireKey(key_name)
+
+
+class KeyEventRouter:
+    """
+    One keyboard hook for every remote of the process. Key events go to the remote whose dialog
+    captured the keyboard last, esc closes every remote.
+    """
+
+    def __init__(self):
+        self.targets = []
+        self.active_target = None
+        # created by start(), a headless process without keyboard hook never imports keyboard
+        self.monitor = None
+
+    def attach(self, key_event_listener, key_exit_listener):
+        target = KeyEventTarget(self, key_event_listener, key_exit_listener)
+        self.targets.append(target)
+        return target
+
+    def start(self):
+        from key_event_monitor import KeyEventMonitor
+        self.monitor = KeyEventMonitor(self.onKeyEvent, self.onExit)
+        self.monitor.start()
+
+    def fireKey(self, key_name):
+        if self.monitor is not None:
+            self.monitor.fireKey(key_name)
+
+    def setCapture(self, target, b_capture):
+        if b_capture:
+            self.active_target = target
+        elif self.active_target is target:
+            self.active_target = None
+        if self.monitor is not None:
+            self.monitor.setCaptureKeyboard(self.active_target is not None)
+
+    def onKeyEvent(self, key_name, pressed):
+        target = self.active_target
+        if target is not None:
+            target.key_event_listener(key_name, pressed)
+
+    def onExit(self):
+        for target in self.targets:
+            if target.key_exit_listener is not None:
+                target.key_exit_listener()
+
+
+class RcuInstance:
+    """
+    One simulated remote on one adapter. With a single instance the object paths are the
+    historical ones, otherwise everything lives under BLUEZ_OBJ_ROOT + "rcu<index>/".
+    """
+
+    def __init__(self, bus, index, adapter_path, mac_address, rc_type, voice_pacing, key_events, exit_listener,
+                 single=True, headless=False, dle=False):
+        self.bus = bus
+        self.index = index
+        self.adapter_path = adapter_path
+        self.rc_type = rc_type
+        self.obj_root = bluetooth_constants.BLUEZ_OBJ_ROOT if single \
+            else bluetooth_constants.BLUEZ_OBJ_ROOT + f"rcu{index}/"
+        self.local_name = get_discoverable_name(rc_type, index, single)
+
+        if rc_type == RC_TYPE_TIVO:
+            self.advertisement = TiVoS4KRCUAdvertisement(bus, mac_address, index, self.local_name)
+            self.service = TivoRCUService(bus, exit_listener, voice_pacing, self.obj_root, key_events, headless)
+        else:
+            self.advertisement = SharpRCUAdvertisement(bus, mac_address, index, self.local_name)
+            self.service = SharpRCUService(bus, exit_listener, voice_pacing, self.obj_root, key_events, headless, dle)
+
+        self.ad_manager = get_object_interface(adapter_path, bluetooth_constants.ADVERTISING_MANAGER_INTERFACE, bus)
+        self.gatt_service_manager = get_object_interface(adapter_path, bluetooth_constants.GATT_MANAGER_INTERFACE, bus)
+        self.app_registered = False
+        # scripted keys go straight to the HID service, bypassing the dialog and the key detector
+        self.key_player = KeySequencePlayer(self.service.hid_service.onKeyEvent)
+        self.advertisement_register_seconds = ADVERTISEMENT_REGISTER_SECONDS.labels(index)
+        self.update_state_seconds = UPDATE_STATE_SECONDS.labels(index)
+
+    def get_name(self):
+        return f"{self.service.get_name()}#{self.index} on {self.adapter_path}"
+
+    def owns_device(self, device_path):
+        return device_path.startswith(self.adapter_path + '/')
+
+    def get_connected_device(self):
+        return self.service.get_connected_device()
+
+    # Programmatic control, the same as using the dialog. Keys are only sent while connected.
+    def press_key(self, key_name):
+        self.service.onKeyEvent(key_name, True)
+
+    def release_key(self, key_name):
+        self.service.onKeyEvent(key_name, False)
+
+    def click_key(self, key_name):
+        self.service.onKeyEvent(key_name, True)
+        self.service.onKeyEvent(key_name, False)
+
+    def play_key_script(self, script_path, repeat=1):
+        # the key tables of both remote types use the same descriptor keys
+        key_table = self.service.hid_service.key_descriptor_obj[ktc.KEY_TABLE]
+        steps = load_key_script(script_path, key_table)
+        self.key_player.play(steps, repeat)
+        return len(steps) * repeat
+
+    def stop_key_script(self):
+        self.key_player.stop()
+
+    def set_capture_by_file(self, capture_by_file):
+        self.service.get_rcu_dlg().setCaptureByFile(capture_by_file)
+
+    def set_voice_file(self, sample_rate_khz, file_path):
+        dlg = self.service.get_rcu_dlg()
+        setter = getattr(dlg, f'set_{sample_rate_khz}k_file_path', None)
+        if setter is None:
+            raise ValueError(f'{self.get_name()} can not set a {sample_rate_khz}k voice file')
+        setter(file_path)
+
+    def set_codec_preference(self, codec_names):
+        voice_service = self.service.voice_service
+        if not hasattr(voice_service, 'setCodecPreference'):
+            raise ValueError(f'{self.get_name()} has no codec negotiation')
+        voice_service.setCodecPreference(parse_codec_names(codec_names))
+
+    def register_ad_cb(self, start_time, on_started):
+        self.advertisement_register_seconds.observe(time.perf_counter() - start_time)
+        print(
+            f"{self.advertisement.get_advertisement_info()} start advertising.. (press esc to exit")
+        if on_started is not None:
+            on_started()
+
+    def register_ad_error_cb(self, error, on_fatal_error, on_started):
+        if "AlreadyExists" in str(error):
+            print(
+                f"{self.advertisement.get_advertisement_info()} has already registered, keep advertising.. (press esc to exit")
+            if on_started is not None:
+                on_started()
+        else:
+            print(f"Failed to register RCUAdvertisement of {self.get_name()}: {str(error)}, exit!")
+            on_fatal_error()
+
+    def start_advertising(self, on_fatal_error, on_started=None):
+        # This causes BlueZ to instruct the controller to start advertising, on_started() is
+        # called once it does
+        start_time = time.perf_counter()
+        self.ad_manager.RegisterAdvertisement(
+            self.advertisement.get_path(),
+            {},
+            reply_handler=lambda: self.register_ad_cb(start_time, on_started),
+            error_handler=lambda error: self.register_ad_error_cb(error, on_fatal_error, on_started),
+        )
+
+    def stop_advertising(self):
+        try:
+            with UNREGISTER_ADVERTISEMENT_SECONDS.time():
+                self.ad_manager.UnregisterAdvertisement(self.advertisement.get_path())
+        except dbus.exceptions.DBusException:
+            pass
+        print(f"{self.advertisement.get_advertisement_info()} stop advertising")
+
+    def prepare_application(self):
+        # Builds the GetManagedObjects reply ahead of RegisterApplication, BlueZ reads it before
+        # replying to the registration
+        self.service.GetManagedObjects()
+
+    def register_application(self, on_fatal_error, on_registered=None):
+        def register_app_cb():
+            self.app_registered = True
+            print(f'4. Registered GATT application of {self.get_name()} ok')
+            if on_registered is not None:
+                on_registered()
+
+        def register_app_error_cb(error):
+            print(f'4. Failed to register GATT application of {self.get_name()}: ' + str(error))
+            on_fatal_error()
+
+        self.gatt_service_manager.RegisterApplication(self.service.get_path(), {},
+                                                      reply_handler=register_app_cb,
+                                                      error_handler=register_app_error_cb)
+
+    def unregister_application(self):
+        if not self.app_registered:
+            return
+        try:
+            self.gatt_service_manager.UnregisterApplication(self.service.get_path())
+            print(f'4-1. UnregisterApplication({self.service.get_path()}) of {self.get_name()} ok')
+        except dbus.exceptions.DBusException as e:
+            print(f'4-1. UnregisterApplication of {self.get_name()} failed: {e}')
+        self.app_registered = False
+
+    def update_state(self, path, paired, connected, service_resolved, on_fatal_error):
+        with self.update_state_seconds.time():
+            self._update_state(path, paired, connected, service_resolved, on_fatal_error)
+
+    def _update_state(self, path, paired, connected, service_resolved, on_fatal_error):
+        if paired and connected and service_resolved:
+            self.stop_advertising()
+            self.service.set_connected_device(path)
+            print(
+                f"{path} connected! {self.get_name()} is ready, press any key to send the events.. (press esc to exit")
+        elif self.service.get_connected_device() == path:
+            print(
+                f"{path} disconnected, {self.get_name()} is not ready, into advertising state")
+            self.start_advertising(on_fatal_error)
+            self.service.set_connected_device(None)
+
+
+def route_device(instances, path, ready):
+    # Returns the instance a device state belongs to: the one it is connected to, or for a device
+    # that just became ready the first idle instance on its adapter. Instances sharing an adapter
+    # can not tell which advertisement a central answered, the first idle one claims it.
+    for instance in instances:
+        if instance.get_connected_device() == path:
+            return instance
+    if ready:
+        for instance in instances:
+            if instance.owns_device(path) and instance.get_connected_device() is None:
+                return instance
+    return None
+
+
+def add_control_commands(control_socket, instances, on_quit):
+    # Registers the remote commands on a control_socket.ControlSocket, the optional trailing
+    # index picks the remote, 0 by default.
+    def get_instance(args, argc):
+        index = int(args[argc]) if len(args) > argc else 0
+        if index < 0 or index >= len(instances):
+            raise ValueError(f'no remote #{index}')
+        return instances[index]
+
+    def on_list(args):
+        return ', '.join(f'{instance.index}:{instance.get_name()} connected={instance.get_connected_device()}'
+                         for instance in instances)
+
+    def on_key(args):
+        if len(args) < 2 or args[1] not in ('press', 'release', 'click'):
+            raise ValueError('usage: key <KEY_NAME> press|release|click [index]')
+        instance = get_instance(args, 2)
+        if instance.get_connected_device() is None:
+            raise ValueError(f'{instance.get_name()} is not connected')
+        getattr(instance, f'{args[1]}_key')(args[0])
+
+    def on_source(args):
+        if len(args) < 1 or args[0] not in ('file', 'mic'):
+            raise ValueError('usage: source file|mic [index]')
+        get_instance(args, 1).set_capture_by_file(args[0] == 'file')
+
+    def on_wav(args):
+        if len(args) < 2 or args[0] not in ('8k', '16k'):
+            raise ValueError('usage: wav 8k|16k <path> [index]')
+        if not os.path.exists(args[1]):
+            raise ValueError(f'{args[1]} does not exist')
+        get_instance(args, 2).set_voice_file(int(args[0][:-1]), args[1])
+
+    def on_codec(args):
+        if len(args) < 1:
+            raise ValueError('usage: codec <name,...> [index]')
+        get_instance(args, 1).set_codec_preference(args[0])
+
+    def on_play(args):
+        if len(args) < 1:
+            raise ValueError('usage: play <script> [repeat] [index]')
+        repeat = int(args[1]) if len(args) > 1 else 1
+        instance = get_instance(args, 2)
+        if instance.get_connected_device() is None:
+            raise ValueError(f'{instance.get_name()} is not connected')
+        return f'{instance.play_key_script(args[0], repeat)} keys'
+
+    def on_stop(args):
+        get_instance(args, 0).stop_key_script()
+
+    def on_quit_command(args):
+        GLib.idle_add(on_quit)
+
+    control_socket.add_command('list', on_list, 'list')
+    control_socket.add_command('key', on_key, 'key <KEY_NAME> press|release|click [index]')
+    control_socket.add_command('source', on_source, 'source file|mic [index]')
+    control_socket.add_command('wav', on_wav, 'wav 8k|16k <path> [index]')
+    control_socket.add_command('codec', on_codec, 'codec opus|adpcm16k|adpcm8k[,...] [index]')
+    control_socket.add_command('play', on_play, 'play <script> [repeat] [index]')
+    control_socket.add_command('stop', on_stop, 'stop [index]')
+    control_socket.add_command('quit', on_quit_command, 'quit')
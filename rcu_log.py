@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""
+Logging for the simulator. The key and voice paths log through module loggers with lazy
+'%' arguments, so a disabled level costs one isEnabledFor() check. Records are handed to a
+bounded queue and formatted and written by a listener thread, the GLib and voice threads
+never wait on the console; when the queue is full records are dropped and counted.
+
+Levels are set per logger name with RCU_LOG_LEVEL (or main.py -log), a bare level applies
+to every logger:
+
+    RCU_LOG_LEVEL=INFO,tivo_rcu.voice_source=DEBUG,tivo_rcu.ble_hogp=WARNING
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+ENV_LOG_LEVEL = 'RCU_LOG_LEVEL'
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_LOG_FORMAT = '%(asctime)s.%(msecs)03d %(levelname).1s %(threadName)s %(name)s: %(message)s'
+DEFAULT_DATE_FORMAT = '%H:%M:%S'
+# records waiting for the listener thread, about 2 s of voice frames at debug level
+DEFAULT_QUEUE_SIZE = 4096
+
+_listener = None
+_queue_handler = None
+
+
+class HexBytes:
+    """
+    Log argument rendering bytes as hex only when the record is formatted, on the listener
+    thread. Anything but bytes is copied, callers may reuse their buffer.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value if isinstance(value, bytes) else bytes(value)
+
+    def __str__(self):
+        return self.value.hex()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that neither blocks nor formats on the logging thread. The stock handler
+    merges msg and args in prepare(), here the record is queued as it is and the listener's
+    handlers format it.
+    """
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_level_spec(spec):
+    # 'INFO,a.b=DEBUG' -> ('INFO', {'a.b': 'DEBUG'}), None when there is no bare level
+    root_level = None
+    levels = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+        else:
+            root_level = item.upper()
+    for level in [root_level] + list(levels.values()):
+        if level is not None and not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f'unknown log level {level}')
+    return root_level, levels
+
+
+def setup_logging(spec=None, stream=None, queue_size=DEFAULT_QUEUE_SIZE, log_format=DEFAULT_LOG_FORMAT):
+    # spec overrides RCU_LOG_LEVEL, calling it again only changes the levels
+    global _listener, _queue_handler
+    if spec is None:
+        spec = os.environ.get(ENV_LOG_LEVEL, DEFAULT_LOG_LEVEL)
+    root_level, levels = parse_level_spec(spec)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(root_level or DEFAULT_LOG_LEVEL)
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    if _listener is None:
+        stream_handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(log_format, DEFAULT_DATE_FORMAT))
+        log_queue = queue.Queue(queue_size)
+        _queue_handler = DroppingQueueHandler(log_queue)
+        root_logger.addHandler(_queue_handler)
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    # flushes the queued records, safe to call more than once
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    if _queue_handler.dropped:
+        print(f'rcu_log, {_queue_handler.dropped} log records dropped, queue full')
+    _listener = None
+    _queue_handler = None
+
+
+def get_dropped_count():
+    return _queue_handler.dropped if _queue_handler is not None else 0
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+import threading
+
+# What ByteRingBuffer.write does when the buffer is full:
+# OVERFLOW_DROP_OLDEST overwrites the oldest unread bytes (real-time sources such as a microphone),
+# OVERFLOW_BLOCK waits until the consumer has made room (sources that must not lose data, such as a file).
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_BLOCK = 'block'
+
+
+class ByteRingBuffer:
+    """
+    Preallocated single-producer/single-consumer byte ring buffer.
+
+    Data is copied in and out of fixed storage, so streaming through it allocates nothing but
+    what the reader asks for. The lock only guards the cursors and the copy, it is never held
+    while waiting on the audio device; readers and blocked writers sleep on conditions instead
+    of polling.
+    """
+
+    def __init__(self, capacity, overflow=OVERFLOW_DROP_OLDEST):
+        if capacity <= 0:
+            raise ValueError(f'capacity must be positive, got {capacity}')
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK):
+            raise ValueError(f'unknown overflow behavior: {overflow}')
+        self.capacity = capacity
+        self.overflow = overflow
+        self.storage = bytearray(capacity)
+        # monotonic byte counters, the storage offset is counter % capacity
+        self.read_count = 0
+        self.write_count = 0
+        self.dropped_bytes = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def __len__(self):
+        return self.write_count - self.read_count
+
+    def is_closed(self):
+        return self.closed
+
+    def _copy_in(self, data):
+        offset = self.write_count % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self.storage[offset:offset + first] = data[:first]
+        if first < len(data):
+            self.storage[:len(data) - first] = data[first:]
+        self.write_count += len(data)
+
+    def _copy_out(self, out, size):
+        offset = self.read_count % self.capacity
+        first = min(size, self.capacity - offset)
+        out[:first] = self.storage[offset:offset + first]
+        if first < size:
+            out[first:size] = self.storage[:size - first]
+        self.read_count += size
+
+    def write(self, data, timeout=None):
+        # Returns the number of bytes accepted, less than len(data) only if the buffer was closed
+        # or the timeout expired while blocking.
+        data = memoryview(data).cast('B')
+        if self.overflow == OVERFLOW_DROP_OLDEST and len(data) > self.capacity:
+            self.dropped_bytes += len(data) - self.capacity
+            data = data[len(data) - self.capacity:]
+
+        written = 0
+        with self.lock:
+            while written < len(data):
+                if self.closed:
+                    break
+                free = self.capacity - (self.write_count - self.read_count)
+                if free == 0:
+                    if self.overflow == OVERFLOW_BLOCK:
+                        if not self.not_full.wait(timeout):
+                            break
+                        continue
+                    # drop the oldest bytes to make room for the whole remaining chunk
+                    drop = min(len(data) - written, self.capacity)
+                    self.read_count += drop
+                    self.dropped_bytes += drop
+                    free = drop
+                chunk = data[written:written + free]
+                self._copy_in(chunk)
+                written += len(chunk)
+                self.not_empty.notify()
+        return written
+
+    def readinto(self, out, timeout=None):
+        # Block until len(out) bytes are available, the buffer is closed or the timeout expires,
+        # copy them into out and return the number of bytes copied (0 means closed and drained).
+        out = memoryview(out).cast('B')
+        size = len(out)
+        with self.lock:
+            while self.write_count - self.read_count < size and not self.closed:
+                if not self.not_empty.wait(timeout):
+                    break
+            size = min(size, self.write_count - self.read_count)
+            if size > 0:
+                self._copy_out(out, size)
+                self.not_full.notify()
+        return size
+
+    def read(self, size, timeout=None):
+        out = bytearray(size)
+        read_size = self.readinto(out, timeout)
+        if read_size < size:
+            del out[read_size:]
+        return bytes(out)
+
+    def close(self, discard=False):
+        # Wake up both sides, pending data is still readable unless discard is set.
+        with self.lock:
+            self.closed = True
+            if discard:
+                self.read_count = self.write_count
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+"""
+Sampling profiler that can be attached to a running simulator: a thread snapshots the stack
+of every other thread with sys._current_frames() at a fixed interval for a given time and
+writes the samples in the collapsed stack format of flamegraph.pl / speedscope:
+
+    KeyEventMonitor;key_event_monitor.py:run;keyboard/__init__.py:read_event 42
+
+The first frame of each stack is the thread name. A capture is started by SIGUSR1 (a second
+SIGUSR1 stops it early) or by the 'profile' command of the control socket. Neither goes
+through the GLib loop, a capture can be started while the loop is the one stalling.
+
+    $ kill -USR1 <pid>
+    $ echo "profile 10 /tmp/stall.collapsed" | socat - UNIX-CONNECT:/tmp/ble-rcu-simu.sock
+    $ flamegraph.pl /tmp/stall.collapsed > stall.svg
+"""
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_DURATION = 10.0
+DEFAULT_OUTPUT_DIR = '/tmp'
+# deeper stacks are cut at the root side, the leaf frames are the interesting ones
+MAX_STACK_DEPTH = 128
+
+
+def get_default_output_path(output_dir=DEFAULT_OUTPUT_DIR):
+    return os.path.join(output_dir, f'rcu-profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.collapsed')
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    directory, name = os.path.split(code.co_filename)
+    package = os.path.basename(directory)
+    # tivo_rcu/ble_hogp.py and sharp_rcu/ble_hogp.py, keyboard/__init__.py, ..
+    if package in ('tivo_rcu', 'sharp_rcu') or name == '__init__.py':
+        name = package + '/' + name
+    return f'{name}:{code.co_name}'
+
+
+class SamplingProfiler:
+    """
+    One capture at a time. The sampler runs in its own thread and never calls into the
+    profiled threads, so it keeps sampling when the GLib loop is the one stalling.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.output_path = None
+        # start and toggle come from the signal thread and the control socket threads
+        self.lock = threading.Lock()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration=DEFAULT_DURATION, output_path=None):
+        # Returns the path the samples will be written to
+        with self.lock:
+            if self.is_running():
+                raise RuntimeError(f'a capture to {self.output_path} is already running')
+            self.output_path = output_path if output_path else get_default_output_path()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, args=(duration, self.output_path),
+                                           name='SamplingProfiler', daemon=True)
+            self.thread.start()
+        logger.info('SamplingProfiler, sampling every %.1f ms for %.1f s into %s',
+                    self.interval * 1000, duration, self.output_path)
+        return self.output_path
+
+    def stop(self):
+        # ends the running capture early, the samples taken so far are written
+        self.stop_event.set()
+
+    def toggle(self, duration=DEFAULT_DURATION):
+        with self.lock:
+            if self.is_running():
+                self.stop()
+                return
+        self.start(duration)
+
+    def run(self, duration, output_path):
+        own_id = threading.get_ident()
+        stacks = collections.Counter()
+        samples = 0
+        begin = time.monotonic()
+        deadline = begin + duration
+        next_sample = begin
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(thread_id, f'thread-{thread_id}'))
+                stacks[';'.join(reversed(labels))] += 1
+            samples += 1
+            # fixed rate from the start, a late sample does not shift the following ones
+            next_sample += self.interval
+            if next_sample < now:
+                next_sample = now
+            self.stop_event.wait(next_sample - time.monotonic())
+
+        with open(output_path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.info('SamplingProfiler, %d samples over %.1f s written to %s',
+                    samples, time.monotonic() - begin, output_path)
+
+
+def install_signal_handler(profiler, signum=signal.SIGUSR1, duration=DEFAULT_DURATION):
+    # Neither a GLib signal source nor a Python signal handler runs while the main loop is
+    # stuck, the signal is blocked and taken by a thread of its own with sigwait() instead.
+    # Must be called from the main thread before any other thread is started, the threads
+    # inherit the mask and none of them gets the signal delivered.
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signum})
+
+    def wait_signal():
+        while True:
+            signal.sigwait({signum})
+            try:
+                profiler.toggle(duration)
+            except (OSError, RuntimeError) as e:
+                logger.warning('SamplingProfiler, %s', e)
+
+    thread = threading.Thread(target=wait_signal, name='ProfilerSignal', daemon=True)
+    thread.start()
+    return thread
+
+
+def add_control_commands(control_socket, profiler, duration=DEFAULT_DURATION):
+    # Registers 'profile [seconds] [path]' and 'profile stop' on a control_socket.ControlSocket,
+    # duration is used when the command gives none
+    def on_profile(args):
+        if args and args[0] == 'stop':
+            if not profiler.is_running():
+                raise ValueError('no capture is running')
+            profiler.stop()
+            return profiler.output_path
+        seconds = float(args[0]) if len(args) > 0 else duration
+        if seconds <= 0:
+            raise ValueError('the duration must be positive')
+        try:
+            return profiler.start(seconds, args[1] if len(args) > 1 else None)
+        except RuntimeError as e:
+            raise ValueError(str(e))
+
+    # runs on the thread of the client, not on the loop it may have to profile
+    control_socket.add_command('profile', on_profile, 'profile [seconds] [path] | profile stop', on_loop=False)
@@ -11,7 +11,7 @@ class SharpRCUAdvertisement(Advertisement):
     
     BASE_PATH = bluetooth_constants.BLUEZ_OBJ_ROOT + "advertisement"
     
-    def __init__(self, bus, mac_address, index):
+    def __init__(self, bus, mac_address, index, local_name=None):
         Advertisement.__init__(self, bus, self.BASE_PATH, index, "peripheral")
         #self.add_service_uuid(tivo_rcu.ble_hogp.HIDService.SERVICE_UUID)
         #self.add_service_uuid(tivo_rcu.ble_hogp.BatteryService.SERVICE_UUID)
@@ -19,6 +19,6 @@ class SharpRCUAdvertisement(Advertisement):
         #self.add_service_uuid(ble_hogp.DeviceInfoService.SERVICE_UUID)
         #self.add_service_uuid(ble_voice_service.VoiceService.SERVICE_UUID)
         self.mac_address = mac_address
-        self.add_local_name(self.DISCOVERABLE_NAME)
+        self.add_local_name(local_name or self.DISCOVERABLE_NAME)
         self.add_discoverable(True)
         self.include_tx_power = True
@@ -1,11 +1,24 @@
 #!/usr/bin/python3
-import audioop
 import bluetooth_constants
-from ble_base import Characteristic, Service
+from ble_base import Characteristic, AcquireNotifyCharacteristic, Service
 import dbus.service
 from gi.repository import GLib
 import struct
+import time
+from voice_pacer import PACING_REALTIME
 from sharp_rcu.voice_source import DataState, VoiceSource
+import logging
+from rcu_log import HexBytes
+from metrics import REGISTRY
+from voice_codecs import CODECS, CODEC_ADPCM_8K, DEFAULT_CODEC_PREFERENCE
+from voice_packer import VoiceFramePacker
+
+logger = logging.getLogger(__name__)
+
+VOICE_FRAMES_ENCODED = REGISTRY.counter('rcu_voice_frames_encoded_total',
+                                        'PCM chunks encoded to voice frames', ['rcu', 'codec'])
+VOICE_ENCODE_SECONDS = REGISTRY.histogram('rcu_voice_encode_seconds',
+                                          'Time to encode one PCM chunk', ['rcu', 'codec'])
 
 TV_TX_GET_CAPS = 0x0A
 TV_TX_MIC_OPEN = 0x0C
@@ -15,6 +28,13 @@ RCU_CTL_GET_CAP_RESP = 0x0B
 RCU_CTL_AUDIO_START = 0x04
 RCU_CTL_AUDIO_END = 0x00
 
+# reason of the audio start notification
+AUDIO_START_REASON_MIC_OPEN = 0x00
+AUDIO_START_REASON_HTT = 0x03
+# reason of the audio end notification
+AUDIO_END_REASON_MIC_CLOSE = 0x00
+AUDIO_END_REASON_HTT = 0x02
+
 
 class TvTxCharacteristic(Characteristic):
     CHARACTERISTIC_UUID = 'b9524732-bb08-11ec-8422-0242ac120002'
@@ -32,20 +52,21 @@ class TvTxCharacteristic(Characteristic):
             '01'), signature=dbus.Signature('y'))
 
     def ReadValue(self, options):
-        print(f'TvTxCharacteristic.ReadValue')
+        logger.info('TvTxCharacteristic.ReadValue')
+        self.parent.packer.update_mtu(options)
         return self.value
 
     def WriteValue(self, value, options):
-        print(f'TvTxCharacteristic.WriteValue, value = : {value}')
+        logger.info('TvTxCharacteristic.WriteValue, value = : %s', value)
         self.parent.HandleTvTx(value, options)
 
 
-class TvRxCharacteristic(Characteristic):
+class TvRxCharacteristic(AcquireNotifyCharacteristic):
     CHARACTERISTIC_UUID = 'b95249d0-bb08-11ec-8422-0242ac120002'
 
     def __init__(self, bus, index, service):
 
-        Characteristic.__init__(
+        AcquireNotifyCharacteristic.__init__(
             self, bus, index,
             self.CHARACTERISTIC_UUID,
             ['notify'],
@@ -55,16 +76,19 @@ class TvRxCharacteristic(Characteristic):
         self.value = dbus.Array(bytearray.fromhex(
             '01'), signature=dbus.Signature('y'))
 
+    # the voice frames are written to the acquired socket, packed to its MTU
+    def onNotifyAcquired(self, mtu):
+        self.parent.packer.set_mtu(mtu)
+
     def StartNotify(self):
-        print('TvRxCharacteristic.StartNotify')
+        logger.info('TvRxCharacteristic.StartNotify')
 
     def StopNotify(self):
-        print('TvRxCharacteristic.StopNotify')
+        logger.info('TvRxCharacteristic.StopNotify')
 
-    def Notify(self, obj):
-        # print(f'TvRxCharacteristic.Notify, obj = {obj}')
-        self.PropertiesChanged(
-            bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, obj, [])
+    def Notify(self, value):
+        # print(f'TvRxCharacteristic.Notify, value = {HexBytes(value)}')
+        self.NotifyValue(value)
 
 
 class TvCtlCharacteristic(Characteristic):
@@ -83,25 +107,25 @@ class TvCtlCharacteristic(Characteristic):
             '01'), signature=dbus.Signature('y'))
 
     def StartNotify(self):
-        print('TvCtlCharacteristic.StartNotify')
+        logger.info('TvCtlCharacteristic.StartNotify')
 
     def StopNotify(self):
-        print('TvCtlCharacteristic.StopNotify')
+        logger.info('TvCtlCharacteristic.StopNotify')
 
-    def Notify(self, obj):
-        print(f'TvCtlCharacteristic.Notify, obj = {obj}')
-        self.PropertiesChanged(
-            bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, obj, [])
+    def Notify(self, value):
+        logger.debug('TvCtlCharacteristic.Notify, value = %s', HexBytes(value))
+        self.NotifyValue(value)
 
 
 class VoiceService(Service):
     SERVICE_UUID = 'b9524502-bb08-11ec-8422-0242ac120002'
-    PATH_BASE = bluetooth_constants.BLUEZ_OBJ_ROOT + "voice_service"
+    PATH_NAME = "voice_service"
 
-    def __init__(self, bus, ruc_dlg):
-        Service.__init__(self, bus, self.PATH_BASE, self.SERVICE_UUID, True)
+    def __init__(self, bus, ruc_dlg, voice_pacing=PACING_REALTIME, obj_root=bluetooth_constants.BLUEZ_OBJ_ROOT,
+                 dle=False):
+        Service.__init__(self, bus, obj_root + self.PATH_NAME, self.SERVICE_UUID, True)
 
-        self.voice_source = VoiceSource(ruc_dlg, self.onPCMData)
+        self.voice_source = VoiceSource(ruc_dlg, self.onPCMData, voice_pacing)
 
         self.tv_tx_char = TvTxCharacteristic(bus, 0, self)
         self.add_characteristic(self.tv_tx_char)
@@ -112,119 +136,153 @@ class VoiceService(Service):
         self.tv_ctl_char = TvCtlCharacteristic(bus, 2, self)
         self.add_characteristic(self.tv_ctl_char)
 
-        # stuff to encode to ADPCM
+        # voice frames to notifications of the negotiated MTU
+        self.packer = VoiceFramePacker(self.tv_rx_char.Notify)
+        # LE Data Length Extension is a link layer feature, independent of the ATT MTU and not
+        # visible to a GATT server, so it is configured rather than guessed
+        self.dle = dle
+
+        # codecs supported mask of the TV, from its GET_CAPS. ADPCM 8 kHz until then, every TV has it.
+        self.tv_codecs_mask = CODEC_ADPCM_8K
+        # voice_codecs codec ids, the first one the TV supports is used
+        self.codec_preference = DEFAULT_CODEC_PREFERENCE
+        self.codec = CODECS.get(CODEC_ADPCM_8K)
+        self.encoder = self.codec.create_encoder()
+        self.stream_reason = AUDIO_START_REASON_HTT
+        self.setEncodeMetrics()
         self.resetEncodeADPCMState()
 
+    # the encode metrics of the current codec
+    def setEncodeMetrics(self):
+        self.encoded_frames = VOICE_FRAMES_ENCODED.labels('sharp', self.codec.name)
+        self.encode_seconds = VOICE_ENCODE_SECONDS.labels('sharp', self.codec.name)
+
     def resetEncodeADPCMState(self):
-        self.state = (0, 0x00)
+        self.encoder.reset()
+        self.packer.reset()
         self.seq = 0
 
-    # split the adpcm data into chunks with each one 20 bytes,
-    def NotifyADPCMPktWithHeaderWithChunks(self, adpcm_packet_with_header):
-        # separate the adpcm data into chunks with each one 20 bytes,
-        # and send it sequentially, each chunk will be notified to the client.
-        adpcm_chunk_size = 20
-        adpcm_data_len = len(adpcm_packet_with_header)
-        chunk_num = adpcm_data_len // adpcm_chunk_size
-        idx_chunk = 0
-        while idx_chunk < chunk_num:
-            chunk = adpcm_packet_with_header[idx_chunk *
-                                             adpcm_chunk_size:(idx_chunk+1)*adpcm_chunk_size]
-            # self.tv_rx_char.Notify({'Value': chunk})
-            self.tv_rx_char.Notify({'Value': chunk})
-            idx_chunk += 1
-
-        # send the last chunk
-        chunk = adpcm_packet_with_header[idx_chunk *
-                                         adpcm_chunk_size:adpcm_data_len]
-        self.tv_rx_char.Notify({'Value': chunk})
-
+    def setCodecPreference(self, codec_ids):
+        self.codec_preference = tuple(codec_ids)
+
+    # negotiates the codec and starts capturing, tv_codecs_mask overrides the GET_CAPS one
+    def startVoiceStream(self, reason, tv_codecs_mask=None):
+        codec = CODECS.negotiate(self.tv_codecs_mask if tv_codecs_mask is None else tv_codecs_mask,
+                                 self.codec_preference)
+        if codec is not self.codec:
+            self.codec = codec
+            self.encoder = codec.create_encoder()
+            self.setEncodeMetrics()
+        self.stream_reason = reason
+        logger.info('VoiceService.startVoiceStream, reason = %s, codec = %s', reason, codec.name)
+        self.voice_source.CaptureVoice(True, codec)
+
+    # the fixed size ADPCM frames fill the notifications, the Opus packets are sent frame aligned
     def NotifyADPCMPkt(self, adpcm_packet):
-        self.tv_rx_char.Notify({'Value': adpcm_packet})
+        if self.codec.frame_format is not None:
+            self.packer.add_frame(adpcm_packet)
+        else:
+            self.packer.send_frame(adpcm_packet)
 
     # receive PCM data from the voice source, encode it to adpcm data and send it to the client.
     # will ended incase receive 0 bytes from the voice source.
     def onPCMData(self, data_state, read_pcm_frames):
-        print(
-            f'VoiceService.onPCMData called, data_state = {data_state}')
+        logger.debug('VoiceService.onPCMData called, data_state = %s', data_state)
         if data_state == DataState.BEGIN:
-            print(
-                f'VoiceService.onPCMData begin to send pcmdata, data_state = {data_state}')
+            logger.info('VoiceService.onPCMData begin to send pcmdata, data_state = %s', data_state)
             self.resetEncodeADPCMState()
 
             # HTT Audio transfer is triggered by “Assistant” button press and
-            # will stop once the button is released.
-            reason = 0x03
+            # will stop once the button is released, on request transfers by MIC_OPEN.
+            reason = self.stream_reason
 
             # codec_used = 0x01: ADPCM (8Khz/16bit)
             # codec_used = 0x02: ADPCM (16Khz/16bit)
-            codec_used = 1
+            # codec_used = 0x04: Opus (16Khz/16bit)
+            codec_used = self.codec.codec_id
 
             # 0x01..0x80:​ an auto-incremented value if the ​ reason ​ field is not 0x00.
             stream_id = 0x80
 
             audio_start_bytes = struct.pack('>B', RCU_CTL_AUDIO_START) + struct.pack(
                 '>B', reason) + struct.pack('>B', codec_used) + struct.pack('>B', stream_id)
-            dbus_audio_start_bytes = [dbus.Byte(b) for b in audio_start_bytes]
-            self.tv_ctl_char.Notify({'Value': dbus_audio_start_bytes})
+            self.tv_ctl_char.Notify(audio_start_bytes)
 
         elif data_state == DataState.END:
-            print(
-                f'VoiceService.onPCMData end, will send end to client')
+            logger.info('VoiceService.onPCMData end, will send end to client')
+            # the rest of the last frames goes before the end
+            self.packer.flush()
             # send the audio_end notification
             # triggered by releasing an Assistant button during HTT
-            # interaction
-            reason = 0x02
+            # interaction, or by MIC_CLOSE
+            reason = AUDIO_END_REASON_MIC_CLOSE if self.stream_reason == AUDIO_START_REASON_MIC_OPEN \
+                else AUDIO_END_REASON_HTT
 
             audio_stop_bytes = struct.pack('>B', RCU_CTL_AUDIO_END) + struct.pack(
                 '>B', reason)
-            dbus_audio_stop_bytes = [dbus.Byte(b) for b in audio_stop_bytes]
-            self.tv_ctl_char.Notify({'Value': dbus_audio_stop_bytes})
+            self.tv_ctl_char.Notify(audio_stop_bytes)
         elif data_state == DataState.SENDING_DATA:
             if len(read_pcm_frames) > 0:
-                dbus_adpcm_data = []
-                # encode the pcm data to adpcm data
-                adpcm_data, self.state = audioop.lin2adpcm(
-                    read_pcm_frames, self.voice_source.getSampleWidth(), self.state)
-                print(
-                    f'VoiceService.onPCMData, read pcm ok, encoded to ADPCM, len = {len(adpcm_data)}')
-                dbus_adpcm_data.extend(
-                    [dbus.Byte(b) for b in adpcm_data])
-                self.NotifyADPCMPkt(dbus_adpcm_data)
+                # encode the pcm data with the negotiated codec
+                encode_start = time.perf_counter()
+                adpcm_data = self.encoder.encode(read_pcm_frames)
+                self.encode_seconds.observe(time.perf_counter() - encode_start)
+                self.encoded_frames.inc()
+                logger.debug('VoiceService.onPCMData, read pcm ok, encoded to %s, len = %s',
+                             self.codec.name, len(adpcm_data))
+                self.NotifyADPCMPkt(adpcm_data)
             else:
-                print(
-                    f'VoiceService.onPCMData receiving data error, len(read_pcm_frames) <= 0!')
+                logger.warning('VoiceService.onPCMData receiving data error, len(read_pcm_frames) <= 0!')
+        elif data_state == DataState.SENDING_ADPCM_DATA:
+            # read_pcm_frames is an already encoded 128 bytes ADPCM frame from the asset cache
+            self.NotifyADPCMPkt(read_pcm_frames)
 
     def HandleTvTx(self, value, options):
-        print(f'HandleTvTx called, value = {value}')
+        logger.debug('HandleTvTx called, value = %s', value)
+        self.packer.update_mtu(options)
         command_val = value[0]
         if int(command_val) == TV_TX_GET_CAPS:
-            print(f'HandleTvTx, will handle get caps..')
+            logger.debug('HandleTvTx, will handle get caps..')
+            # [0x0A, version hi, version lo, codecs supported hi, codecs supported lo, ..]
+            if len(value) >= 5:
+                self.tv_codecs_mask = (int(value[3]) << 8) | int(value[4])
+                logger.info('HandleTvTx, TV version = 0x%02x%02x, codecs supported = 0x%04x',
+                            int(value[1]), int(value[2]), self.tv_codecs_mask)
             get_cap_resp_byte = struct.pack('>B', RCU_CTL_GET_CAP_RESP)
             version = 0x0100
             version_bytes = struct.pack('>H', version)
-            codec = 1
+            # the codecs this remote can encode with, in the same bit mask
+            codec = CODECS.get_mask(self.codec_preference)
             codec_byte = struct.pack('>B', codec)
             htt_mode = 3
             htt_mode_byte = struct.pack('>B', htt_mode)
             audio_frame_size = 128
             audio_frame_size_bytes = struct.pack('>H', audio_frame_size)
-            dle = 0
+            dle = 1 if self.dle else 0
             dle_byte = struct.pack('>B', dle)
             reserved = 0
             reserved_byte = struct.pack('>B', reserved)
             get_cap_resp = get_cap_resp_byte + version_bytes + codec_byte + \
                 htt_mode_byte + audio_frame_size_bytes + dle_byte + reserved_byte
-            dbus_get_cap_resp = [dbus.Byte(b) for b in get_cap_resp]
-            self.tv_ctl_char.Notify({'Value': dbus_get_cap_resp})
-            print(f'HandleTvTx, handle get caps end')
-        print(f'HandleTvTx end')
+            self.tv_ctl_char.Notify(get_cap_resp)
+            logger.debug('HandleTvTx, handle get caps end')
+        elif int(command_val) == TV_TX_MIC_OPEN:
+            # [0x0C, mode] or [0x0C, mode, codec] with the codec the TV wants for this stream
+            tv_codecs_mask = int(value[2]) if len(value) >= 3 else None
+            logger.debug('HandleTvTx, will handle mic open, codec requested = %s', tv_codecs_mask)
+            if self.voice_source.capture_end:
+                self.startVoiceStream(AUDIO_START_REASON_MIC_OPEN, tv_codecs_mask)
+        elif int(command_val) == TV_TX_MIC_CLOSE:
+            logger.debug('HandleTvTx, will handle mic close..')
+            if self.stream_reason == AUDIO_START_REASON_MIC_OPEN and not self.voice_source.capture_end:
+                self.voice_source.CaptureVoice(False)
+        logger.debug('HandleTvTx end')
 
     def HTT(self, pressed = True):
         if pressed:
-            self.voice_source.CaptureVoice(pressed)
+            self.startVoiceStream(AUDIO_START_REASON_HTT)
         else:
             self.voice_source.CaptureVoice(pressed)
 
     def simulatingHTT(self):
-        self.voice_source.startCaptureThreads()
+        self.startVoiceStream(AUDIO_START_REASON_HTT)
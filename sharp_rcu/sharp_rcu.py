@@ -4,6 +4,10 @@ from key_detector import KeyDetector
 from sharp_rcu.sharp_rcu_ui import Ui_SharpRcuDlg
 import sharp_rcu.key_table_constants as ktc
 import os
+import logging
+
+logger = logging.getLogger(__name__)
+
 
 class SharpRcuDlg(QtWidgets.QDialog):
     def __init__(self, key_event_listener, capture_keyboard_listener, key_descriptor_obj, key_exit_listener):
@@ -17,6 +21,9 @@ class SharpRcuDlg(QtWidgets.QDialog):
         current_dir = os.getcwd()
         self.path_to_8k_file = os.path.join(
             current_dir, "./audio/find_spiderman_8k.wav")
+        # used when the ADPCM 16k or the Opus codec is negotiated, no widget for it yet
+        self.path_to_16k_file = os.path.join(
+            current_dir, "./audio/find_spiderman_16k.wav")
         self.ui = Ui_SharpRcuDlg()
         self.ui.setupUi(self)
         self.setup_control()
@@ -28,6 +35,9 @@ class SharpRcuDlg(QtWidgets.QDialog):
     def get_8k_file_path(self):
         return self.path_to_8k_file
 
+    def get_16k_file_path(self):
+        return self.path_to_16k_file
+
     def setup_control(self):
         self.ui.KEY_POWER.pressed.connect(self.onPressed)
         self.ui.KEY_POWER.released.connect(self.onReleased)
@@ -130,28 +140,28 @@ class SharpRcuDlg(QtWidgets.QDialog):
         self.ui.KEY_BLUE.released.connect(self.onReleased)
 
     def handlePress(self, key_name):
-        print(f'handlePress, key_name = {key_name}')
+        logger.debug('handlePress, key_name = %s', key_name)
         self.key_event_listener(key_name, True)
 
     def handleRelease(self, key_name):
-        print(f'handleRelease, key_name = {key_name}')
+        logger.debug('handleRelease, key_name = %s', key_name)
         self.key_event_listener(key_name, False)
 
     def handleClick(self, key_name):
-        print(f'handleClick, key_name = {key_name}')
+        logger.debug('handleClick, key_name = %s', key_name)
         self.key_event_listener(key_name, True)
         self.key_event_listener(key_name, False)
 
     def onPressed(self):
         sender = self.sender()
         key_name = sender.objectName()
-        print('onPressed, key_name = ' + sender.objectName())
+        logger.debug('onPressed, key_name = %s', key_name)
         self.key_detector.onPressed(key_name)
 
     def onReleased(self):
         sender = self.sender()
         key_name = sender.objectName()
-        print('onReleased, key_name = ' + sender.objectName())
+        logger.debug('onReleased, key_name = %s', key_name)
         self.key_detector.onReleased(key_name)
 
     def captureKeyboardClicked(self):
@@ -0,0 +1,96 @@
+import socket
+import time
+
+import pytest
+
+dbus = pytest.importorskip('dbus')
+pytest.importorskip('gi')
+GLib = pytest.importorskip('gi.repository.GLib')
+
+import bluetooth_constants
+from ble_base import AcquireNotifyCharacteristic, Service
+
+
+class VoiceRxCharacteristic(AcquireNotifyCharacteristic):
+    def __init__(self, service):
+        # not exported, no bus needed to call the methods bluetoothd would call
+        AcquireNotifyCharacteristic.__init__(self, None, 0, 'ab5e0003-5a21-4f05-bc7d-af01f617b664',
+                                             ['notify'], service)
+        self.acquired_mtus = []
+        self.signals = []
+
+    def onNotifyAcquired(self, mtu):
+        self.acquired_mtus.append(mtu)
+
+    def PropertiesChanged(self, interface, changed, invalidated):
+        self.signals.append(dict(changed))
+
+
+@pytest.fixture
+def characteristic():
+    service = Service(None, '/org/bluez/test/service0', 'ab5e0001-5a21-4f05-bc7d-af01f617b664', True)
+    return VoiceRxCharacteristic(service)
+
+
+def is_acquired(characteristic):
+    properties = characteristic.get_properties()[bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE]
+    return bool(properties[bluetooth_constants.GATT_PROP_NOTIFY_ACQUIRED])
+
+
+def acquire(characteristic, mtu=100):
+    fd, reply_mtu = characteristic.AcquireNotify({'mtu': dbus.UInt16(mtu)})
+    assert reply_mtu == mtu
+    return socket.socket(fileno=fd.take())
+
+
+def iterate_loop_until(condition, timeout=5):
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        context.iteration(False)
+        time.sleep(0.001)
+
+
+def test_notifications_go_through_the_socket(characteristic):
+    assert not is_acquired(characteristic)
+    peer = acquire(characteristic, 185)
+    try:
+        assert is_acquired(characteristic)
+        assert characteristic.acquired_mtus == [185]
+        assert characteristic.signals == [{bluetooth_constants.GATT_PROP_NOTIFY_ACQUIRED: True}]
+        characteristic.NotifyValue(b'\x01' * 20)
+        characteristic.NotifyValue(bytearray(b'\x02' * 182))
+        peer.settimeout(5)
+        # one packet per notification
+        assert peer.recv(512) == b'\x01' * 20
+        assert peer.recv(512) == b'\x02' * 182
+        assert len(characteristic.signals) == 1
+    finally:
+        peer.close()
+        characteristic.releaseNotify()
+
+
+def test_peer_close_falls_back_to_signals(characteristic):
+    peer = acquire(characteristic)
+    peer.close()
+    iterate_loop_until(lambda: not is_acquired(characteristic))
+    assert characteristic.signals[-1] == {bluetooth_constants.GATT_PROP_NOTIFY_ACQUIRED: False}
+    characteristic.NotifyValue(b'\x03\x04')
+    assert bytes(characteristic.signals[-1]['Value']) == b'\x03\x04'
+
+
+def test_full_socket_drops_without_blocking(characteristic):
+    peer = acquire(characteristic)
+    try:
+        begin = time.monotonic()
+        for _ in range(10000):
+            characteristic.NotifyValue(bytes(97))
+        assert time.monotonic() - begin < 1.0
+        assert characteristic.fd_drop_counter.value > 0
+        # still acquired, the queued packets are not overtaken by signals
+        assert is_acquired(characteristic)
+        assert len(characteristic.signals) == 1
+    finally:
+        peer.close()
+        characteristic.releaseNotify()
@@ -0,0 +1,156 @@
+import array
+import math
+import os
+import struct
+import threading
+import wave
+
+import pytest
+
+import adpcm_asset_cache
+from adpcm_asset_cache import (ADPCM_FRAME_PAYLOAD_SIZE, CACHE_HEADER, FRAME_FORMAT_SHARP, FRAME_FORMAT_TIVO,
+                               encode_wave_frames, load_asset)
+from adpcm_codec import AdpcmEncoder
+
+# PCM bytes the voice sources hand to the encoder per frame
+PCM_CHUNK_SIZE = ADPCM_FRAME_PAYLOAD_SIZE * 4
+
+
+@pytest.fixture(autouse=True)
+def loaded_assets(monkeypatch):
+    # every test starts with nothing mapped, as a new process does
+    assets = {}
+    monkeypatch.setattr(adpcm_asset_cache, '_loaded_assets', assets)
+    return assets
+
+
+def write_wave(path, seconds=0.5, sample_rate=8000, sample_width=2, channels=1):
+    samples = int(seconds * sample_rate)
+    pcm = array.array('h', (int(12000 * math.sin(i / 7.0)) for i in range(samples * channels)))
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(sample_width)
+        f.setframerate(sample_rate)
+        if sample_width == 2:
+            f.writeframes(pcm.tobytes())
+        else:
+            f.writeframes(bytes(samples * channels * sample_width))
+    return pcm.tobytes()
+
+
+def live_frames(pcm, frame_format):
+    # the framing of the voice services encoding the PCM chunks of one utterance
+    encoder = AdpcmEncoder()
+    frames = []
+    for seq, begin in enumerate(range(0, len(pcm) - PCM_CHUNK_SIZE + 1, PCM_CHUNK_SIZE)):
+        header = b''
+        if frame_format == FRAME_FORMAT_TIVO:
+            header = struct.pack('>H', seq) + struct.pack('B', 0x00) + struct.pack('>h', encoder.valpred) + \
+                struct.pack('B', encoder.index)
+        frames.append(header + encoder.encode(pcm[begin:begin + PCM_CHUNK_SIZE]))
+    return frames
+
+
+@pytest.mark.parametrize('frame_format', [FRAME_FORMAT_SHARP, FRAME_FORMAT_TIVO])
+def test_cached_frames_match_the_live_encoding(tmp_path, frame_format):
+    wave_file = tmp_path / 'voice.wav'
+    pcm = write_wave(wave_file)
+    asset = load_asset(str(wave_file), frame_format, str(tmp_path / 'cache'))
+    assert asset is not None
+    assert asset.sample_rate == 8000
+    cached = [bytes(frame) for frame in asset]
+    _, encoded = encode_wave_frames(str(wave_file), frame_format)
+    assert cached == encoded
+    assert cached == live_frames(pcm, frame_format)
+    assert len(cached) == len(pcm) // PCM_CHUNK_SIZE
+
+
+def test_loaded_once_per_process(tmp_path):
+    wave_file = tmp_path / 'voice.wav'
+    write_wave(wave_file)
+    cache_dir = str(tmp_path / 'cache')
+    first = load_asset(str(wave_file), FRAME_FORMAT_SHARP, cache_dir)
+    assert load_asset(str(wave_file), FRAME_FORMAT_SHARP, cache_dir) is first
+    assert load_asset(str(wave_file), FRAME_FORMAT_TIVO, cache_dir) is not first
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_mtime_change_makes_a_new_key(tmp_path):
+    wave_file = tmp_path / 'voice.wav'
+    write_wave(wave_file)
+    cache_dir = str(tmp_path / 'cache')
+    first = load_asset(str(wave_file), FRAME_FORMAT_SHARP, cache_dir)
+    st = os.stat(wave_file)
+    os.utime(wave_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    second = load_asset(str(wave_file), FRAME_FORMAT_SHARP, cache_dir)
+    assert second is not first
+    assert second.path != first.path
+    assert sorted(os.listdir(cache_dir)) == sorted([os.path.basename(first.path), os.path.basename(second.path)])
+
+
+@pytest.mark.parametrize('damage', ['truncate', 'magic'])
+def test_damaged_cache_file_is_encoded_again(tmp_path, loaded_assets, damage):
+    wave_file = tmp_path / 'voice.wav'
+    write_wave(wave_file)
+    cache_dir = str(tmp_path / 'cache')
+    good = [bytes(frame) for frame in load_asset(str(wave_file), FRAME_FORMAT_TIVO, cache_dir)]
+    cache_path = load_asset(str(wave_file), FRAME_FORMAT_TIVO, cache_dir).path
+    with open(cache_path, 'rb') as f:
+        data = f.read()
+    if damage == 'truncate':
+        data = data[:CACHE_HEADER.size + 100]
+    else:
+        data = b'NOTADPCM' + data[8:]
+    # replaced rather than rewritten in place, the old mapping stays valid
+    os.unlink(cache_path)
+    with open(cache_path, 'wb') as f:
+        f.write(data)
+    # as a new process would find it
+    loaded_assets.clear()
+    asset = load_asset(str(wave_file), FRAME_FORMAT_TIVO, cache_dir)
+    assert [bytes(frame) for frame in asset] == good
+    assert os.path.getsize(cache_path) == CACHE_HEADER.size + len(good) * (6 + ADPCM_FRAME_PAYLOAD_SIZE)
+
+
+def test_cached_clip_loads_while_another_is_encoded(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    cached_file = tmp_path / 'cached.wav'
+    write_wave(cached_file)
+    cached = load_asset(str(cached_file), FRAME_FORMAT_SHARP, cache_dir)
+    new_file = tmp_path / 'new.wav'
+    write_wave(new_file, seconds=0.2)
+
+    encoding = threading.Event()
+    release = threading.Event()
+    encode = adpcm_asset_cache.encode_wave_frames
+
+    def slow_encode(wave_file, frame_format):
+        encoding.set()
+        assert release.wait(5)
+        return encode(wave_file, frame_format)
+
+    monkeypatch.setattr(adpcm_asset_cache, 'encode_wave_frames', slow_encode)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(load_asset(str(new_file), FRAME_FORMAT_SHARP, cache_dir)))
+    thread.start()
+    try:
+        assert encoding.wait(5)
+        # not queued behind the encode of the new clip
+        assert load_asset(str(cached_file), FRAME_FORMAT_SHARP, cache_dir) is cached
+    finally:
+        release.set()
+        thread.join(5)
+    assert results[0] is not None and len(results[0]) > 0
+
+
+@pytest.mark.parametrize('sample_width, channels', [(1, 1), (2, 2)])
+def test_unsupported_wave_is_not_cached(tmp_path, sample_width, channels):
+    wave_file = tmp_path / 'voice.wav'
+    write_wave(wave_file, sample_width=sample_width, channels=channels)
+    assert load_asset(str(wave_file), FRAME_FORMAT_SHARP, str(tmp_path / 'cache')) is None
+
+
+def test_missing_wave(tmp_path):
+    assert load_asset(str(tmp_path / 'missing.wav'), FRAME_FORMAT_SHARP, str(tmp_path / 'cache')) is None
+    with pytest.raises(ValueError):
+        load_asset(str(tmp_path / 'missing.wav'), 'mp3', str(tmp_path / 'cache'))
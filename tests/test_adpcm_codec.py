@@ -0,0 +1,77 @@
+import array
+import math
+import random
+import warnings
+
+import pytest
+
+from adpcm_codec import AdpcmDecoder, AdpcmEncoder, adpcm2lin, lin2adpcm
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import audioop
+    except ImportError:
+        audioop = None
+
+
+def make_pcm(samples=4096, seed=1):
+    # a sweep with noise and clipped peaks, every step index gets used
+    rnd = random.Random(seed)
+    pcm = array.array('h')
+    for i in range(samples):
+        value = 40000 * math.sin(i * i / 20000.0) + rnd.randint(-2000, 2000)
+        pcm.append(max(-32768, min(32767, int(value))))
+    return pcm.tobytes()
+
+
+@pytest.mark.skipif(audioop is None, reason='audioop is gone from this Python')
+@pytest.mark.parametrize('state', [None, (0, 0), (-1234, 40), (32767, 88)])
+def test_lin2adpcm_matches_audioop(state):
+    pcm = make_pcm()
+    assert lin2adpcm(pcm, 2, state) == audioop.lin2adpcm(pcm, 2, state)
+
+
+@pytest.mark.skipif(audioop is None, reason='audioop is gone from this Python')
+def test_adpcm2lin_matches_audioop():
+    adpcm, _ = audioop.lin2adpcm(make_pcm(), 2, None)
+    assert adpcm2lin(adpcm, 2, (100, 20)) == audioop.adpcm2lin(adpcm, 2, (100, 20))
+
+
+def test_encoder_state_carries_over_chunks():
+    pcm = make_pcm()
+    whole = AdpcmEncoder().encode(pcm)
+    encoder = AdpcmEncoder()
+    chunked = b''.join(encoder.encode(pcm[i:i + 512]) for i in range(0, len(pcm), 512))
+    assert chunked == whole
+
+
+def test_encode_frames_states():
+    pcm = make_pcm(samples=256 * 5 + 10)
+    frames = AdpcmEncoder().encode_frames(pcm, 128)
+    # the trailing partial frame is dropped
+    assert len(frames) == 5
+    assert frames[0][0] == (0, 0)
+    decoder = AdpcmDecoder()
+    for state, frame in frames:
+        assert len(frame) == 128
+        # a receiver can start decoding from any frame with the state sent before it
+        assert decoder.get_state() == state
+        decoder.decode(frame)
+
+
+def test_decoder_follows_the_signal():
+    pcm = make_pcm()
+    decoded = array.array('h', AdpcmDecoder().decode(AdpcmEncoder().encode(pcm)))
+    original = array.array('h', pcm)
+    error = sum(abs(a - b) for a, b in zip(original, decoded)) / len(original)
+    assert error < 2000
+
+
+def test_bad_arguments():
+    with pytest.raises(ValueError):
+        lin2adpcm(b'\x00\x00', 1, None)
+    with pytest.raises(ValueError):
+        AdpcmEncoder((0, 89))
+    with pytest.raises(ValueError):
+        AdpcmEncoder().encode(b'\x00\x00\x00')
@@ -0,0 +1,140 @@
+import pytest
+
+pytest.importorskip('dbus')
+
+import bluetooth_constants
+from bluetooth_utils import ProxyCache
+
+DEVICE_PATH = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+OTHER_DEVICE_PATH = '/org/bluez/hci0/dev_00_11_22_33_44_550'
+
+
+class StubProxy:
+    def __init__(self, bus_name, object_path):
+        self.bus_name = bus_name
+        self.object_path = object_path
+
+
+class StubMatch:
+    def __init__(self):
+        self.removed = False
+
+    def remove(self):
+        self.removed = True
+
+
+class StubWatch:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class StubBus:
+    def __init__(self):
+        self.get_object_calls = []
+        self.signal_receivers = []
+        self.owner_watches = []
+
+    def get_object(self, bus_name, object_path, introspect=True):
+        assert not introspect
+        self.get_object_calls.append(object_path)
+        return StubProxy(bus_name, object_path)
+
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None, bus_name=None, path=None):
+        match = StubMatch()
+        self.signal_receivers.append((handler, signal_name, dbus_interface, bus_name, match))
+        return match
+
+    def watch_name_owner(self, bus_name, callback):
+        watch = StubWatch()
+        self.owner_watches.append((bus_name, callback, watch))
+        return watch
+
+    def interfaces_removed(self, path, interfaces):
+        for handler, signal_name, dbus_interface, bus_name, _ in self.signal_receivers:
+            if signal_name == 'InterfacesRemoved' and dbus_interface == bluetooth_constants.DBUS_OM_IFACE:
+                handler(path, interfaces)
+
+    def name_owner_changed(self, owner):
+        for bus_name, callback, _ in self.owner_watches:
+            if bus_name == bluetooth_constants.BLUEZ_SERVICE_NAME:
+                callback(owner)
+
+
+@pytest.fixture
+def bus():
+    return StubBus()
+
+
+@pytest.fixture
+def cache(bus):
+    cache = ProxyCache(bus)
+    # the watch reports the current owner right away
+    bus.name_owner_changed(':1.7')
+    return cache
+
+
+def lookup_all(cache, paths):
+    return {path: cache.get_interface(path, bluetooth_constants.DBUS_PROPERTIES) for path in paths}
+
+
+def test_watches_org_bluez(bus, cache):
+    assert [receiver[1:4] for receiver in bus.signal_receivers] == \
+        [('InterfacesRemoved', bluetooth_constants.DBUS_OM_IFACE, bluetooth_constants.BLUEZ_SERVICE_NAME)]
+    assert [watch[0] for watch in bus.owner_watches] == [bluetooth_constants.BLUEZ_SERVICE_NAME]
+    cache.close()
+    assert bus.signal_receivers[0][4].removed
+    assert bus.owner_watches[0][2].cancelled
+
+
+def test_lookups_share_one_proxy_per_path(bus, cache):
+    properties = cache.get_interface(DEVICE_PATH, bluetooth_constants.DBUS_PROPERTIES)
+    device = cache.get_interface(DEVICE_PATH, bluetooth_constants.DEVICE_INTERFACE)
+    assert cache.get_interface(DEVICE_PATH, bluetooth_constants.DBUS_PROPERTIES) is properties
+    assert properties is not device
+    assert properties.proxy_object is device.proxy_object
+    assert bus.get_object_calls == [DEVICE_PATH]
+
+
+def test_interfaces_removed_drops_the_objects_below_the_path(bus, cache):
+    service_path = DEVICE_PATH + '/service0010'
+    char_path = service_path + '/char0011'
+    paths = [DEVICE_PATH, service_path, char_path, OTHER_DEVICE_PATH]
+    before = lookup_all(cache, paths)
+    bus.interfaces_removed(DEVICE_PATH, [bluetooth_constants.DEVICE_INTERFACE])
+    assert sorted(cache.proxies) == [OTHER_DEVICE_PATH]
+    after = lookup_all(cache, paths)
+    assert after[OTHER_DEVICE_PATH] is before[OTHER_DEVICE_PATH]
+    for path in (DEVICE_PATH, service_path, char_path):
+        assert after[path] is not before[path]
+    assert bus.get_object_calls == paths + paths[:3]
+
+
+def test_interfaces_removed_of_a_child_keeps_the_parent(bus, cache):
+    service_path = DEVICE_PATH + '/service0010'
+    before = lookup_all(cache, [DEVICE_PATH, service_path])
+    bus.interfaces_removed(service_path, [bluetooth_constants.GATT_SERVICE_INTERFACE])
+    assert sorted(cache.proxies) == [DEVICE_PATH]
+    assert cache.get_interface(DEVICE_PATH, bluetooth_constants.DBUS_PROPERTIES) is before[DEVICE_PATH]
+
+
+def test_initial_owner_report_keeps_the_cache(bus):
+    cache = ProxyCache(bus)
+    before = lookup_all(cache, [DEVICE_PATH])
+    bus.name_owner_changed(':1.7')
+    assert cache.owner == ':1.7'
+    assert lookup_all(cache, [DEVICE_PATH]) == before
+
+
+@pytest.mark.parametrize('new_owner', [':1.42', ''])
+def test_owner_change_clears_the_cache(bus, cache, new_owner):
+    before = lookup_all(cache, [DEVICE_PATH, OTHER_DEVICE_PATH])
+    # bluetoothd restarted, or went away
+    bus.name_owner_changed(new_owner)
+    assert cache.owner == new_owner
+    assert cache.proxies == {}
+    assert cache.interfaces == {}
+    after = lookup_all(cache, [DEVICE_PATH, OTHER_DEVICE_PATH])
+    assert all(after[path] is not before[path] for path in before)
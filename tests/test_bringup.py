@@ -0,0 +1,320 @@
+import threading
+
+import pytest
+
+pytest.importorskip('gi')
+GLib = pytest.importorskip('gi.repository.GLib')
+dbus = pytest.importorskip('dbus')
+
+import bluetooth_constants
+import bringup
+from bringup import Bringup, Join, run_in_thread
+from rcu_instance import RC_TYPE_SHARP, get_discoverable_name
+
+ADAPTERS = ['/org/bluez/hci0', '/org/bluez/hci1']
+AGENT_PATH = '/test/agent'
+
+
+def deliver(handler, *args):
+    handler(*args)
+    return False
+
+
+def no_reply():
+    return dbus.exceptions.DBusException('Did not receive a reply', name='org.freedesktop.DBus.Error.NoReply')
+
+
+class FakeBluez:
+    """
+    Answers the adapter and agent manager calls of Bringup from the loop, as dbus-python calls
+    the reply handlers. A call listed in errors gets that error, one listed in held gets no
+    answer until answer() is called.
+    """
+
+    def __init__(self, adapters):
+        self.adapters = adapters
+        self.calls = []
+        self.errors = {}
+        self.held = set()
+        self.held_calls = {}
+
+    def call(self, key, reply_handler, error_handler, *reply):
+        self.calls.append(key)
+        if key in self.held:
+            self.held_calls[key] = (reply_handler, error_handler)
+        elif key in self.errors:
+            GLib.idle_add(deliver, error_handler, self.errors[key])
+        else:
+            GLib.idle_add(deliver, reply_handler, *reply)
+
+    def answer(self, key, error=None):
+        reply_handler, error_handler = self.held_calls.pop(key)
+        if error is not None:
+            GLib.idle_add(deliver, error_handler, error)
+        else:
+            GLib.idle_add(deliver, reply_handler)
+
+
+class FakeInterface:
+    def __init__(self, bluez, path):
+        self.bluez = bluez
+        self.path = path
+
+    def Set(self, interface, name, value, reply_handler, error_handler):
+        assert interface == bluetooth_constants.ADAPTER_INTERFACE
+        self.bluez.call((self.path, 'Set', name), reply_handler, error_handler)
+
+    def Get(self, interface, name, reply_handler, error_handler):
+        assert name == bluetooth_constants.ADAPTER_PROP_MAC_ADDRESS
+        address = '00:00:00:00:00:%02X' % self.bluez.adapters.index(self.path)
+        self.bluez.call((self.path, 'Get', name), reply_handler, error_handler, address)
+
+    def RegisterAgent(self, agent_path, capability, reply_handler, error_handler):
+        self.bluez.call((self.path, 'RegisterAgent', capability), reply_handler, error_handler)
+
+    def RequestDefaultAgent(self, agent_path, reply_handler, error_handler):
+        self.bluez.call((self.path, 'RequestDefaultAgent', agent_path), reply_handler, error_handler)
+
+
+class FakeInstance:
+    def __init__(self, index, adapter_path, mac_address, fail_registration=False):
+        self.index = index
+        self.adapter_path = adapter_path
+        self.mac_address = mac_address
+        self.fail_registration = fail_registration
+        self.prepared = False
+        self.steps = []
+
+    def get_name(self):
+        return f'FakeRemote#{self.index} on {self.adapter_path}'
+
+    def prepare_application(self):
+        self.prepared = True
+
+    def start_advertising(self, on_fatal_error, on_started=None):
+        self.steps.append('advertise')
+        GLib.idle_add(deliver, on_started)
+
+    def register_application(self, on_fatal_error, on_registered=None):
+        self.steps.append('register_gatt')
+        if self.fail_registration:
+            GLib.idle_add(deliver, on_fatal_error)
+        else:
+            GLib.idle_add(deliver, on_registered)
+
+
+@pytest.fixture
+def bluez(monkeypatch):
+    bluez = FakeBluez(ADAPTERS)
+    monkeypatch.setattr(bringup, 'clear_local_devices', lambda: None)
+    monkeypatch.setattr(bringup, 'find_adapters_async',
+                        lambda bus, reply_handler, error_handler: GLib.idle_add(deliver, reply_handler,
+                                                                                list(bluez.adapters)))
+    monkeypatch.setattr(bringup, 'get_object_interface',
+                        lambda path, interface_name, bus=None: FakeInterface(bluez, path))
+    return bluez
+
+
+class Outcome:
+    def __init__(self, loop):
+        self.loop = loop
+        self.ready = 0
+        self.fatal_errors = 0
+
+    def on_ready(self):
+        self.ready += 1
+        self.loop.quit()
+
+    def on_fatal_error(self):
+        self.fatal_errors += 1
+        self.loop.quit()
+
+
+def run_loop(loop, seconds):
+    # returns False when the loop had to be stopped by the timeout
+    timed_out = []
+
+    def on_timeout():
+        timed_out.append(True)
+        loop.quit()
+        return False
+
+    source = GLib.timeout_add(int(seconds * 1000), on_timeout)
+    loop.run()
+    if not timed_out:
+        GLib.source_remove(source)
+    return not timed_out
+
+
+def start_bringup(instance_count, create_instance, ip_addresses=()):
+    loop = GLib.MainLoop()
+    outcome = Outcome(loop)
+    instance = Bringup(None, RC_TYPE_SHARP, instance_count, list(ip_addresses), [], AGENT_PATH, 'NoInputNoOutput',
+                       create_instance, outcome.on_ready, outcome.on_fatal_error)
+    GLib.idle_add(instance.start)
+    return loop, outcome, instance
+
+
+def test_join_fires_once_after_the_last_done():
+    fired = []
+    join = Join(3, lambda: fired.append(True))
+    join.done()
+    join.done()
+    assert fired == []
+    join.done()
+    assert fired == [True]
+
+
+def test_empty_join_fires_from_the_loop():
+    loop = GLib.MainLoop()
+    fired = []
+    Join(0, lambda: (fired.append(True), loop.quit()))
+    assert fired == []
+    assert run_loop(loop, 5)
+    assert fired == [True]
+
+
+def test_run_in_thread_delivers_on_the_loop():
+    loop = GLib.MainLoop()
+    results = []
+
+    def on_done(result, error):
+        results.append((threading.current_thread(), result, error))
+        if len(results) == 2:
+            loop.quit()
+
+    def fail():
+        raise OSError('no bluetoothd')
+
+    run_in_thread(on_done, lambda a, b: (threading.current_thread(), a + b), 2, b=3)
+    run_in_thread(on_done, fail)
+    assert run_loop(loop, 5)
+    assert all(thread is threading.main_thread() for thread, _, _ in results)
+    results = {error is None: (result, error) for _, result, error in results}
+    worker, total = results[True][0]
+    assert worker is not threading.main_thread() and total == 5
+    assert results[False][0] is None and isinstance(results[False][1], OSError)
+
+
+def test_every_instance_comes_up(bluez):
+    instances = []
+
+    def create_instance(index, adapter_path, mac_address):
+        instances.append(FakeInstance(index, adapter_path, mac_address))
+        return instances[-1]
+
+    loop, outcome, instance = start_bringup(3, create_instance)
+    assert run_loop(loop, 5)
+    assert (outcome.ready, outcome.fatal_errors) == (1, 0)
+    # created in index order, round robin over the adapters, once every address is known
+    assert [(i.index, i.adapter_path, i.mac_address) for i in instances] == [
+        (0, ADAPTERS[0], '00:00:00:00:00:00'), (1, ADAPTERS[1], '00:00:00:00:00:01'),
+        (2, ADAPTERS[0], '00:00:00:00:00:00')]
+    assert all(i.prepared and i.steps == ['advertise', 'register_gatt'] for i in instances)
+    for adapter in ADAPTERS:
+        # Discoverable is set once the adapter is powered
+        calls = [call for call in bluez.calls if call[0] == adapter]
+        assert calls.index((adapter, 'Set', bluetooth_constants.ADAPTER_PROP_DISCOVERABLE)) > \
+            calls.index((adapter, 'Set', bluetooth_constants.ADAPTER_PROP_POWER))
+    assert ('/org/bluez', 'RequestDefaultAgent', AGENT_PATH) in bluez.calls
+    phases = instance.timer.phases
+    assert all(end is not None for _, end in phases.values())
+    assert {'clear_devices', 'find_adapters', 'adapter_setup[hci0]', 'adapter_setup[hci1]', 'create_remotes',
+            'register_agent', 'advertise[2]', 'register_gatt[2]'} <= set(phases)
+
+
+def test_one_failing_instance_is_fatal(bluez):
+    def create_instance(index, adapter_path, mac_address):
+        return FakeInstance(index, adapter_path, mac_address, fail_registration=index == 1)
+
+    loop, outcome, instance = start_bringup(2, create_instance)
+    assert run_loop(loop, 5)
+    assert outcome.fatal_errors == 1
+    # the join of the ready phases never completes
+    assert not run_loop(loop, 0.2)
+    assert outcome.ready == 0
+    assert instance.timer.phases['register_gatt[1]'][1] is None
+    assert instance.timer.phases['register_gatt[0]'][1] is not None
+
+
+def test_failed_adapter_setup_starts_no_remote(bluez):
+    bluez.errors[(ADAPTERS[1], 'Set', bluetooth_constants.ADAPTER_PROP_POWER)] = \
+        dbus.exceptions.DBusException('org.bluez.Error.Failed')
+    created = []
+
+    def create_instance(index, adapter_path, mac_address):
+        created.append(index)
+        return FakeInstance(index, adapter_path, mac_address)
+
+    loop, outcome, instance = start_bringup(2, create_instance)
+    assert run_loop(loop, 5)
+    assert outcome.fatal_errors == 1
+    assert not run_loop(loop, 0.2)
+    assert (outcome.ready, outcome.fatal_errors) == (0, 1)
+    assert instance.failed
+    assert created == []
+
+
+def test_timed_out_call_fails_the_bringup(bluez):
+    held = (ADAPTERS[0], 'Set', bluetooth_constants.ADAPTER_PROP_DISCOVERABLE)
+    bluez.held.add(held)
+    instances = []
+
+    def create_instance(index, adapter_path, mac_address):
+        instances.append(FakeInstance(index, adapter_path, mac_address))
+        return instances[-1]
+
+    loop, outcome, instance = start_bringup(2, create_instance)
+    # nothing is ready while the reply is outstanding, the remote of the other adapter is up
+    assert not run_loop(loop, 0.3)
+    assert (outcome.ready, outcome.fatal_errors) == (0, 0)
+    assert instance.timer.phases['adapter_setup[hci0]'][1] is None
+    assert instances[0].steps == []
+    assert instances[1].steps == ['advertise', 'register_gatt']
+    # dbus-python gives up on the call after its timeout
+    bluez.answer(held, no_reply())
+    assert run_loop(loop, 5)
+    assert (outcome.ready, outcome.fatal_errors) == (0, 1)
+    assert instance.failed
+    assert instances[0].steps == []
+
+
+def test_auto_connect_waits_for_the_cleared_devices(bluez, monkeypatch):
+    probed = threading.Event()
+    cleared = threading.Event()
+    provisioned = []
+
+    class FakeProvisioner:
+        def __init__(self, transport):
+            self.transport = transport
+
+        def provision(self, name):
+            provisioned.append((self.transport, name, cleared.is_set()))
+            return 'AA:BB:CC:DD:EE:FF'
+
+        def close(self):
+            pass
+
+    def clear_local_devices():
+        # the ssh probe answers first
+        assert probed.wait(5)
+        cleared.set()
+
+    def check_ssh_connection(provisioner):
+        probed.set()
+        return True
+
+    monkeypatch.setattr(bringup, 'clear_local_devices', clear_local_devices)
+    monkeypatch.setattr(bringup, 'checkSshConnection', check_ssh_connection)
+    monkeypatch.setattr(bringup, 'SshTransport', lambda host: host)
+    monkeypatch.setattr(bringup, 'TvProvisioner', FakeProvisioner)
+    loop, outcome, instance = start_bringup(1, FakeInstance, ip_addresses=['10.0.0.7'])
+    assert run_loop(loop, 5)
+    assert outcome.ready == 1
+    # the provisioning thread may still be running
+    for _ in range(50):
+        if instance.timer.phases.get('auto_connect[10.0.0.7]', [0, None])[1] is not None:
+            break
+        run_loop(loop, 0.1)
+    assert provisioned == [('10.0.0.7', get_discoverable_name(RC_TYPE_SHARP), True)]
+    assert instance.timer.phases['auto_connect[10.0.0.7]'][1] is not None
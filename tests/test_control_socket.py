@@ -0,0 +1,65 @@
+import socket
+import threading
+
+import pytest
+
+pytest.importorskip('gi')
+GLib = pytest.importorskip('gi.repository.GLib')
+
+from control_socket import ControlSocket
+
+
+def send_line(path, line):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(5)
+        client.connect(path)
+        client.sendall((line + '\n').encode())
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    return reply.decode().strip()
+
+
+@pytest.fixture
+def control_socket(tmp_path):
+    control_socket = ControlSocket(str(tmp_path / 'control.sock'))
+    control_socket.start()
+    yield control_socket
+    control_socket.stop()
+
+
+def test_off_loop_command_answers_without_the_loop(control_socket):
+    # no GLib loop runs in this test, as when it is stalled
+    control_socket.add_command('ping', lambda args: 'pong ' + ' '.join(args), on_loop=False)
+    assert send_line(control_socket.path, 'ping a b') == 'OK pong a b'
+    assert send_line(control_socket.path, 'nope') == 'ERR unknown command: nope'
+    assert 'ping' in send_line(control_socket.path, 'help')
+
+
+def test_loop_command_runs_on_the_loop(control_socket):
+    loop = GLib.MainLoop()
+    ran_on = []
+
+    def on_key(args):
+        ran_on.append(threading.current_thread())
+        if not args:
+            raise ValueError('a key is needed')
+        return args[0]
+
+    control_socket.add_command('key', on_key)
+    replies = []
+
+    def client():
+        replies.append(send_line(control_socket.path, 'key KEY_HOME'))
+        replies.append(send_line(control_socket.path, 'key'))
+        GLib.idle_add(loop.quit)
+
+    thread = threading.Thread(target=client)
+    thread.start()
+    loop.run()
+    thread.join(5)
+    assert replies == ['OK KEY_HOME', 'ERR a key is needed']
+    assert ran_on == [threading.main_thread(), threading.main_thread()]
@@ -0,0 +1,132 @@
+import pytest
+
+pytest.importorskip('dbus')
+
+import bluetooth_constants
+import device_state
+from device_state import DeviceStateCache
+
+PATH = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+OTHER_PATH = '/org/bluez/hci0/dev_66_77_88_99_AA_BB'
+
+PAIRED = bluetooth_constants.DEVICE_PROP_PAIRED
+CONNECTED = bluetooth_constants.DEVICE_PROP_CONNECTED
+RESOLVED = bluetooth_constants.DEVICE_PROP_SERVICES_RESOLVED
+
+
+class FakeProperties:
+    def __init__(self, bus, path):
+        self.bus = bus
+        self.path = path
+
+    def GetAll(self, interface, reply_handler, error_handler):
+        assert interface == bluetooth_constants.DEVICE_INTERFACE
+        self.bus.calls.append((self.path, reply_handler, error_handler))
+
+
+class FakeBus:
+    def __init__(self):
+        # GetAll calls in flight, answered by the test
+        self.calls = []
+
+    def reply(self, properties, index=0):
+        path, reply_handler, _ = self.calls.pop(index)
+        reply_handler(properties)
+        return path
+
+    def fail(self, error, index=0):
+        path, _, error_handler = self.calls.pop(index)
+        error_handler(error)
+        return path
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    bus = FakeBus()
+
+    def get_object_interface(path, interface_name, bus_arg=None):
+        assert interface_name == bluetooth_constants.DBUS_PROPERTIES
+        assert bus_arg is bus
+        return FakeProperties(bus, path)
+
+    monkeypatch.setattr(device_state, 'get_object_interface', get_object_interface)
+    return bus
+
+
+@pytest.fixture
+def changes():
+    return []
+
+
+@pytest.fixture
+def cache(bus, changes):
+    return DeviceStateCache(bus, lambda path, state: changes.append((path, dict(state))))
+
+
+def full_state(paired=True, connected=True, resolved=True):
+    return {PAIRED: paired, CONNECTED: connected, RESOLVED: resolved}
+
+
+def test_rssi_only_updates_are_ignored(cache, bus, changes):
+    cache.update(PATH, {'RSSI': -60})
+    cache.update(PATH, {'RSSI': -58, 'TxPower': 4})
+    assert bus.calls == []
+    assert cache.get_state(PATH) is None
+    assert changes == []
+
+
+def test_partial_update_fetches_once_with_signals_in_flight(cache, bus, changes):
+    cache.update(PATH, {CONNECTED: True})
+    cache.update(PATH, {RESOLVED: False})
+    cache.update(PATH, {RESOLVED: True, 'RSSI': -40})
+    assert [call[0] for call in bus.calls] == [PATH]
+    assert changes == []
+    bus.reply(full_state(paired=True, connected=True, resolved=True))
+    assert changes == [(PATH, full_state())]
+    assert PATH not in cache.pending
+    # known now, a change needs no call
+    cache.update(PATH, {CONNECTED: False})
+    assert bus.calls == []
+    assert changes[-1] == (PATH, full_state(connected=False))
+
+
+def test_complete_interfaces_added_needs_no_fetch(cache, bus, changes):
+    cache.update(PATH, dict(full_state(paired=False, connected=True, resolved=False), Address='00:11:22:33:44:55'))
+    assert bus.calls == []
+    assert changes == [(PATH, full_state(paired=False, connected=True, resolved=False))]
+
+
+def test_remove_during_fetch_drops_the_reply(cache, bus, changes):
+    cache.update(PATH, {CONNECTED: True})
+    cache.update(OTHER_PATH, {PAIRED: True})
+    cache.remove(PATH)
+    assert bus.reply(full_state()) == PATH
+    assert cache.get_state(PATH) is None
+    assert changes == []
+    # the other device is not affected
+    bus.reply(full_state(connected=False))
+    assert changes == [(OTHER_PATH, full_state(connected=False))]
+
+
+def test_fetch_error_allows_a_new_fetch(cache, bus, changes):
+    cache.update(PATH, {CONNECTED: True})
+    bus.fail(Exception('org.freedesktop.DBus.Error.UnknownObject'))
+    assert changes == []
+    cache.update(PATH, {CONNECTED: True})
+    assert len(bus.calls) == 1
+    bus.reply(full_state())
+    assert changes == [(PATH, full_state())]
+
+
+def test_state_changed_only_on_transitions(cache, bus, changes):
+    cache.update(PATH, full_state(resolved=False))
+    cache.update(PATH, {CONNECTED: True})
+    cache.update(PATH, {PAIRED: True, RESOLVED: False})
+    assert changes == [(PATH, full_state(resolved=False))]
+    cache.update(PATH, {RESOLVED: True})
+    cache.update(PATH, {RESOLVED: True})
+    assert changes == [(PATH, full_state(resolved=False)), (PATH, full_state())]
+    cache.update(PATH, {CONNECTED: False, RESOLVED: False})
+    assert changes[-1] == (PATH, full_state(connected=False, resolved=False))
+    assert len(changes) == 3
+    assert bus.calls == []
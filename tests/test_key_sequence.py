@@ -0,0 +1,121 @@
+import pytest
+
+import key_sequence
+from key_sequence import DEFAULT_GAP_MS, DEFAULT_HOLD_MS, KeySequencePlayer, KeyStep, parse_key_script
+
+SCRIPT = """
+# warm up
+KEY_HOME                # default hold and gap
+KEY_RIGHT 30 20
+repeat 2
+    KEY_VOLUP 10 10
+    repeat 2
+        KEY_VOLDW 5 0
+    end
+end
+KEY_SEL 2000 500
+"""
+
+
+def test_parse_key_script():
+    steps = parse_key_script(SCRIPT)
+    assert steps == [
+        KeyStep('KEY_HOME', DEFAULT_HOLD_MS / 1000, DEFAULT_GAP_MS / 1000),
+        KeyStep('KEY_RIGHT', 0.03, 0.02),
+        KeyStep('KEY_VOLUP', 0.01, 0.01),
+        KeyStep('KEY_VOLDW', 0.005, 0.0),
+        KeyStep('KEY_VOLDW', 0.005, 0.0),
+        KeyStep('KEY_VOLUP', 0.01, 0.01),
+        KeyStep('KEY_VOLDW', 0.005, 0.0),
+        KeyStep('KEY_VOLDW', 0.005, 0.0),
+        KeyStep('KEY_SEL', 2.0, 0.5),
+    ]
+
+
+def test_parse_checks_the_key_table():
+    key_table = {'KEY_HOME': '01', 'KEY_SEL': '02'}
+    assert len(parse_key_script('KEY_HOME\nKEY_SEL', key_table)) == 2
+    with pytest.raises(ValueError, match='line 2'):
+        parse_key_script('KEY_HOME\nKEY_MENU', key_table)
+
+
+@pytest.mark.parametrize('text', [
+    'end',
+    'repeat 3\nKEY_HOME',
+    'repeat\nKEY_HOME\nend',
+    'repeat x\nKEY_HOME\nend',
+    'KEY_HOME -5',
+    'KEY_HOME 10 abc',
+])
+def test_parse_errors(text):
+    with pytest.raises(ValueError):
+        parse_key_script(text)
+
+
+class FakeScheduler:
+    # runs the armed timer on demand, with the clock jumped to its deadline
+    def __init__(self, clock):
+        self.clock = clock
+        self.pending = None
+
+    def call_at(self, deadline, callback):
+        self.pending = (deadline, callback)
+        return self
+
+    def cancel(self):
+        self.pending = None
+
+    def run(self):
+        while self.pending is not None:
+            deadline, callback = self.pending
+            self.pending = None
+            self.clock.now = max(self.clock.now, deadline)
+            callback()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 50.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(key_sequence, 'time', clock)
+    return clock
+
+
+def test_player_fires_on_absolute_deadlines(clock):
+    events = []
+    scheduler = FakeScheduler(clock)
+    player = KeySequencePlayer(lambda key, pressed: events.append((clock.now - 50.0, key, pressed)),
+                               scheduler)
+    done = []
+    player.play(parse_key_script('KEY_A 10 5\nKEY_B 20 0'), repeat=2, on_done=lambda: done.append(True))
+    scheduler.run()
+    assert [(round(t, 6), key, pressed) for t, key, pressed in events] == [
+        (0.0, 'KEY_A', True), (0.01, 'KEY_A', False),
+        (0.015, 'KEY_B', True), (0.035, 'KEY_B', False),
+        (0.035, 'KEY_A', True), (0.045, 'KEY_A', False),
+        (0.05, 'KEY_B', True), (0.07, 'KEY_B', False),
+    ]
+    assert done == [True]
+    assert not player.is_playing()
+    assert player.get_stats()['events'] == 8
+    assert player.get_stats()['late_max_ms'] == pytest.approx(0.0)
+
+
+def test_stop_releases_the_held_key(clock):
+    events = []
+    scheduler = FakeScheduler(clock)
+    player = KeySequencePlayer(lambda key, pressed: events.append((key, pressed)), scheduler)
+    player.play(parse_key_script('KEY_A 100 0\nKEY_B'))
+    deadline, callback = scheduler.pending
+    callback()
+    assert events == [('KEY_A', True)]
+    player.stop()
+    assert events == [('KEY_A', True), ('KEY_A', False)]
+    assert scheduler.pending is None
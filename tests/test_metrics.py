@@ -0,0 +1,86 @@
+import socket
+import urllib.request
+
+import pytest
+
+from metrics import MetricsRegistry, MetricsServer
+
+
+def test_counter_and_gauge_render():
+    registry = MetricsRegistry()
+    counter = registry.counter('rcu_notifications_total', 'GATT notifications sent', ['characteristic'])
+    counter.labels('Report').inc()
+    counter.labels('Report').inc(2)
+    counter.labels('VoiceRx').inc()
+    gauge = registry.gauge('rcu_queue_depth', 'Voice queue depth')
+    gauge.set(3)
+    assert registry.render() == (
+        '# HELP rcu_notifications_total GATT notifications sent\n'
+        '# TYPE rcu_notifications_total counter\n'
+        'rcu_notifications_total{characteristic="Report"} 3\n'
+        'rcu_notifications_total{characteristic="VoiceRx"} 1\n'
+        '# HELP rcu_queue_depth Voice queue depth\n'
+        '# TYPE rcu_queue_depth gauge\n'
+        'rcu_queue_depth 3\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('rcu_encode_seconds', 'Encode time', buckets=(0.1, 0.01))
+    for value in (0.005, 0.05, 0.05, 1.0):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'rcu_encode_seconds_bucket{le="0.01"} 1',
+        'rcu_encode_seconds_bucket{le="0.1"} 3',
+        'rcu_encode_seconds_bucket{le="+Inf"} 4',
+        'rcu_encode_seconds_sum 1.105',
+        'rcu_encode_seconds_count 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter('rcu_errors_total', 'Errors', ['error']).labels('say "hi"\\\n').inc()
+    assert 'rcu_errors_total{error="say \\"hi\\"\\\\\\n"} 1' in registry.render()
+
+
+def test_gauge_function():
+    registry = MetricsRegistry()
+    registry.gauge('rcu_connected', 'Connected devices').set_function(lambda: 2)
+    assert registry.render().endswith('rcu_connected 2\n')
+
+
+def test_declaring_twice():
+    registry = MetricsRegistry()
+    first = registry.counter('rcu_keys_total', 'Keys', ['rcu'])
+    assert registry.counter('rcu_keys_total', 'Keys', ['rcu']) is first
+    with pytest.raises(ValueError):
+        registry.counter('rcu_keys_total', 'Keys', ['rcu', 'codec'])
+    with pytest.raises(ValueError):
+        first.labels('sharp', 'opus')
+
+
+def test_server_http_and_unix(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter('rcu_keys_total', 'Keys').inc()
+    server = MetricsServer(registry)
+    unix_path = str(tmp_path / 'metrics.sock')
+    server.start_http('127.0.0.1', 0)
+    server.start_unix(unix_path)
+    try:
+        port = server.servers[0].server_address[1]
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            assert response.read().decode() == registry.render()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(5)
+            client.connect(unix_path)
+            data = b''
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        assert data.decode() == registry.render()
+    finally:
+        server.stop()
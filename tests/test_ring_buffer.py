@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from ring_buffer import ByteRingBuffer, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST
+
+
+def test_wraps_around():
+    ring = ByteRingBuffer(8)
+    assert ring.write(b'abcdef') == 6
+    assert ring.read(4) == b'abcd'
+    assert ring.write(b'ghijkl') == 6
+    assert len(ring) == 8
+    assert ring.read(8) == b'efghijkl'
+    assert len(ring) == 0
+
+
+def test_drop_oldest_keeps_the_newest_bytes():
+    ring = ByteRingBuffer(8, OVERFLOW_DROP_OLDEST)
+    ring.write(b'012345')
+    ring.write(b'6789')
+    assert ring.dropped_bytes == 2
+    assert ring.read(8) == b'23456789'
+    # a write larger than the whole buffer keeps its tail
+    ring.write(b'abcdefghijkl')
+    assert ring.read(8) == b'efghijkl'
+    assert ring.dropped_bytes == 6
+
+
+def test_block_times_out_when_full():
+    ring = ByteRingBuffer(4, OVERFLOW_BLOCK)
+    assert ring.write(b'abcdef', timeout=0.01) == 4
+    assert ring.dropped_bytes == 0
+    assert ring.read(4) == b'abcd'
+
+
+def test_read_returns_what_is_left_after_close():
+    ring = ByteRingBuffer(16)
+    ring.write(b'abc')
+    ring.close()
+    assert ring.is_closed()
+    assert ring.read(8) == b'abc'
+    assert ring.read(8) == b''
+    assert ring.write(b'x') == 0
+
+
+def test_close_discard_drops_pending_data():
+    ring = ByteRingBuffer(16)
+    ring.write(b'abc')
+    ring.close(discard=True)
+    assert ring.read(3) == b''
+
+
+def test_producer_consumer_threads():
+    data = bytes(range(256)) * 64
+    ring = ByteRingBuffer(100, OVERFLOW_BLOCK)
+    received = bytearray()
+
+    def consume():
+        while True:
+            chunk = ring.read(37)
+            if not chunk:
+                break
+            received.extend(chunk)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    for offset in range(0, len(data), 61):
+        ring.write(data[offset:offset + 61])
+    ring.close()
+    consumer.join(5)
+    assert not consumer.is_alive()
+    assert bytes(received) == data
+
+
+def test_bad_arguments():
+    with pytest.raises(ValueError):
+        ByteRingBuffer(0)
+    with pytest.raises(ValueError):
+        ByteRingBuffer(8, 'grow')
@@ -0,0 +1,105 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from sampling_profiler import SamplingProfiler, add_control_commands
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def busy_voice_work(stop_event):
+    while not stop_event.is_set():
+        sum(range(1000))
+
+
+def run_busy_thread():
+    stop_event = threading.Event()
+    thread = threading.Thread(target=busy_voice_work, args=(stop_event,), name='BusyVoiceConsumer')
+    thread.start()
+    return stop_event, thread
+
+
+def test_capture_of_a_busy_thread(tmp_path):
+    path = str(tmp_path / 'busy.collapsed')
+    stop_event, thread = run_busy_thread()
+    profiler = SamplingProfiler(interval=0.002)
+    try:
+        assert profiler.start(0.2, path) == path
+        profiler.thread.join(5)
+    finally:
+        stop_event.set()
+        thread.join()
+    assert not profiler.is_running()
+    with open(path) as f:
+        lines = f.read().splitlines()
+    busy = [line for line in lines if line.startswith('BusyVoiceConsumer;')]
+    assert busy
+    assert all('test_sampling_profiler.py:busy_voice_work' in line for line in busy)
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in busy) > 10
+
+
+def test_toggle_stops_an_active_capture(tmp_path):
+    profiler = SamplingProfiler()
+    profiler.start(60, str(tmp_path / 'long.collapsed'))
+    assert profiler.is_running()
+    profiler.toggle()
+    profiler.thread.join(5)
+    assert not profiler.is_running()
+    assert os.path.exists(tmp_path / 'long.collapsed')
+
+
+class CommandTable:
+    def __init__(self):
+        self.commands = {}
+
+    def add_command(self, name, handler, usage=None, on_loop=True):
+        self.commands[name] = (handler, on_loop)
+
+
+def test_profile_command_does_not_need_the_loop(tmp_path):
+    profiler = SamplingProfiler()
+    table = CommandTable()
+    add_control_commands(table, profiler, duration=60)
+    handler, on_loop = table.commands['profile']
+    assert not on_loop
+    path = str(tmp_path / 'command.collapsed')
+    assert handler(['5', path]) == path
+    assert profiler.is_running()
+    assert handler(['stop']) == path
+    profiler.thread.join(5)
+    assert not profiler.is_running()
+    with pytest.raises(ValueError):
+        handler(['stop'])
+    with pytest.raises(ValueError):
+        handler(['0'])
+
+
+SIGNAL_SCRIPT = '''
+import os, signal, sys, threading, time
+import sampling_profiler
+profiler = sampling_profiler.SamplingProfiler()
+sampling_profiler.install_signal_handler(profiler, duration=0.2)
+# the main thread stands for a stalled loop, the capture starts without its help
+os.kill(os.getpid(), signal.SIGUSR1)
+deadline = time.monotonic() + 5
+while profiler.thread is None or profiler.is_running():
+    if time.monotonic() > deadline:
+        sys.exit(2)
+print(profiler.output_path)
+'''
+
+
+def test_sigusr1_starts_a_capture_while_the_main_thread_spins(tmp_path):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    result = subprocess.run([sys.executable, '-c', SIGNAL_SCRIPT], cwd=str(tmp_path), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=30)
+    assert result.returncode == 0, result.stderr
+    path = result.stdout.strip()
+    try:
+        with open(path) as f:
+            assert 'MainThread;<string>:<module>' in f.read()
+    finally:
+        os.unlink(path)
@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('gi')
+GLib = pytest.importorskip('gi.repository.GLib')
+
+from timer_scheduler import TimerScheduler
+
+
+def run_loop(scheduler, seconds):
+    loop = GLib.MainLoop()
+    scheduler.call_later(seconds, loop.quit)
+    loop.run()
+
+
+def test_fires_in_deadline_order_never_early():
+    scheduler = TimerScheduler()
+    fired = []
+
+    def on_timer(name, deadline):
+        fired.append((name, time.monotonic() >= deadline))
+
+    now = time.monotonic()
+    for name, delay in (('c', 0.03), ('a', 0.01), ('b', 0.02)):
+        scheduler.call_at(now + delay, on_timer, name, now + delay)
+    run_loop(scheduler, 0.05)
+    assert fired == [('a', True), ('b', True), ('c', True)]
+    assert len(scheduler) == 0
+
+
+def test_equal_deadlines_keep_their_order():
+    scheduler = TimerScheduler()
+    fired = []
+    deadline = time.monotonic() + 0.01
+    for i in range(5):
+        scheduler.call_at(deadline, fired.append, i)
+    run_loop(scheduler, 0.03)
+    assert fired == [0, 1, 2, 3, 4]
+
+
+def test_cancel():
+    scheduler = TimerScheduler()
+    fired = []
+    first = scheduler.call_later(0.01, fired.append, 'first')
+    scheduler.call_later(0.02, fired.append, 'second')
+    # cancelled by another timer before it is due
+    later = scheduler.call_later(0.02, fired.append, 'third')
+    scheduler.call_later(0.015, later.cancel)
+    first.cancel()
+    assert len(scheduler) == 3
+    run_loop(scheduler, 0.04)
+    assert fired == ['second']
+
+
+def test_call_from_another_thread():
+    scheduler = TimerScheduler()
+    fired = []
+    thread = threading.Thread(target=lambda: scheduler.call_later(0.01, fired.append, 'thread'))
+    thread.start()
+    thread.join()
+    run_loop(scheduler, 0.03)
+    assert fired == ['thread']
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from tv_provisioning import (LocalTransport, ProvisioningError, TvProvisioner, clear_local_devices,
+                             parse_devices, run_batch)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_BLUETOOTHCTL = os.path.join(REPO_ROOT, 'benchmarks', 'fake_bluetoothctl')
+
+
+def test_parse_devices():
+    output = '\n'.join([
+        'Device 00:00:00:00:B1:E0 RCU 0',
+        '  Device AA:BB:CC:DD:EE:FF VEWDT5W remote  ',
+        'Device 11:22:33:44:55:66',
+        '[CHG] Device 00:00:00:00:B1:E0 RSSI: -40',
+        'Device 00:00:00:00:B1 too short',
+        'Discovery started',
+    ])
+    assert parse_devices(output) == [
+        ('00:00:00:00:B1:E0', 'RCU 0'),
+        ('AA:BB:CC:DD:EE:FF', 'VEWDT5W remote'),
+        ('11:22:33:44:55:66', ''),
+    ]
+
+
+def test_run_batch_keeps_every_result():
+    results = run_batch(LocalTransport(), [
+        'echo one',
+        'printf "two\\nlines\\n"',
+        'echo failed >&2; false',
+        'true',
+    ])
+    assert results == [(0, 'one'), (0, 'two\nlines'), (1, 'failed'), (0, '')]
+
+
+def test_run_batch_interrupted():
+    with pytest.raises(ProvisioningError, match='interrupted'):
+        run_batch(LocalTransport(), ['echo one', 'exit 3', 'echo never'])
+
+
+@pytest.fixture
+def fake_bluez(tmp_path):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    os.symlink(FAKE_BLUETOOTHCTL, bin_dir / 'bluetoothctl')
+    state_dir = tmp_path / 'state'
+    state_dir.mkdir()
+    env = dict(os.environ)
+    env['PATH'] = f'{bin_dir}{os.pathsep}{env["PATH"]}'
+    env['FAKE_BT_STATE'] = str(state_dir)
+    env['FAKE_BT_REMOTES'] = '00:00:00:00:B1:E0 RCU 0'
+    return env, state_dir
+
+
+def test_parse_devices_of_fake_bluetoothctl(fake_bluez):
+    env, state_dir = fake_bluez
+    (state_dir / 'known').write_text('Device 00:00:00:00:00:01 VEWDT5W\nDevice 00:00:00:00:00:02 TV\n')
+    (_, output), = run_batch(LocalTransport(env=env), ['bluetoothctl -- devices'])
+    assert parse_devices(output) == [('00:00:00:00:00:01', 'VEWDT5W'), ('00:00:00:00:00:02', 'TV')]
+
+
+def test_provision_against_fake_bluetoothctl(fake_bluez):
+    env, state_dir = fake_bluez
+    (state_dir / 'known').write_text('Device 00:00:00:00:00:01 old remote\n')
+    (state_dir / 'paired').write_text('Device 00:00:00:00:00:01 old remote\n')
+    provisioner = TvProvisioner(LocalTransport(env=env))
+    provisioner.clear()
+    assert (state_dir / 'paired').read_text() == ''
+    assert provisioner.pair('RCU 0', interval=0.1) == '00:00:00:00:B1:E0'
+    assert (state_dir / 'paired').read_text() == 'Device 00:00:00:00:B1:E0 RCU 0\n'
+
+
+def test_pair_gives_up(fake_bluez):
+    env, _ = fake_bluez
+    provisioner = TvProvisioner(LocalTransport(env=env))
+    with pytest.raises(ProvisioningError, match='not found'):
+        provisioner.pair('RCU 9', attempts=3, interval=0.1)
+
+
+def test_clear_local_devices(fake_bluez):
+    env, state_dir = fake_bluez
+    (state_dir / 'known').write_text('Device 00:00:00:00:00:01 VEWDT5W\nDevice 00:00:00:00:00:02 TV\n')
+    clear_local_devices(LocalTransport(env=env), restart_bluetooth=False)
+    assert (state_dir / 'known').read_text() == 'Device 00:00:00:00:00:02 TV\n'
@@ -0,0 +1,36 @@
+import pytest
+
+from voice_codecs import (CODEC_ADPCM_16K, CODEC_ADPCM_8K, CODEC_OPUS, CODECS,
+                          DEFAULT_CODEC_PREFERENCE, parse_codec_names)
+
+
+def test_parse_codec_names():
+    assert parse_codec_names('opus, adpcm16k') == (CODEC_OPUS, CODEC_ADPCM_16K)
+    with pytest.raises(ValueError):
+        parse_codec_names('adpcm8k,mp3')
+
+
+def test_negotiate_first_shared_codec():
+    codec = CODECS.negotiate(CODEC_ADPCM_8K | CODEC_ADPCM_16K, DEFAULT_CODEC_PREFERENCE)
+    assert codec.codec_id == CODEC_ADPCM_16K
+    codec = CODECS.negotiate(CODEC_ADPCM_8K | CODEC_ADPCM_16K, (CODEC_ADPCM_8K, CODEC_ADPCM_16K))
+    assert codec.codec_id == CODEC_ADPCM_8K
+
+
+def test_negotiate_falls_back_to_adpcm_8k():
+    assert CODECS.negotiate(0, (CODEC_ADPCM_16K,)).codec_id == CODEC_ADPCM_8K
+
+
+def test_opus_only_when_available():
+    opus = CODECS.get(CODEC_OPUS)
+    codec = CODECS.negotiate(CODEC_OPUS | CODEC_ADPCM_8K, DEFAULT_CODEC_PREFERENCE)
+    expected = CODEC_OPUS if opus.is_available() else CODEC_ADPCM_8K
+    assert codec.codec_id == expected
+    mask = CODECS.get_mask((CODEC_OPUS, CODEC_ADPCM_8K))
+    assert bool(mask & CODEC_OPUS) == opus.is_available()
+
+
+def test_adpcm_encoder_frame_size():
+    codec = CODECS.get(CODEC_ADPCM_16K)
+    frame = codec.create_encoder().encode(bytes(codec.frame_pcm_bytes))
+    assert len(frame) == 128
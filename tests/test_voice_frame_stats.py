@@ -0,0 +1,66 @@
+import struct
+
+import pytest
+
+from voice_frame_stats import (FRAME_AFTER_GAP, FRAME_IN_ORDER, FRAME_LATE, JITTER_BUCKETS_MS,
+                               VoiceFrameStats, parse_tivo_frame_header)
+
+
+def test_parse_tivo_frame_header():
+    frame = struct.pack('>H', 0x1234) + b'\x00' + struct.pack('>h', -300) + b'\x2a' + bytes(128)
+    assert parse_tivo_frame_header(frame) == (0x1234, 0, -300, 42)
+
+
+def test_gaps_and_late_frames():
+    stats = VoiceFrameStats()
+    results = [stats.on_frame(seq) for seq in (10, 11, 14, 12, 15, 15, 20)]
+    assert results == [FRAME_IN_ORDER, FRAME_IN_ORDER, FRAME_AFTER_GAP, FRAME_LATE,
+                       FRAME_IN_ORDER, FRAME_LATE, FRAME_AFTER_GAP]
+    assert stats.frames == 5
+    assert stats.lost_frames == 2 + 4
+    assert stats.gaps == 2
+    assert stats.late_frames == 2
+    assert stats.get_loss_rate() == pytest.approx(6 / 11)
+
+
+def test_sequence_wraps_around():
+    stats = VoiceFrameStats()
+    results = [stats.on_frame(seq) for seq in (0xfffe, 0xffff, 0, 2, 0xffff)]
+    assert results == [FRAME_IN_ORDER, FRAME_IN_ORDER, FRAME_IN_ORDER, FRAME_AFTER_GAP, FRAME_LATE]
+    assert stats.lost_frames == 1
+
+
+def test_inter_arrival_jitter_and_throughput():
+    stats = VoiceFrameStats()
+    for rx_time in (1.0, 1.008, 1.023, 1.032, 1.057):
+        stats.on_notification(rx_time, 100)
+    assert stats.get_duration() == pytest.approx(0.057)
+    assert stats.get_throughput() == pytest.approx(500 / 0.057)
+    # intervals 8, 15, 9 and 25 ms
+    assert stats.inter_arrival_max == pytest.approx(0.025)
+    assert stats.get_jitter() == pytest.approx(0.0067593, rel=1e-4)
+    histogram = dict(zip(JITTER_BUCKETS_MS, stats.jitter_histogram))
+    assert histogram[10] == 2
+    assert histogram[20] == 1
+    assert histogram[30] == 1
+    assert sum(stats.jitter_histogram) == 4
+
+
+def test_empty_stats_report():
+    stats = VoiceFrameStats()
+    assert stats.get_loss_rate() == 0.0
+    assert stats.get_throughput() == 0.0
+    assert stats.get_jitter() == 0.0
+    report = stats.format_report()
+    assert report.startswith('notifications: 0, bytes: 0')
+    assert 'loss rate: 0.00 %' in report
+
+
+def test_reset():
+    stats = VoiceFrameStats()
+    stats.on_notification(1.0, 20)
+    stats.on_frame(5)
+    stats.reset()
+    assert stats.notifications == 0
+    assert stats.on_frame(100) == FRAME_IN_ORDER
+    assert stats.lost_frames == 0
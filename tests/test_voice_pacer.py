@@ -0,0 +1,76 @@
+import pytest
+
+import voice_pacer
+from voice_pacer import FramePacer, PACING_FAST, PACING_REALTIME
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(voice_pacer, 'time', clock)
+    return clock
+
+
+def test_for_pcm_frame_duration():
+    # 512 bytes of 16 bit mono PCM at 8 kHz
+    assert FramePacer.for_pcm(512, 8000, 2).frame_duration == pytest.approx(0.032)
+
+
+def test_realtime_sleeps_to_absolute_deadlines(clock):
+    pacer = FramePacer(0.02, PACING_REALTIME)
+    pacer.wait()
+    assert clock.sleeps == []
+    # the work of a frame is taken from the next sleep, it does not add up
+    for _ in range(3):
+        clock.now += 0.005
+        pacer.wait()
+    assert clock.sleeps == pytest.approx([0.015, 0.015, 0.015])
+    assert clock.now == pytest.approx(100.06)
+    assert pacer.get_stats() == {'frames': 4, 'late_frames': 0, 'resyncs': 0}
+
+
+def test_late_frame_is_caught_up(clock):
+    pacer = FramePacer(0.02, PACING_REALTIME, max_lag_frames=4)
+    pacer.wait()
+    clock.now += 0.03
+    pacer.wait()
+    pacer.wait()
+    assert clock.sleeps == pytest.approx([0.01])
+    assert pacer.get_stats()['late_frames'] == 1
+
+
+def test_resync_after_a_long_stall(clock):
+    pacer = FramePacer(0.02, PACING_REALTIME, max_lag_frames=4)
+    pacer.wait()
+    clock.now += 1.0
+    pacer.wait()
+    assert pacer.get_stats()['resyncs'] == 1
+    # re-anchored to now, no burst of the missed frames
+    pacer.wait()
+    assert clock.sleeps == pytest.approx([0.02])
+
+
+def test_fast_never_sleeps(clock):
+    pacer = FramePacer(0.02, PACING_FAST)
+    assert not pacer.is_realtime()
+    for _ in range(10):
+        pacer.wait()
+    assert clock.sleeps == []
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        FramePacer(0.02, 'slow')
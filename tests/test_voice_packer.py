@@ -0,0 +1,69 @@
+import pytest
+
+from voice_packer import ATT_MAX_MTU, VoiceFramePacker, get_option_mtu
+from voice_stream import FrameReassembler
+
+FRAME_LENGTH = 134
+
+
+def make_frames(count, length=FRAME_LENGTH):
+    return [bytes((i + j) & 0xff for j in range(length)) for i in range(count)]
+
+
+def test_default_mtu_payload():
+    notifications = []
+    packer = VoiceFramePacker(notifications.append)
+    assert packer.get_payload_size() == 20
+    packer.add_frame(bytes(50))
+    assert [len(n) for n in notifications] == [20, 20]
+    packer.flush()
+    assert [len(n) for n in notifications] == [20, 20, 10]
+
+
+@pytest.mark.parametrize('mtus', [[23], [185], [517], [23, 247, 64, 517, 100]])
+def test_lossless_reassembly(mtus):
+    notifications = []
+    packer = VoiceFramePacker(notifications.append)
+    frames = make_frames(40)
+    for i, frame in enumerate(frames):
+        # the MTU may change in the middle of a stream
+        if i % 10 == 0:
+            packer.set_mtu(mtus[(i // 10) % len(mtus)])
+        packer.add_frame(frame)
+    packer.flush()
+    assert all(len(n) <= ATT_MAX_MTU - 3 for n in notifications)
+
+    received = []
+    reassembler = FrameReassembler(FRAME_LENGTH)
+    for notification in notifications:
+        reassembler.feed(notification, received.append)
+    assert received == frames
+    assert reassembler.get_pending_length() == 0
+
+
+def test_send_frame_is_frame_aligned():
+    notifications = []
+    packer = VoiceFramePacker(notifications.append, mtu=50)
+    packer.send_frame(bytes(30))
+    packer.send_frame(bytes(100))
+    assert [len(n) for n in notifications] == [30, 47, 47, 6]
+
+
+def test_fixed_payload_size_ignores_a_larger_mtu():
+    packer = VoiceFramePacker(lambda data: None, mtu=100)
+    assert packer.fix_payload_size() == 97
+    packer.set_mtu(247)
+    assert packer.get_payload_size() == 97
+    # a smaller MTU still has to be honored
+    packer.set_mtu(50)
+    assert packer.get_payload_size() == 47
+
+
+def test_mtu_from_options():
+    assert get_option_mtu(None) is None
+    assert get_option_mtu({'device': '/org/bluez/hci0/dev_00'}) is None
+    packer = VoiceFramePacker(lambda data: None)
+    packer.update_mtu({'mtu': 1000})
+    assert packer.mtu == ATT_MAX_MTU
+    packer.update_mtu({'mtu': 5})
+    assert packer.get_payload_size() == 20
@@ -0,0 +1,261 @@
+import array
+import math
+import os
+import random
+import struct
+import threading
+import wave
+
+import pytest
+
+import voice_stream
+from adpcm_codec import AdpcmDecoder, AdpcmEncoder
+from voice_frame_stats import FRAME_AFTER_GAP, FRAME_LATE, VoiceFrameStats, parse_tivo_frame_header
+from voice_stream import (ADPCM_FRAME_PAYLOAD_SIZE, TIVO_FRAME_HEADER_SIZE, FifoPlaybackSink, FrameReassembler,
+                          LivePlayback, StreamingWavDecoder, make_playback_sink)
+
+SAMPLE_RATE = 8000
+FRAME_LENGTH = TIVO_FRAME_HEADER_SIZE + ADPCM_FRAME_PAYLOAD_SIZE
+
+
+def make_pcm(frames=30):
+    samples = frames * ADPCM_FRAME_PAYLOAD_SIZE * 2
+    return array.array('h', (int(9000 * math.sin(i / 5.0) + 3000 * math.sin(i / 37.0))
+                             for i in range(samples))).tobytes()
+
+
+def make_tivo_frames(pcm):
+    # framed as tivo_rcu/ble_voice_service.py sends them
+    frames = []
+    for seq, (state, adpcm_data) in enumerate(AdpcmEncoder().encode_frames(pcm, ADPCM_FRAME_PAYLOAD_SIZE)):
+        frames.append(struct.pack('>HBhB', seq, 0x00, state[0], state[1]) + adpcm_data)
+    return frames
+
+
+def random_chunks(data, seed):
+    rnd = random.Random(seed)
+    offset = 0
+    while offset < len(data):
+        size = rnd.randint(1, 250)
+        yield data[offset:offset + size]
+        offset += size
+
+
+def read_wave(path):
+    with wave.open(str(path), 'rb') as f:
+        return f.getnchannels(), f.getsampwidth(), f.getframerate(), f.getnframes(), f.readframes(f.getnframes())
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_streamed_frames_decode_like_the_whole_stream(tmp_path, seed):
+    frames = make_tivo_frames(make_pcm())
+    stream = b''.join(frames)
+    decoder = StreamingWavDecoder(str(tmp_path / 'voice.adpcm'), str(tmp_path / 'voice.wav'), SAMPLE_RATE)
+    reassembler = FrameReassembler(FRAME_LENGTH)
+    received = []
+
+    def on_frame(frame):
+        received.append(frame)
+        decoder.write_frame(memoryview(frame)[TIVO_FRAME_HEADER_SIZE:])
+
+    for chunk in random_chunks(stream, seed):
+        reassembler.feed(chunk, on_frame)
+    decoder.close()
+    assert received == frames
+    assert reassembler.get_pending_length() == 0
+    assert decoder.frames == len(frames)
+
+    adpcm = b''.join(frame[TIVO_FRAME_HEADER_SIZE:] for frame in frames)
+    expected_pcm = AdpcmDecoder().decode(adpcm)
+    channels, sample_width, sample_rate, nframes, data = read_wave(tmp_path / 'voice.wav')
+    assert (channels, sample_width, sample_rate) == (1, 2, SAMPLE_RATE)
+    assert nframes == len(adpcm) * 2
+    assert data == expected_pcm
+    with open(tmp_path / 'voice.adpcm', 'rb') as f:
+        assert f.read() == adpcm
+
+
+def test_reassembler_keeps_a_partial_frame():
+    reassembler = FrameReassembler(4)
+    frames = []
+    reassembler.feed(b'abcdef', frames.append)
+    assert frames == [b'abcd']
+    assert reassembler.get_pending_length() == 2
+    reassembler.reset(3)
+    reassembler.feed(b'xyz', frames.append)
+    assert frames == [b'abcd', b'xyz']
+
+
+def decode_received(tmp_path, frames, resync):
+    # the ble_worker / decoder_worker path of voice-main.py
+    decoder = StreamingWavDecoder(str(tmp_path / 'voice.adpcm'), str(tmp_path / 'voice.wav'), SAMPLE_RATE)
+    stats = VoiceFrameStats()
+    for frame in frames:
+        seq, _, predictor, index = parse_tivo_frame_header(frame)
+        status = stats.on_frame(seq)
+        if status == FRAME_LATE:
+            continue
+        payload = frame[TIVO_FRAME_HEADER_SIZE:]
+        if resync and status == FRAME_AFTER_GAP:
+            decoder.write_frame(payload, (predictor, index))
+        else:
+            decoder.write_frame(payload)
+    decoder.close()
+    return stats, read_wave(tmp_path / 'voice.wav')[4]
+
+
+def test_resync_after_a_gap(tmp_path):
+    frames = make_tivo_frames(make_pcm())
+    full_pcm = AdpcmDecoder().decode(b''.join(frame[TIVO_FRAME_HEADER_SIZE:] for frame in frames))
+    frame_pcm_size = ADPCM_FRAME_PAYLOAD_SIZE * 2 * 2
+    # frames 10 to 12 lost, frame 5 repeated late
+    received = frames[:10] + frames[13:20] + [frames[5]] + frames[20:]
+    kept = list(range(10)) + list(range(13, len(frames)))
+    expected = b''.join(full_pcm[i * frame_pcm_size:(i + 1) * frame_pcm_size] for i in kept)
+
+    stats, pcm = decode_received(tmp_path, received, resync=True)
+    assert stats.lost_frames == 3
+    assert stats.late_frames == 1
+    # from the header state the frames after the gap decode as if nothing was lost
+    assert pcm == expected
+
+    _, pcm = decode_received(tmp_path, received, resync=False)
+    assert pcm[:10 * frame_pcm_size] == expected[:10 * frame_pcm_size]
+    assert pcm != expected
+
+
+class ListSink:
+    def __init__(self):
+        self.written = []
+
+    def write(self, pcm):
+        self.written.append(bytes(pcm))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(voice_stream.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def pcm_frame(n):
+    return bytes([n]) * 8
+
+
+def start_playback(jitter_frames=3):
+    sink = ListSink()
+    playback = LivePlayback(sink, jitter_frames)
+    playback.start()
+    return playback, sink
+
+
+def test_pre_roll_holds_output_until_the_jitter_depth(clock):
+    playback, sink = start_playback(jitter_frames=3)
+    playback.push(pcm_frame(1))
+    playback.push(pcm_frame(2))
+    playback.queue.join()
+    assert sink.written == []
+    playback.push(pcm_frame(3))
+    playback.queue.join()
+    assert sink.written == [pcm_frame(1), pcm_frame(2), pcm_frame(3)]
+    # once playing every frame goes straight to the sink
+    playback.push(pcm_frame(4))
+    playback.queue.join()
+    assert sink.written[-1] == pcm_frame(4)
+
+
+def test_underrun_plays_late_frames_without_buffering_again(clock):
+    playback, sink = start_playback(jitter_frames=2)
+    for n in range(1, 4):
+        playback.push(pcm_frame(n))
+    playback.queue.join()
+    # the queue ran dry, the next frame is played as soon as it arrives
+    clock.now += 1.0
+    playback.push(pcm_frame(4))
+    playback.queue.join()
+    assert sink.written == [pcm_frame(n) for n in range(1, 5)]
+
+
+def test_short_utterance_is_flushed_and_the_next_one_buffers_again(clock):
+    playback, sink = start_playback(jitter_frames=3)
+    playback.push(pcm_frame(1))
+    playback.end_utterance()
+    playback.queue.join()
+    assert sink.written == [pcm_frame(1)]
+    assert playback.get_latency() is None
+    playback.push(pcm_frame(2))
+    playback.push(pcm_frame(3))
+    playback.queue.join()
+    assert sink.written == [pcm_frame(1)]
+    playback.end_utterance()
+    playback.queue.join()
+    assert sink.written == [pcm_frame(n) for n in range(1, 4)]
+
+
+def test_latency_from_the_first_rx_notification(clock):
+    playback, sink = start_playback(jitter_frames=2)
+    playback.mark_rx()
+    clock.now += 0.030
+    # later notifications of the same utterance do not move the start
+    playback.mark_rx()
+    playback.push(pcm_frame(1))
+    playback.queue.join()
+    clock.now += 0.015
+    playback.push(pcm_frame(2))
+    playback.queue.join()
+    assert playback.get_latency() == pytest.approx(0.045)
+    clock.now += 0.500
+    playback.push(pcm_frame(3))
+    playback.queue.join()
+    assert playback.get_latency() == pytest.approx(0.045)
+    playback.end_utterance()
+    playback.rx_ended()
+    playback.queue.join()
+
+    clock.now += 2.0
+    playback.mark_rx()
+    clock.now += 0.020
+    playback.push(pcm_frame(4))
+    playback.push(pcm_frame(5))
+    playback.queue.join()
+    assert playback.get_latency() == pytest.approx(0.020)
+
+
+def test_fifo_sink_feeds_a_reader(tmp_path):
+    path = str(tmp_path / 'playback.fifo')
+    sink = make_playback_sink('fifo:' + path, 8000)
+    assert isinstance(sink, FifoPlaybackSink)
+    received = []
+
+    def reader():
+        with open(path, 'rb') as f:
+            received.append(f.read())
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    playback = LivePlayback(sink, jitter_frames=1)
+    playback.start()
+    data = os.urandom(70000)
+    playback.push(data[:30000])
+    playback.push(data[30000:])
+    playback.end_utterance()
+    playback.queue.join()
+    sink.close()
+    thread.join(5)
+    assert received == [data]
+
+
+def test_unknown_playback_sink():
+    with pytest.raises(ValueError):
+        make_playback_sink('fifo', 8000)
+    with pytest.raises(ValueError):
+        make_playback_sink('pulse', 8000)
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""
+One-shot timers for the whole process on a heap, served by a single GLib timeout that is
+always armed for the earliest deadline. Timers can be added and cancelled from any thread,
+callbacks run on the GLib main loop thread.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+from gi.repository import GLib
+
+
+class TimerHandle:
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # lazy deletion, the heap entry is dropped when it reaches the top
+        self.cancelled = True
+
+
+class TimerScheduler:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # [(deadline, sequence, TimerHandle)], sequence keeps equal deadlines in FIFO order
+        self.heap = []
+        self.sequence = itertools.count()
+        self.source_id = None
+        self.armed_deadline = None
+        # identifies the armed source, a replaced source may still be dispatching
+        self.generation = 0
+
+    def call_at(self, deadline, callback, *args):
+        # deadline is on the time.monotonic() clock
+        handle = TimerHandle(deadline, callback, args)
+        with self.lock:
+            heapq.heappush(self.heap, (deadline, next(self.sequence), handle))
+            if self.armed_deadline is None or deadline < self.armed_deadline:
+                self.arm()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for _, _, handle in self.heap if not handle.cancelled)
+
+    def arm(self):
+        # called with the lock held
+        if self.source_id is not None:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
+            self.armed_deadline = None
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        # round up, a GLib timeout must not fire before the deadline
+        delay_ms = max(0, math.ceil((deadline - time.monotonic()) * 1000))
+        self.armed_deadline = deadline
+        self.generation += 1
+        self.source_id = GLib.timeout_add(delay_ms, self.onTimeout, self.generation)
+
+    def onTimeout(self, generation):
+        due = []
+        with self.lock:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                _, _, handle = heapq.heappop(self.heap)
+                if not handle.cancelled:
+                    due.append(handle)
+            if generation == self.generation:
+                self.source_id = None
+                self.armed_deadline = None
+                self.arm()
+        for handle in due:
+            # a callback may cancel a timer due in the same batch
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                print(f'TimerScheduler, timer callback {handle.callback} failed: {e}')
+        return False
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = TimerScheduler()
+        return _default_scheduler
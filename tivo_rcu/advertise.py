@@ -18,7 +18,7 @@ class TiVoS4KRCUAdvertisement(Advertisement):
         manufacturer_data_string = f"{device_name}_{version_code}"
         return manufacturer_id, bytes(manufacturer_data_string, "utf-8")
     
-    def __init__(self, bus, mac_address, index):
+    def __init__(self, bus, mac_address, index, local_name=None):
         Advertisement.__init__(self, bus, self.BASE_PATH, index, "peripheral")
         self.add_service_uuid(tivo_rcu.ble_hogp.HIDService.SERVICE_UUID)
         self.add_service_uuid(tivo_rcu.ble_hogp.BatteryService.SERVICE_UUID)
@@ -27,6 +27,6 @@ class TiVoS4KRCUAdvertisement(Advertisement):
         id, data = self.make_manufacturer_data()
         self.add_manufacturer_data(id, data)
         self.mac_address = mac_address
-        self.add_local_name(self.DISCOVERABLE_NAME)
+        self.add_local_name(local_name or self.DISCOVERABLE_NAME)
         self.add_discoverable(True)
         self.include_tx_power = True
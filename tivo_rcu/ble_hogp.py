@@ -4,6 +4,9 @@ import bluetooth_constants
 from gi.repository import GLib
 from ble_base import Descriptor, Characteristic, Service
 import tivo_rcu.key_table_constants as ktc
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class BatteryLevelCharacteristic(Characteristic):
@@ -25,8 +28,7 @@ class BatteryLevelCharacteristic(Characteristic):
         self.battery_lvl = 100
 
     def notify_battery_level(self):
-        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, {
-                               'Value': [dbus.Byte(self.battery_lvl)]}, [])
+        self.NotifyValue(bytes([self.battery_lvl]))
         self.notifyCnt += 1
 
     def drain_battery(self):
@@ -46,24 +48,24 @@ class BatteryLevelCharacteristic(Characteristic):
         return True
 
     def ReadValue(self, options):
-        print('Battery Level read: ' + repr(self.battery_lvl))
+        logger.info('Battery Level read: %r', self.battery_lvl)
         return [dbus.Byte(self.battery_lvl)]
 
     def StartNotify(self):
-        print('BatteryLevelCharacteristic.StartNotify')
+        logger.info('BatteryLevelCharacteristic.StartNotify')
 
         if self.notifying:
-            print('BatteryLevelCharacteristic already notifying, nothing to do')
+            logger.info('BatteryLevelCharacteristic already notifying, nothing to do')
             return
 
         self.notifying = True
         self.timer = GLib.timeout_add(1000, self.drain_battery)
 
     def StopNotify(self):
-        print('BatteryLevelCharacteristic StopNotify')
+        logger.info('BatteryLevelCharacteristic StopNotify')
 
         if not self.notifying:
-            print('BatteryLevelCharacteristic not notifying, nothing to do')
+            logger.info('BatteryLevelCharacteristic not notifying, nothing to do')
             return
 
         self.notifying = False
@@ -74,11 +76,11 @@ class BatteryService(Service):
     Fake Battery service that emulates a draining battery.
 
     """
-    PATH_BASE = bluetooth_constants.BLUEZ_OBJ_ROOT + "batt_service"
+    PATH_NAME = "batt_service"
     SERVICE_UUID = '180f'
 
-    def __init__(self, bus):
-        Service.__init__(self, bus, self.PATH_BASE, self.SERVICE_UUID, True)
+    def __init__(self, bus, obj_root=bluetooth_constants.BLUEZ_OBJ_ROOT):
+        Service.__init__(self, bus, obj_root + self.PATH_NAME, self.SERVICE_UUID, True)
         self.add_characteristic(BatteryLevelCharacteristic(bus, 0, self))
 
 
@@ -106,7 +108,7 @@ class ManufacturerNameCharacteristic(Characteristic):
             self.MANUFACTURER_NAME.encode(), signature=dbus.Signature('y'))
 
     def ReadValue(self, options):
-        print(f'Read RCU Manufacturer Name : {self.value}')
+        logger.debug('Read RCU Manufacturer Name : %s', self.value)
         return self.value
 
 
@@ -135,7 +137,7 @@ class ModelNumberCharacteristic(Characteristic):
             self.MODEL_NUMBER.encode(), signature=dbus.Signature('y'))
 
     def ReadValue(self, options):
-        print(f'Read ModelNumberCharacteristic: {self.value}')
+        logger.debug('Read ModelNumberCharacteristic: %s', self.value)
         return self.value
 
 
@@ -165,17 +167,17 @@ class VersionCharacteristic(Characteristic):
             self.VERSION_NUMBER.encode(), signature=dbus.Signature('y'))
 
     def ReadValue(self, options):
-        print(f'Read VersionCharacteristic: {self.value}')
+        logger.debug('Read VersionCharacteristic: %s', self.value)
         return self.value
 
 
 class DeviceInfoService(Service):
 
     SERVICE_UUID = '180A'
-    PATH_BASE = bluetooth_constants.BLUEZ_OBJ_ROOT + "device_info_service"
+    PATH_NAME = "device_info_service"
 
-    def __init__(self, bus):
-        Service.__init__(self, bus, self.PATH_BASE, self.SERVICE_UUID, True)
+    def __init__(self, bus, obj_root=bluetooth_constants.BLUEZ_OBJ_ROOT):
+        Service.__init__(self, bus, obj_root + self.PATH_NAME, self.SERVICE_UUID, True)
         self.add_characteristic(ManufacturerNameCharacteristic(bus, 0, self))
         self.add_characteristic(ModelNumberCharacteristic(bus, 1, self))
         self.add_characteristic(VersionCharacteristic(bus, 2, self))
@@ -197,11 +199,11 @@ class ProtocolModeCharacteristic(Characteristic):
             '01'), signature=dbus.Signature('y'))
 
     def ReadValue(self, options):
-        print(f'Read ProtocolMode ..')
+        logger.debug('Read ProtocolMode ..')
         return self.value
 
     def WriteValue(self, value, options):
-        print(f'Write ProtocolMode {value}')
+        logger.info('Write ProtocolMode %s', value)
         self.value = value
 
 
@@ -222,7 +224,7 @@ class HIDInfoCharacteristic(Characteristic):
             '01010002'), signature=dbus.Signature('y'))
 
     def ReadValue(self, options):
-        print(f'Read HIDInformation ..')
+        logger.debug('Read HIDInformation ..')
         return self.value
 
 
@@ -241,7 +243,7 @@ class ControlPointCharacteristic(Characteristic):
             '00'), signature=dbus.Signature('y'))
 
     def WriteValue(self, value, options):
-        print(f'Write ControlPoint {value}')
+        logger.info('Write ControlPoint %s', value)
         self.value = value
 
 
@@ -263,7 +265,7 @@ class ReportMapCharacteristic(Characteristic):
         self.value = dbus.Array(report_map)
 
     def ReadValue(self, options):
-        print(f'Read ReportMap: {self.value}')
+        logger.debug('Read ReportMap: %s', self.value)
         return self.value
 
 
@@ -308,7 +310,7 @@ class ReportDescriptor(Descriptor):
         self.value = dbus.Array(compose_value, signature=dbus.Signature('y'))
 
     def ReadValue(self, options):
-        print(f'Read {self.report_name} Descriptor with value {self.value}')
+        logger.debug('Read %s Descriptor with value %s', self.report_name, self.value)
         return self.value
 
 
@@ -330,48 +332,39 @@ class ReportCharacteristic(Characteristic):
         self.add_descriptor(ReportDescriptor(
             bus, 1, self, self.report_name, report_id))
         self.value = [dbus.Byte(0) * self.report_length]
+        # shared by every key of this report
+        self.release_payload = dbus.ByteArray(bytes(self.report_length))
 
-    def send(self, key_codes, pressed):
-        full_key_code = []
-        if pressed:
-            key_codes_byte_array = bytearray.fromhex(key_codes)
-            full_key_code = [dbus.Byte(key_code_byte)
-                             for key_code_byte in key_codes_byte_array]
-        else:  # released
-            full_key_code = [dbus.Byte(0x00)
-                             for _ in range(self.report_length)]
-
-        print(
-            f'ReportCharacteristic [{self.report_name}], send full_key_code: {full_key_code}')
-        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, {
-                               'Value': full_key_code}, [])
-        print(f'ReportCharacteristic [{self.report_name}], sent')
-        return True
+    # Ready-made D-Bus payload of a key code, see HIDService.compileKeyDispatch().
+    def compilePayload(self, key_codes):
+        return dbus.ByteArray(bytes.fromhex(key_codes))
+
+    def sendPayload(self, payload):
+        self.NotifyValue(payload)
 
     # This is not be read while service registered by central
     def ReadValue(self, options):
-        print(f'Read ReportCharacteristic [{self.report_name}] ..')
+        logger.debug('Read ReportCharacteristic [%s] ..', self.report_name)
         return self.value
 
     # This is supposed not to be workable while central write value directly
     def WriteValue(self, value, options):
-        print(f'Write ReportCharacteristic [{self.report_name}] {value}')
+        logger.info('Write ReportCharacteristic [%s] %s', self.report_name, value)
         self.value = value
 
     def StartNotify(self):
-        print(
-            f'ReportCharacteristic [{self.report_name}] StartNotify() called')
+        logger.info('ReportCharacteristic [%s] StartNotify() called', self.report_name)
 
     def StopNotify(self):
-        print(f'ReportCharacteristic [{self.report_name}] StopNotify() called')
+        logger.info('ReportCharacteristic [%s] StopNotify() called', self.report_name)
 
 
 class HIDService(Service):
     SERVICE_UUID = '1812'
-    PATH_BASE = bluetooth_constants.BLUEZ_OBJ_ROOT + "hid_service"
+    PATH_NAME = "hid_service"
 
-    def __init__(self, bus, key_descriptor_obj):
-        Service.__init__(self, bus, self.PATH_BASE, self.SERVICE_UUID, True)
+    def __init__(self, bus, key_descriptor_obj, obj_root=bluetooth_constants.BLUEZ_OBJ_ROOT):
+        Service.__init__(self, bus, obj_root + self.PATH_NAME, self.SERVICE_UUID, True)
         self.key_descriptor_obj = key_descriptor_obj
 
         index = 0
@@ -405,8 +398,25 @@ class HIDService(Service):
                 self.add_characteristic(report_char)
                 self.report_characteristics[report_key] = report_char
 
+        self.key_dispatch = self.compileKeyDispatch()
+
+    # Resolve the key table once: {key name: (report characteristic, press payload, release payload)},
+    # so a key event is a single lookup and a single PropertiesChanged emit.
+    def compileKeyDispatch(self):
+        key_dispatch = {}
+        if self.key_descriptor_obj is None or ktc.KEY_TABLE not in self.key_descriptor_obj:
+            return key_dispatch
+        for key_name, key_info in self.key_descriptor_obj[ktc.KEY_TABLE].items():
+            report_char = self.report_characteristics.get(key_info.get(ktc.REFER_TO_HID_REPORT, None), None)
+            if report_char is None:
+                continue
+            key_dispatch[key_name] = (report_char,
+                                      report_char.compilePayload(key_info[ktc.KEY_CODE]),
+                                      report_char.release_payload)
+        return key_dispatch
+
     def onKeyEvent(self, key_name, pressed):
-        key_info = self.key_descriptor_obj[ktc.KEY_TABLE][key_name]
-        if ktc.REFER_TO_HID_REPORT in key_info and key_info[ktc.REFER_TO_HID_REPORT] in self.report_characteristics:
-            dest_rc = self.report_characteristics[key_info[ktc.REFER_TO_HID_REPORT]]
-            dest_rc.send(key_info[ktc.KEY_CODE], pressed)
+        dispatch = self.key_dispatch.get(key_name, None)
+        if dispatch is not None:
+            report_char, press_payload, release_payload = dispatch
+            report_char.sendPayload(press_payload if pressed else release_payload)
@@ -1,11 +1,24 @@
 #!/usr/bin/python3
-import audioop
 import bluetooth_constants
-from ble_base import Characteristic, Service
+from adpcm_codec import AdpcmEncoder
+from ble_base import Characteristic, AcquireNotifyCharacteristic, Service
 import dbus.service
 from gi.repository import GLib
 import struct
+import time
+from voice_pacer import PACING_REALTIME
 from tivo_rcu.voice_source import DataState, VoiceSource
+import logging
+from rcu_log import HexBytes
+from metrics import REGISTRY
+from voice_packer import VoiceFramePacker
+
+logger = logging.getLogger(__name__)
+
+VOICE_FRAMES_ENCODED = REGISTRY.counter('rcu_voice_frames_encoded_total',
+                                        'PCM chunks encoded to voice frames', ['rcu', 'codec'])
+VOICE_ENCODE_SECONDS = REGISTRY.histogram('rcu_voice_encode_seconds',
+                                          'Time to encode one PCM chunk', ['rcu', 'codec'])
 
 TV_TX_GET_CAPS = 0x0A
 TV_TX_MIC_OPEN = 0x0C
@@ -33,20 +46,21 @@ class TivoTvTxCharacteristic(Characteristic):
             '01'), signature=dbus.Signature('y'))
 
     def ReadValue(self, options):
-        print(f'TivoTvTxCharacteristic.ReadValue')
+        logger.info('TivoTvTxCharacteristic.ReadValue')
+        self.parent.packer.update_mtu(options)
         return self.value
 
     def WriteValue(self, value, options):
-        print(f'TivoTvTxCharacteristic.WriteValue, value = : {value}')
+        logger.info('TivoTvTxCharacteristic.WriteValue, value = : %s', value)
         self.parent.HandleTvTx(value, options)
 
 
-class TivoTvRxCharacteristic(Characteristic):
+class TivoTvRxCharacteristic(AcquireNotifyCharacteristic):
     CHARACTERISTIC_UUID = 'ab5e0003-5a21-4f05-bc7d-af01f617b664'
 
     def __init__(self, bus, index, service):
 
-        Characteristic.__init__(
+        AcquireNotifyCharacteristic.__init__(
             self, bus, index,
             self.CHARACTERISTIC_UUID,
             ['notify'],
@@ -56,16 +70,19 @@ class TivoTvRxCharacteristic(Characteristic):
         self.value = dbus.Array(bytearray.fromhex(
             '01'), signature=dbus.Signature('y'))
 
+    # the voice frames are written to the acquired socket, packed to its MTU
+    def onNotifyAcquired(self, mtu):
+        self.parent.packer.set_mtu(mtu)
+
     def StartNotify(self):
-        print('TivoTvRxCharacteristic.StartNotify')
+        logger.info('TivoTvRxCharacteristic.StartNotify')
 
     def StopNotify(self):
-        print('TivoTvRxCharacteristic.StopNotify')
+        logger.info('TivoTvRxCharacteristic.StopNotify')
 
-    def Notify(self, obj):
-        # print(f'TivoTvRxCharacteristic.Notify, obj = {obj}')
-        self.PropertiesChanged(
-            bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, obj, [])
+    def Notify(self, value):
+        # print(f'TivoTvRxCharacteristic.Notify, value = {HexBytes(value)}')
+        self.NotifyValue(value)
 
 
 class TivoTvCtlCharacteristic(Characteristic):
@@ -84,25 +101,24 @@ class TivoTvCtlCharacteristic(Characteristic):
             '01'), signature=dbus.Signature('y'))
 
     def StartNotify(self):
-        print('TivoTvCtlCharacteristic.StartNotify')
+        logger.info('TivoTvCtlCharacteristic.StartNotify')
 
     def StopNotify(self):
-        print('TivoTvCtlCharacteristic.StopNotify')
+        logger.info('TivoTvCtlCharacteristic.StopNotify')
 
-    def Notify(self, obj):
-        print(f'TivoTvCtlCharacteristic.Notify, obj = {obj}')
-        self.PropertiesChanged(
-            bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, obj, [])
+    def Notify(self, value):
+        logger.debug('TivoTvCtlCharacteristic.Notify, value = %s', HexBytes(value))
+        self.NotifyValue(value)
 
 
 class VoiceService(Service):
     SERVICE_UUID = 'ab5e0001-5a21-4f05-bc7d-af01f617b664'
-    PATH_BASE = bluetooth_constants.BLUEZ_OBJ_ROOT + "tivo_voice_service"
+    PATH_NAME = "tivo_voice_service"
 
-    def __init__(self, bus, tivo_ruc_dlg):
-        Service.__init__(self, bus, self.PATH_BASE, self.SERVICE_UUID, True)
+    def __init__(self, bus, tivo_ruc_dlg, voice_pacing=PACING_REALTIME, obj_root=bluetooth_constants.BLUEZ_OBJ_ROOT):
+        Service.__init__(self, bus, obj_root + self.PATH_NAME, self.SERVICE_UUID, True)
 
-        self.voice_source = VoiceSource(tivo_ruc_dlg, self.onPCMData)
+        self.voice_source = VoiceSource(tivo_ruc_dlg, self.onPCMData, voice_pacing)
 
         self.tivo_tv_tx_char = TivoTvTxCharacteristic(bus, 0, self)
         self.add_characteristic(self.tivo_tv_tx_char)
@@ -113,80 +129,74 @@ class VoiceService(Service):
         self.tivo_tv_ctl_char = TivoTvCtlCharacteristic(bus, 2, self)
         self.add_characteristic(self.tivo_tv_ctl_char)
 
+        # voice frames to notifications of the negotiated MTU
+        self.packer = VoiceFramePacker(self.tivo_tv_rx_char.Notify)
+
         # stuff to encode to ADPCM
+        self.adpcm_encoder = AdpcmEncoder()
+        self.setEncodeMetrics(1)
         self.resetEncodeADPCMState()
 
+    # the encode metrics of the ADPCM rate requested by MIC_OPEN
+    def setEncodeMetrics(self, mic_open_params):
+        codec_name = 'adpcm16k' if mic_open_params == 2 else 'adpcm8k'
+        self.encoded_frames = VOICE_FRAMES_ENCODED.labels('tivo', codec_name)
+        self.encode_seconds = VOICE_ENCODE_SECONDS.labels('tivo', codec_name)
+
     def resetEncodeADPCMState(self):
-        self.state = (0, 0x00)
+        self.adpcm_encoder.reset()
+        self.packer.reset()
         self.seq = 0
 
-    # split the adpcm data into chunks with each one 20 bytes,
-    def NotifyADPCMPktWithHeaderWithChunks(self, adpcm_packet_with_header):
-        # separate the adpcm data into chunks with each one 20 bytes,
-        # and send it sequentially, each chunk will be notified to the client.
-        adpcm_chunk_size = 20
-        adpcm_data_len = len(adpcm_packet_with_header)
-        chunk_num = adpcm_data_len // adpcm_chunk_size
-        idx_chunk = 0
-        while idx_chunk < chunk_num:
-            chunk = adpcm_packet_with_header[idx_chunk *
-                                             adpcm_chunk_size:(idx_chunk+1)*adpcm_chunk_size]
-            # self.tivo_tv_rx_char.Notify({'Value': chunk})
-            self.tivo_tv_rx_char.Notify({'Value': chunk})
-            idx_chunk += 1
-
-        # send the last chunk
-        chunk = adpcm_packet_with_header[idx_chunk *
-                                         adpcm_chunk_size:adpcm_data_len]
-        self.tivo_tv_rx_char.Notify({'Value': chunk})
-
+    # the 134 bytes frames fill the notifications of bytes_per_char bytes announced in the caps response
     def NotifyADPCMPktWithHeader(self, adpcm_packet_with_header):
-        self.tivo_tv_rx_char.Notify({'Value': adpcm_packet_with_header})
+        self.packer.add_frame(adpcm_packet_with_header)
 
     # receive PCM data from the voice source, encode it to adpcm data and send it to the client.
     # will ended incase receive 0 bytes from the voice source.
     def onPCMData(self, data_state, read_pcm_frames):
-        print(
-            f'VoiceService.onPCMData called, data_state = {data_state}')
+        logger.debug('VoiceService.onPCMData called, data_state = %s', data_state)
         if data_state == DataState.BEGIN:
             # todo: send begin notification
-            print(
-                f'VoiceService.onPCMData begin to send pcmdata, data_state = {data_state}')
+            logger.info('VoiceService.onPCMData begin to send pcmdata, data_state = %s', data_state)
             self.resetEncodeADPCMState()
         elif data_state == DataState.END:
-            print(
-                f'VoiceService.onPCMData end, will send end to client')
+            logger.info('VoiceService.onPCMData end, will send end to client')
+            # the rest of the last frames goes before the end
+            self.packer.flush()
             # send the end notification
             audio_end_byte = struct.pack('>B', RCU_CTL_AUDIO_END)
-            dbus_audio_end_byte = [dbus.Byte(audio_end_byte)]
-            self.tivo_tv_ctl_char.Notify({'Value': dbus_audio_end_byte})
+            self.tivo_tv_ctl_char.Notify(audio_end_byte)
         elif data_state == DataState.SENDING_DATA:
             if len(read_pcm_frames) > 0:
                 # adpcm_data_with_header will append 6 bytes header and 128 bytes adpcm data.
                 # header structure: [seq hi, seq lo, rcuid, pre predict hi, pre predict lo, pre index]
                 adpcm_header_bytes = struct.pack(
-                    '>H', self.seq) + struct.pack('B', 0x00) + struct.pack('>h', self.state[0]) + struct.pack('B', self.state[1])
-                adpcm_data_with_header = [
-                    dbus.Byte(b) for b in adpcm_header_bytes]
+                    '>H', self.seq) + struct.pack('B', 0x00) + struct.pack('>h', self.adpcm_encoder.valpred) + struct.pack('B', self.adpcm_encoder.index)
                 self.seq += 1
 
                 # encode the pcm data to adpcm data
-                adpcm_data, self.state = audioop.lin2adpcm(
-                    read_pcm_frames, self.voice_source.getSampleWidth(), self.state)
-                print(
-                    f'VoiceService.onPCMData, read pcm ok, encoded to ADPCM, len = {len(adpcm_data)}')
-                adpcm_data_with_header.extend(
-                    [dbus.Byte(b) for b in adpcm_data])
-                self.NotifyADPCMPktWithHeader(adpcm_data_with_header)
+                encode_start = time.perf_counter()
+                adpcm_data = self.adpcm_encoder.encode(read_pcm_frames)
+                self.encode_seconds.observe(time.perf_counter() - encode_start)
+                self.encoded_frames.inc()
+                logger.debug('VoiceService.onPCMData, read pcm ok, encoded to ADPCM, len = %s',
+                             len(adpcm_data))
+                self.NotifyADPCMPktWithHeader(adpcm_header_bytes + adpcm_data)
             else:
-                print(
-                    f'VoiceService.onPCMData receiving data error, len(read_pcm_frames) <= 0!')
+                logger.warning('VoiceService.onPCMData receiving data error, len(read_pcm_frames) <= 0!')
+        elif data_state == DataState.SENDING_ADPCM_DATA:
+            # read_pcm_frames is an already framed packet (6 bytes header + 128 bytes ADPCM data)
+            # from the asset cache
+            self.seq += 1
+            self.NotifyADPCMPktWithHeader(read_pcm_frames)
 
     def HandleTvTx(self, value, options):
-        print(f'HandleTvTx called, value = {value}')
+        logger.debug('HandleTvTx called, value = %s', value)
+        self.packer.update_mtu(options)
         command_val = value[0]
         if int(command_val) == TV_TX_GET_CAPS:
-            print(f'HandleTvTx, will handle get caps..')
+            logger.debug('HandleTvTx, will handle get caps..')
             get_cap_resp_byte = struct.pack('>B', RCU_CTL_GET_CAP_RESP)
             version = 4
             version_bytes = struct.pack('>H', version)
@@ -194,16 +204,16 @@ class VoiceService(Service):
             codec_bytes = struct.pack('>H', codec)
             bytes_per_frame = 134
             bytes_per_frame_bytes = struct.pack('>H', bytes_per_frame)
-            bytes_per_char = 20
+            # the TV reassembles with this size, a later MTU change must not alter it
+            bytes_per_char = self.packer.fix_payload_size()
             bytes_per_char_bytes = struct.pack('>H', bytes_per_char)
 
             get_cap_resp = get_cap_resp_byte + version_bytes + codec_bytes + \
                 bytes_per_frame_bytes + bytes_per_char_bytes
-            dbus_get_cap_resp = [dbus.Byte(b) for b in get_cap_resp]
-            self.tivo_tv_ctl_char.Notify({'Value': dbus_get_cap_resp})
-            print(f'HandleTvTx, handle get caps end')
+            self.tivo_tv_ctl_char.Notify(get_cap_resp)
+            logger.debug('HandleTvTx, handle get caps end')
         elif int(command_val) == TV_TX_MIC_OPEN:
-            print(f'HandleTvTx, will handle mic open..')
+            logger.debug('HandleTvTx, will handle mic open..')
             # There are 2 cases here, one is the mic open successful with intended parameters,
             # would response with audio start, the other is the mic open failed and response
             # with error code. Both are notified by self.tivo_tv_ctl_char.
@@ -212,26 +222,25 @@ class VoiceService(Service):
             # mic_open_params = 2: ADPCM (16Khz/16bit)
             mic_open_params = (int)(value[2])
             if mic_open_params == 1:
-                print(f'HandleTvTx, mic_open_params:ADPCM (8Khz/16bit)')
+                logger.debug('HandleTvTx, mic_open_params:ADPCM (8Khz/16bit)')
             elif mic_open_params == 2:
-                print(f'HandleTvTx, mic_open_params:ADPCM (16Khz/16bit)')
+                logger.debug('HandleTvTx, mic_open_params:ADPCM (16Khz/16bit)')
 
             # Todo:error case is not implemented yet
             mic_open_resp = struct.pack('>B', RCU_CTL_AUDIO_START)
-            dbus_mic_open_resp = [dbus.Byte(mic_open_resp)]
-            self.tivo_tv_ctl_char.Notify({'Value': dbus_mic_open_resp})
+            self.tivo_tv_ctl_char.Notify(mic_open_resp)
 
             # start to capture voice with worker thread, will receive pcm data from
             # the callback onPCMData
+            self.setEncodeMetrics(mic_open_params)
             self.voice_source.startCaptureVoice(mic_open_params)
-            print(f'HandleTvTx, handle mic open end')
+            logger.debug('HandleTvTx, handle mic open end')
 
         elif int(command_val) == TV_TX_MIC_CLOSE:
-            print(f'HandleTvTx, handle mic close end')
+            logger.debug('HandleTvTx, handle mic close end')
 
-        print(f'HandleTvTx end')
+        logger.debug('HandleTvTx end')
 
     def VoiceSearch(self):
         start_search_byte = struct.pack('>B', RCU_CTL_START_SEARCH)
-        dbus_start_search_byte = [dbus.Byte(start_search_byte)]
-        self.tivo_tv_ctl_char.Notify({'Value': dbus_start_search_byte})
+        self.tivo_tv_ctl_char.Notify(start_search_byte)
@@ -4,6 +4,10 @@ from key_detector import KeyDetector
 from tivo_rcu.tivo_rcu_ui import Ui_TivoRcuDlg
 import tivo_rcu.key_table_constants as ktc
 import os
+import logging
+
+logger = logging.getLogger(__name__)
+
 
 class TivoRcuDlg(QtWidgets.QDialog):
     def __init__(self, key_event_listener, capture_keyboard_listener, key_descriptor_obj):
@@ -86,28 +90,28 @@ class TivoRcuDlg(QtWidgets.QDialog):
         self.setCaptureByFile(True)
 
     def handlePress(self, key_name):
-        print(f'handlePress, key_name = {key_name}')
+        logger.debug('handlePress, key_name = %s', key_name)
         self.key_event_listener(key_name, True)
 
     def handleRelease(self, key_name):
-        print(f'handleRelease, key_name = {key_name}')
+        logger.debug('handleRelease, key_name = %s', key_name)
         self.key_event_listener(key_name, False)
 
     def handleClick(self, key_name):
-        print(f'handleClick, key_name = {key_name}')
+        logger.debug('handleClick, key_name = %s', key_name)
         self.key_event_listener(key_name, True)
         self.key_event_listener(key_name, False)
 
     def onPressed(self):
         sender = self.sender()
         key_name = sender.objectName()
-        print('onPressed, key_name = ' + sender.objectName())
+        logger.debug('onPressed, key_name = %s', key_name)
         self.key_detector.onPressed(key_name)
 
     def onReleased(self):
         sender = self.sender()
         key_name = sender.objectName()
-        print('onReleased, key_name = ' + sender.objectName())
+        logger.debug('onReleased, key_name = %s', key_name)
         self.key_detector.onReleased(key_name)
 
     def captureKeyboardClicked(self):
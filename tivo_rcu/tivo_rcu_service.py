@@ -2,18 +2,25 @@
 import dbus.service
 import bluetooth_constants
 import bluetooth_utils
+from ble_base import build_managed_objects
 from gi.repository import GLib
 from tivo_rcu.ble_hogp import DeviceInfoService, BatteryService, HIDService
-from key_event_monitor import KeyEventMonitor
-from tivo_rcu.tivo_rcu import TivoRcuDlg
+from headless_dlg import HeadlessRcuDlg
 from tivo_rcu.ble_voice_service import VoiceService
 import json
+from voice_pacer import PACING_REALTIME
 
 
 class TivoRCUService(dbus.service.Object):
-    def __init__(self, bus, exit_listener):
-        self.path = '/'
+    # obj_root is the object path namespace of this remote, several remotes in one process need
+    # distinct roots. key_events is a shared rcu_instance.KeyEventRouter, None to own a monitor.
+    # headless replaces the Qt dialog by a HeadlessRcuDlg, PyQt5 is then never imported.
+    def __init__(self, bus, exit_listener, voice_pacing=PACING_REALTIME,
+                 obj_root=bluetooth_constants.BLUEZ_OBJ_ROOT, key_events=None, headless=False):
+        self.path = '/' if obj_root == bluetooth_constants.BLUEZ_OBJ_ROOT else obj_root.rstrip('/')
         self.services = []
+        # GetManagedObjects response, built on the first call and dropped when a service is added
+        self.managed_objects = None
         dbus.service.Object.__init__(self, bus, self.path)
 
         # Prepare json object, load configuration from json file.
@@ -21,20 +28,30 @@ class TivoRCUService(dbus.service.Object):
         with open('./tivo_rcu/tivo_rcu_descriptor.json', 'r') as f:
             key_descriptor_obj = json.load(f) 
 
-        self.hid_service = HIDService(bus, key_descriptor_obj)
+        self.hid_service = HIDService(bus, key_descriptor_obj, obj_root)
         self.add_service(self.hid_service)
 
         # Prepare voice service
-        self.tivo_ruc_dlg = TivoRcuDlg(
-            self.onKeyEvent, self.onCaptureKeyboard, key_descriptor_obj)
-        self.voice_service = VoiceService(bus, self.tivo_ruc_dlg)
+        if headless:
+            self.tivo_ruc_dlg = HeadlessRcuDlg(
+                self.onKeyEvent, self.onCaptureKeyboard, key_descriptor_obj)
+        else:
+            from tivo_rcu.tivo_rcu import TivoRcuDlg
+            self.tivo_ruc_dlg = TivoRcuDlg(
+                self.onKeyEvent, self.onCaptureKeyboard, key_descriptor_obj)
+        self.voice_service = VoiceService(bus, self.tivo_ruc_dlg, voice_pacing, obj_root)
         self.add_service(self.voice_service)
-        self.add_service(DeviceInfoService(bus))
-        self.add_service(BatteryService(bus))
+        self.add_service(DeviceInfoService(bus, obj_root))
+        self.add_service(BatteryService(bus, obj_root))
 
         self.connected_device_path = None
-        self.KeyEventMonitor = KeyEventMonitor(self.onKeyEvent, self.onExit)
-        self.KeyEventMonitor.start()
+        if key_events is None:
+            # the keyboard package hooks the input devices, only loaded for a remote of its own
+            from key_event_monitor import KeyEventMonitor
+            self.KeyEventMonitor = KeyEventMonitor(self.onKeyEvent, self.onExit)
+            self.KeyEventMonitor.start()
+        else:
+            self.KeyEventMonitor = key_events.attach(self.onKeyEvent, self.onExit)
 
         self.exit_listener = exit_listener
 
@@ -46,6 +63,7 @@ class TivoRCUService(dbus.service.Object):
 
     def add_service(self, service):
         self.services.append(service)
+        self.managed_objects = None
 
     # The Object Manager interface method GetManagedObjects is exported. This makes the
     # method available to be called by other DBus applications, in our case the BlueZ bluetooth
@@ -53,19 +71,12 @@ class TivoRCUService(dbus.service.Object):
     # implemented by our application and results in DBus objects for each being registered on the
     # system bus.
     @dbus.service.method(bluetooth_constants.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    # The object tree does not change after construction, so the response is built once and
+    # served as is on every (re-)registration.
     def GetManagedObjects(self):
-        response = {}
-
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-
-        return response
+        if self.managed_objects is None:
+            self.managed_objects = build_managed_objects(self.services)
+        return self.managed_objects
 
     def set_connected_device(self, device_path):
         self.connected_device_path = device_path
@@ -77,6 +88,9 @@ class TivoRCUService(dbus.service.Object):
     def get_connected_device(self):
         return self.connected_device_path
 
+    def get_rcu_dlg(self):
+        return self.tivo_ruc_dlg
+
     def onExit(self):
         print(f"onExit begin")
         connected_device = self.get_connected_device()
@@ -1,11 +1,19 @@
 #!/usr/bin/python3
-from tivo_rcu.tivo_rcu import TivoRcuDlg
 import wave
 import os
 from enum import Enum
 import threading
 import time
-import alsaaudio
+from ring_buffer import ByteRingBuffer, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST
+from voice_pacer import FramePacer, PACING_REALTIME
+from adpcm_asset_cache import load_asset, FRAME_FORMAT_TIVO
+import logging
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+VOICE_QUEUE_DEPTH = REGISTRY.gauge('rcu_voice_ring_buffer_bytes',
+                                   'PCM bytes buffered between the voice producer and consumer', ['rcu'])
 
 ENCODE_ADPCM_CHUNK_SIZE = 128
 ENCODE_PCM_TO_ADPCM_FAC = 4
@@ -14,198 +22,195 @@ ENCODE_ADPCM_SAMPLE_RATE_16k = 16000
 ENCODE_ADPCM_CHANNELS = 1
 ENCODE_ADPCM_SAMPLE_WIDTH = 2
 RECORD_SECONDS = 6
+VOICE_PRODUCER_THREAD_NAME = 'VoiceProducer'
+VOICE_CONSUMER_THREAD_NAME = 'VoiceConsumer'
+# capacity of the PCM ring buffer between the producer and the consumer thread
+RING_BUFFER_SECONDS = 2
+# framing of the pre-encoded packets the voice service notifies as they are
+ADPCM_FRAME_FORMAT = FRAME_FORMAT_TIVO
 
 
 class DataState(Enum):
     BEGIN = 0
     SENDING_DATA = 1
     END = 2
+    # pre-encoded ADPCM packet from the asset cache, to be notified as it is
+    SENDING_ADPCM_DATA = 3
 
 
 class VoiceSource:
 
-    def __init__(self, tivo_ruc_dlg, onPCMDataCb):
+    def __init__(self, tivo_ruc_dlg, onPCMDataCb, voice_pacing=PACING_REALTIME):
         self.tivo_ruc_dlg = tivo_ruc_dlg
         self.mic_open_params = 1
-        self.condition = None
-        self.read_frames_list = []
+        self.voice_pacing = voice_pacing
+        self.pacer = None
+        self.ring_buffer = None
         self.capture_end = True
         self.onPCMDataCb = onPCMDataCb
+        self.consumeThread = None
+        self.produceThread = None
+        self.queue_depth = VOICE_QUEUE_DEPTH.labels('tivo')
 
     def getSampleWidth(self):
         return ENCODE_ADPCM_SAMPLE_WIDTH
 
+    def getPCMChunkSize(self):
+        return ENCODE_ADPCM_CHUNK_SIZE * ENCODE_PCM_TO_ADPCM_FAC
+
+    # mic_open_params = 1: ADPCM (8Khz/16bit)
+    # mic_open_params = 2: ADPCM (16Khz/16bit)
+    def getSampleRate(self):
+        if self.mic_open_params == 2:
+            return ENCODE_ADPCM_SAMPLE_RATE_16k
+        return ENCODE_ADPCM_SAMPLE_RATE_8k
+
     def consumePCM(self):
-        print(f"VoiceSource.consumePCM begin")
+        logger.info('VoiceSource.consumePCM begin')
+        ring_buffer = self.ring_buffer
+        pacer = self.pacer
         if self.onPCMDataCb != None:
             self.onPCMDataCb(DataState.BEGIN, None)
+        pcm_chunk_size = self.getPCMChunkSize()
         while True:
-            temp_read_frames_list = None
-            temp_capture_end = False
-            with self.condition:
-                while self.capture_end == False and len(self.read_frames_list) == 0:
-                    print(f"VoiceSource.consumePCM wait")
-                    self.condition.wait()
-                    print(
-                        f"VoiceSource.consumePCM wake in loop, self.capture_end = {self.capture_end}, len(self.read_frames_list) = {len(self.read_frames_list)}")
-
-                len_read_frames_list = len(self.read_frames_list)
-                temp_read_frames_list = [self.read_frames_list.pop(
-                    0) for i in range(len_read_frames_list)]
-                temp_capture_end = self.capture_end
-
-            if temp_read_frames_list != None and self.onPCMDataCb != None:
-                for frames in temp_read_frames_list:
-                    self.onPCMDataCb(DataState.SENDING_DATA, frames)
-
-            if temp_capture_end == True:
+            # blocks until a whole chunk is buffered, returns a short read once the producer has
+            # closed the ring buffer and an empty one when it is drained.
+            read_frames = ring_buffer.read(pcm_chunk_size)
+            self.queue_depth.set(len(ring_buffer))
+            if len(read_frames) == 0:
                 break
+            # a file is read much faster than real time, release its frames at the codec rate
+            if pacer != None:
+                pacer.wait()
+            if self.onPCMDataCb != None:
+                self.onPCMDataCb(DataState.SENDING_DATA, read_frames)
 
         if self.onPCMDataCb != None:
             self.onPCMDataCb(DataState.END, None)
 
-    def producePCMByCapture(self):
-        sample_rate = ENCODE_ADPCM_SAMPLE_RATE_8k
-        if self.mic_open_params == 1:
-            sample_rate = ENCODE_ADPCM_SAMPLE_RATE_8k
-        elif self.mic_open_params == 2:
-            sample_rate = ENCODE_ADPCM_SAMPLE_RATE_16k
-
-        pcm_frame_size = ENCODE_ADPCM_SAMPLE_WIDTH * ENCODE_ADPCM_CHANNELS
-        expected_pcm_frames_num = ENCODE_ADPCM_CHUNK_SIZE * \
-            ENCODE_PCM_TO_ADPCM_FAC // pcm_frame_size
-
-        # 初始化錄音
-        audio = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK,
-                              channels=ENCODE_ADPCM_CHANNELS, rate=sample_rate, format=alsaaudio.PCM_FORMAT_S16_LE,
-                              periodsize=expected_pcm_frames_num, device='plughw:CARD=PCH,DEV=0')
+    def consumeADPCMAsset(self, asset):
+        logger.info('VoiceSource.consumeADPCMAsset begin, frames = %s', len(asset))
+        if self.onPCMDataCb != None:
+            self.onPCMDataCb(DataState.BEGIN, None)
+        pacer = FramePacer(asset.get_frame_duration(), self.voice_pacing)
+        for adpcm_frame in asset:
+            if self.capture_end:
+                break
+            pacer.wait()
+            if self.onPCMDataCb != None:
+                self.onPCMDataCb(DataState.SENDING_ADPCM_DATA, adpcm_frame)
 
-        capture_begin_time = time.time()
-        while True:
-            with self.condition:
-                read_pcm_frames_num, read_frames = audio.read() # read_frames_size =256, len(read_frames) = 512
-                if read_pcm_frames_num <= 0:
-                    continue
-                # if read_pcm_frames_num == 0 or read_pcm_frames_num < expected_pcm_frames_num:
-                #    print(f'producePCMByCapture error, read_pcm_frames_num:{read_pcm_frames_num}, will break')
-                #    self.capture_end = True
-                #    self.condition.notify()
-                #    break
-                capture_elapse_time = time.time() - capture_begin_time
-                print(
-                    f"producePCMByCapture, read_pcm_frames_num:{read_pcm_frames_num}, capture_elapse_time:{capture_elapse_time}")
-                if capture_elapse_time > RECORD_SECONDS:
-                    print(
-                        f'producePCMByCapture, capture_elapse_time:{capture_elapse_time}, will break')
-                    self.capture_end = True
-                    self.condition.notify()
-                    break
-                self.read_frames_list.append(read_frames)
-                print(
-                    f'producePCMByCapture, len(self.read_frames_list):{len(self.read_frames_list)}')
-                self.condition.notify()
+        self.capture_end = True
+        if self.onPCMDataCb != None:
+            self.onPCMDataCb(DataState.END, None)
 
-    def producePCMByCapture_bk(self):
-        sample_rate = ENCODE_ADPCM_SAMPLE_RATE_8k
-        if self.mic_open_params == 1:
-            sample_rate = ENCODE_ADPCM_SAMPLE_RATE_8k
-        elif self.mic_open_params == 2:
-            sample_rate = ENCODE_ADPCM_SAMPLE_RATE_16k
+    def producePCMByCapture(self):
+        ring_buffer = self.ring_buffer
+        sample_rate = self.getSampleRate()
 
         pcm_frame_size = ENCODE_ADPCM_SAMPLE_WIDTH * ENCODE_ADPCM_CHANNELS
         expected_pcm_frames_num = ENCODE_ADPCM_CHUNK_SIZE * \
             ENCODE_PCM_TO_ADPCM_FAC // pcm_frame_size
 
-        # 初始化錄音
-        audio = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK,
+        # only the microphone source needs ALSA, the file and asset sources run without it
+        import alsaaudio
+
+        # 初始化錄音, blocking mode so audio.read() sleeps until a period is captured
+        audio = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NORMAL,
                               channels=ENCODE_ADPCM_CHANNELS, rate=sample_rate, format=alsaaudio.PCM_FORMAT_S16_LE,
                               periodsize=expected_pcm_frames_num, device='plughw:CARD=PCH,DEV=0')
 
         capture_begin_time = time.time()
-        with self.condition:
-            while True:
-                read_pcm_frames_num, read_frames = audio.read() # read_frames_size =256, len(read_frames) = 512
-                if read_pcm_frames_num <= 0:
-                    continue
-                capture_elapse_time = time.time() - capture_begin_time
-                print(
-                    f"producePCMByCapture, read_pcm_frames_num:{read_pcm_frames_num}, capture_elapse_time:{capture_elapse_time}")
-                if capture_elapse_time > RECORD_SECONDS:
-                    print(
-                        f'producePCMByCapture, capture_elapse_time:{capture_elapse_time}, will break')
-                    self.capture_end = True
-                    self.condition.notify()
-                    break
-                self.read_frames_list.append(read_frames)
-                print(
-                    f'producePCMByCapture, len(self.read_frames_list):{len(self.read_frames_list)}')
-                
+        while not self.capture_end:
+            read_pcm_frames_num, read_frames = audio.read() # read_frames_size =256, len(read_frames) = 512
+            if read_pcm_frames_num <= 0:
+                # overrun, nothing to hand over for this period
+                continue
+            capture_elapse_time = time.time() - capture_begin_time
+            if capture_elapse_time > RECORD_SECONDS:
+                logger.info('producePCMByCapture, capture_elapse_time:%s, will break', capture_elapse_time)
+                break
+            ring_buffer.write(read_frames)
+
+        self.capture_end = True
+        audio.close()
+        ring_buffer.close()
 
     def producePCMByFile(self):
+        ring_buffer = self.ring_buffer
         wave_file = None
 
         if self.mic_open_params == 1:
             wave_file = self.tivo_ruc_dlg.get_8k_file_path()
         elif self.mic_open_params == 2:
             wave_file = self.tivo_ruc_dlg.get_16k_file_path()
-        else:
-            with self.condition:
-                self.capture_end = True
-                self.read_frames_list = []
-                self.condition.notify()
-            return
 
-        if os.path.exists(wave_file) == False:
-            with self.condition:
-                self.capture_end = True
-                self.read_frames_list = []
-                self.condition.notify()
+        if wave_file == None or os.path.exists(wave_file) == False:
+            self.capture_end = True
+            ring_buffer.close(discard=True)
             return
 
         with wave.open(wave_file, 'rb') as f:
-            print(
-                f'producePCMByFile, open file = {wave_file}, channels = {f.getnchannels()}, sample_width = {f.getsampwidth()}, sample_rate = {f.getframerate()}')
+            logger.info('producePCMByFile, open file = %s, channels = %s, sample_width = %s, sample_rate = %s',
+                        wave_file, f.getnchannels(), f.getsampwidth(), f.getframerate())
 
             pcm_frame_size = f.getsampwidth() * f.getnchannels()
             expected_pcm_frames_num = ENCODE_ADPCM_CHUNK_SIZE * \
                 ENCODE_PCM_TO_ADPCM_FAC // pcm_frame_size
-            print(
-                f'producePCMByFile, expected_pcm_frames_num:{expected_pcm_frames_num}')
+            logger.info('producePCMByFile, expected_pcm_frames_num:%s', expected_pcm_frames_num)
 
             while True:
-                # if len(self.read_frames_list) > 200:
-                #    print(f'producePCMByFile, len(self.read_frames_list) > 200!')
-                #    time.sleep(0.01)
-                with self.condition:
-                    read_frames = f.readframes(expected_pcm_frames_num)
-                    read_pcm_frames_num = len(read_frames) // pcm_frame_size
-                    if read_pcm_frames_num == 0 or read_pcm_frames_num < expected_pcm_frames_num:
-                        print(
-                            f'producePCMByFile read_pcm_frames_num:{read_pcm_frames_num}, will break')
-                        self.capture_end = True
-                        self.condition.notify()
-                        break
-                    self.read_frames_list.append(read_frames)
-                    print(
-                        f'producePCMByFile, len(self.read_frames_list):{len(self.read_frames_list)}')
-                    self.condition.notify()
+                read_frames = f.readframes(expected_pcm_frames_num)
+                read_pcm_frames_num = len(read_frames) // pcm_frame_size
+                if read_pcm_frames_num == 0 or read_pcm_frames_num < expected_pcm_frames_num:
+                    logger.info('producePCMByFile read_pcm_frames_num:%s, will break', read_pcm_frames_num)
+                    break
+                # the ring buffer blocks instead of dropping when the consumer falls behind
+                if ring_buffer.write(read_frames) < len(read_frames):
+                    logger.info('producePCMByFile, ring buffer closed, will break')
+                    break
+
+        self.capture_end = True
+        ring_buffer.close()
 
     # mic_open_params = 1: ADPCM (8Khz/16bit)
     # mic_open_params = 2: ADPCM (16Khz/16bit)
     def startCaptureVoice(self, mic_open_params):
         self.mic_open_params = mic_open_params
-        print(
-            f"VoiceSource.startCaptureVoice, mic_open_params = {self.mic_open_params}")
+        logger.info('VoiceSource.startCaptureVoice, mic_open_params = %s', self.mic_open_params)
         self.capture_end = False
         voice_source_file = self.tivo_ruc_dlg.getCaptureByFile()
-        self.condition = threading.Condition()
-        c = threading.Timer(0.001, self.consumePCM)
-        p = None
+        pcm_bytes_per_second = self.getSampleRate() * ENCODE_ADPCM_SAMPLE_WIDTH * \
+            ENCODE_ADPCM_CHANNELS
+        self.consumeThread = None
+        self.produceThread = None
+        self.pacer = None
+        asset = None
         if voice_source_file:
-            p = threading.Timer(0.001, self.producePCMByFile)
+            wave_file = self.tivo_ruc_dlg.get_16k_file_path() if self.mic_open_params == 2 \
+                else self.tivo_ruc_dlg.get_8k_file_path()
+            asset = load_asset(wave_file, ADPCM_FRAME_FORMAT)
+        if asset != None:
+            # the whole clip is already framed, no producer and no encoding needed
+            self.consumeThread = threading.Timer(0.001, self.consumeADPCMAsset, args=(asset,))
+            self.consumeThread.name = VOICE_CONSUMER_THREAD_NAME
+            self.consumeThread.start()
+            return
+        if voice_source_file:
+            self.ring_buffer = ByteRingBuffer(
+                RING_BUFFER_SECONDS * pcm_bytes_per_second, OVERFLOW_BLOCK)
+            self.pacer = FramePacer.for_pcm(self.getPCMChunkSize(), self.getSampleRate(),
+                                            ENCODE_ADPCM_SAMPLE_WIDTH, ENCODE_ADPCM_CHANNELS, self.voice_pacing)
+            self.produceThread = threading.Timer(0.001, self.producePCMByFile)
         else:
-            p = threading.Timer(0.001, self.producePCMByCapture)
-
-        if c != None and p != None:
-            c.start()
-            p.start()
+            self.ring_buffer = ByteRingBuffer(
+                RING_BUFFER_SECONDS * pcm_bytes_per_second, OVERFLOW_DROP_OLDEST)
+            self.produceThread = threading.Timer(0.001, self.producePCMByCapture)
+        self.consumeThread = threading.Timer(0.001, self.consumePCM)
+        # named for the sampling profiler and the log
+        self.produceThread.name = VOICE_PRODUCER_THREAD_NAME
+        self.consumeThread.name = VOICE_CONSUMER_THREAD_NAME
+
+        if self.consumeThread != None and self.produceThread != None:
+            self.consumeThread.start()
+            self.produceThread.start()
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+"""
+Pre-test provisioning of the TVs and of the local adapter, the Python side of
+aml_device_auto_connect.sh and clear_aml_devices.sh.
+
+Every TV gets one SSH ControlMaster connection, the commands of a step go over it as one
+batch (one channel, one round trip) instead of one ssh login per bluetoothctl call, and
+several TVs are provisioned in parallel from a thread pool:
+
+    $ python3 tv_provisioning.py -ip 10.82.83.8,10.82.83.9 -name "RCU 0,RCU 1"
+
+The commands run through a transport, LocalTransport runs them on this host so the steps can
+be exercised against the fake bluetoothctl of benchmarks/fake_bluetoothctl:
+
+    $ mkdir -p /tmp/fakebin && ln -sf $PWD/benchmarks/fake_bluetoothctl /tmp/fakebin/bluetoothctl
+    $ FAKE_BT_REMOTES="00:00:00:00:B1:E0 RCU 0" PATH=/tmp/fakebin:$PATH python3 tv_provisioning.py --local -name "RCU 0"
+"""
+import argparse
+import concurrent.futures
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+SSH_USER = 'root'
+SSH_CONNECT_TIMEOUT = 5
+# the master connection outlives the provisioning a little, a re-run within it reuses it
+SSH_CONTROL_PERSIST = 60
+COMMAND_TIMEOUT = 60
+SCAN_TIMEOUT = 20
+DISCOVERY_ATTEMPTS = 15
+DISCOVERY_INTERVAL = 1.0
+# the local remotes bluez keeps from the previous runs, see clear_aml_devices.sh
+LOCAL_TARGET_NAME = 'VEWDT5W'
+
+BATCH_MARK = '@@rcu-provisioning'
+DEVICE_LINE = re.compile(r'^Device ((?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}) ?(.*)$')
+REMOVED_OK = 'Device has been removed'
+REMOVED_FAIL = 'Failed to remove device'
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+class HostKeyVerificationError(ProvisioningError):
+    pass
+
+
+class LocalTransport:
+    """
+    Runs the commands with sh on this host.
+    """
+
+    def __init__(self, name='localhost', env=None):
+        self.name = name
+        self.env = env
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def run(self, script, timeout=COMMAND_TIMEOUT):
+        # Returns (return code, stdout, stderr)
+        result = subprocess.run(['sh', '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, timeout=timeout, env=self.env)
+        return result.returncode, result.stdout, result.stderr
+
+    def spawn(self, script):
+        # Starts a long running command, returns its subprocess.Popen
+        return subprocess.Popen(['sh', '-c', script], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                env=self.env)
+
+
+class SshTransport:
+    """
+    Runs the commands on a TV over one multiplexed SSH connection: open() starts the
+    ControlMaster, every run() and spawn() is a new channel on it without a new login.
+    """
+
+    def __init__(self, host, user=SSH_USER):
+        self.name = host
+        self.host = host
+        self.user = user
+        self.control_dir = None
+
+    def ssh_args(self):
+        return ['ssh', '-o', 'BatchMode=yes', '-o', f'ConnectTimeout={SSH_CONNECT_TIMEOUT}',
+                '-o', f'ControlPath={os.path.join(self.control_dir, "%C")}',
+                f'{self.user}@{self.host}']
+
+    def open(self):
+        if self.control_dir is not None:
+            return
+        # %C keeps the socket path short, unix socket paths are limited to about 100 bytes
+        self.control_dir = tempfile.mkdtemp(prefix='rcu-ssh-')
+        args = self.ssh_args()
+        args[1:1] = ['-o', 'ControlMaster=yes', '-o', f'ControlPersist={SSH_CONTROL_PERSIST}', '-f', '-N']
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                timeout=SSH_CONNECT_TIMEOUT * 4)
+        if result.returncode != 0:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+            if 'Host key verification failed' in result.stderr:
+                raise HostKeyVerificationError(f'{self.host}: host key verification failed')
+            raise ProvisioningError(f'{self.host}: ssh failed: {result.stderr.strip()}')
+
+    def close(self):
+        if self.control_dir is None:
+            return
+        args = self.ssh_args()
+        args[1:1] = ['-O', 'exit']
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=SSH_CONNECT_TIMEOUT)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
+
+    def run(self, script, timeout=COMMAND_TIMEOUT):
+        result = subprocess.run(self.ssh_args() + [script], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, timeout=timeout)
+        return result.returncode, result.stdout, result.stderr
+
+    def spawn(self, script):
+        return subprocess.Popen(self.ssh_args() + [script], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_batch(transport, commands, timeout=COMMAND_TIMEOUT):
+    # Runs the shell commands in one round trip, returns [(return code, output), ...] in order.
+    # Every command runs, a failing one does not stop the batch.
+    # the command is grouped so the stderr of every part of a compound command is in its output
+    script = '\n'.join(f'echo "{BATCH_MARK} {i}"; {{ {command}\n}} 2>&1; echo "{BATCH_MARK} {i} $?"'
+                       for i, command in enumerate(commands))
+    return_code, stdout, stderr = transport.run(script, timeout)
+    results = [None] * len(commands)
+    output = None
+    for line in stdout.splitlines():
+        if line.startswith(BATCH_MARK):
+            words = line.split()
+            if len(words) == 2:
+                output = []
+            elif len(words) == 3 and output is not None:
+                results[int(words[1])] = (int(words[2]), '\n'.join(output))
+                output = None
+        elif output is not None:
+            output.append(line)
+    if None in results:
+        raise ProvisioningError(f'{transport.name}: batch interrupted, exit code {return_code}: {stderr.strip()}')
+    return results
+
+
+def parse_devices(output):
+    # 'bluetoothctl -- devices' output, returns [(address, name), ...]
+    devices = []
+    for line in output.splitlines():
+        match = DEVICE_LINE.match(line.strip())
+        if match:
+            devices.append((match.group(1), match.group(2)))
+    return devices
+
+
+def check_removed(transport, address, result):
+    return_code, output = result
+    if REMOVED_OK in output:
+        logger.info('%s: %s has been removed', transport.name, address)
+    elif REMOVED_FAIL in output:
+        raise ProvisioningError(f'{transport.name}: failed to remove {address}')
+    else:
+        logger.warning('%s: removing %s, unknown result: %s', transport.name, address, output.strip())
+
+
+class TvProvisioner:
+    """
+    Unpairs everything from a TV and pairs it with the remote advertising rcu_name, the steps
+    of aml_device_auto_connect.sh.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def open(self):
+        self.transport.open()
+
+    def close(self):
+        self.transport.close()
+
+    def clear(self):
+        # SELinux state and paired devices in one round trip, removals in a second one
+        enforce, paired = run_batch(self.transport, ['getenforce', 'bluetoothctl -- devices Paired'])
+        commands = []
+        # getenforce is missing without SELinux
+        if enforce[0] == 0 and enforce[1].strip() not in ('', 'Disabled'):
+            logger.info('%s: SELinux is %s, setting it permissive', self.transport.name, enforce[1].strip())
+            commands.append('setenforce 0')
+        addresses = [address for address, _ in parse_devices(paired[1])]
+        commands += [f'bluetoothctl -- remove {address}' for address in addresses]
+        if not commands:
+            return
+        results = run_batch(self.transport, commands)
+        for address, result in zip(addresses, results[len(commands) - len(addresses):]):
+            check_removed(self.transport, address, result)
+
+    def pair(self, rcu_name, attempts=DISCOVERY_ATTEMPTS, interval=DISCOVERY_INTERVAL):
+        # Returns the address of the remote once paired and connected
+        scan = self.transport.spawn(f'bluetoothctl --timeout {SCAN_TIMEOUT} scan on')
+        try:
+            for attempt in range(attempts):
+                _, output, _ = self.transport.run('bluetoothctl -- devices')
+                for address, name in parse_devices(output):
+                    if rcu_name in name:
+                        logger.info('%s: found %s %s', self.transport.name, address, name)
+                        # the TV needs a moment between pairing and connecting
+                        pair, connect = run_batch(self.transport, [
+                            f'bluetoothctl -- pair {address}',
+                            f'sleep 2; bluetoothctl -- connect {address}'])
+                        if connect[0] != 0:
+                            raise ProvisioningError(
+                                f'{self.transport.name}: connect {address} failed: {connect[1].strip()}')
+                        logger.info('%s: connected to %s', self.transport.name, address)
+                        return address
+                time.sleep(interval)
+            raise ProvisioningError(f'{self.transport.name}: {rcu_name} not found')
+        finally:
+            if scan.poll() is None:
+                scan.terminate()
+            scan.wait()
+
+    def provision(self, rcu_name):
+        self.open()
+        try:
+            self.clear()
+            return self.pair(rcu_name)
+        finally:
+            self.close()
+
+
+def clear_local_devices(transport=None, target_name=LOCAL_TARGET_NAME, restart_bluetooth=True):
+    # clear_aml_devices.sh: restarts bluetoothd and removes the remotes it still knows
+    transport = transport if transport is not None else LocalTransport()
+    if restart_bluetooth:
+        return_code, _, stderr = transport.run('sudo systemctl restart bluetooth.service && sleep 1')
+        if return_code != 0:
+            raise ProvisioningError(f'restarting bluetooth failed: {stderr.strip()}')
+    (_, output), = run_batch(transport, ['bluetoothctl -- devices'])
+    addresses = [address for address, name in parse_devices(output) if target_name in name]
+    if not addresses:
+        return
+    results = run_batch(transport, [f'bluetoothctl -- remove {address}' for address in addresses])
+    for address, result in zip(addresses, results):
+        check_removed(transport, address, result)
+
+
+def provision_all(jobs, max_workers=8):
+    # jobs: [(TvProvisioner, rcu name), ...], returns [(address or None, error or None), ...]
+    def provision(job):
+        provisioner, rcu_name = job
+        try:
+            return provisioner.provision(rcu_name), None
+        except (ProvisioningError, OSError, subprocess.SubprocessError) as e:
+            return None, e
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='Provisioning') as executor:
+        return list(executor.map(provision, jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pair the TVs with the simulated remotes')
+    parser.add_argument('-ip', dest='ip_address', type=str, default=None,
+                        help='Specify the TVs as a comma separated list of IPv4 addresses')
+    parser.add_argument('-name', dest='rcu_names', type=str, required=True,
+                        help='Specify the remote names as a comma separated list, one per TV')
+    parser.add_argument('--local', dest='local', action='store_true',
+                        help='Run the TV commands on this host, with the bluetoothctl found in PATH')
+    parser.add_argument('--clear-local', dest='clear_local', action='store_true',
+                        help='Restart bluetoothd and remove the remotes it knows first')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(threadName)s %(message)s')
+
+    rcu_names = [name.strip() for name in args.rcu_names.split(',')]
+    if args.local:
+        transports = [LocalTransport(f'local{i}') for i in range(len(rcu_names))]
+    elif args.ip_address:
+        transports = [SshTransport(ip.strip()) for ip in args.ip_address.split(',') if ip.strip()]
+    else:
+        parser.error('either -ip or --local is required')
+    if len(transports) != len(rcu_names):
+        parser.error('one remote name per TV is required')
+
+    if args.clear_local:
+        clear_local_devices()
+    start_time = time.monotonic()
+    results = provision_all([(TvProvisioner(t), name) for t, name in zip(transports, rcu_names)])
+    failed = False
+    for transport, name, (address, error) in zip(transports, rcu_names, results):
+        print(f'{transport.name}: {name} -> {address if error is None else error}')
+        failed = failed or error is not None
+    print(f'provisioned {len(results)} TVs in {time.monotonic() - start_time:.1f} s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,15 +1,15 @@
 import argparse
 
 import dbus
-import wave
-import audioop
 import threading, queue
+import time
 
-bleQ = queue.Queue() #receiver queue to save adpcm packet to file
-decoderQ = queue.Queue() #decoder queue to decode adpcm file into wav file
+from voice_stream import FrameReassembler, StreamingWavDecoder, TIVO_FRAME_HEADER_SIZE, LivePlayback, make_playback_sink
+from voice_frame_stats import VoiceFrameStats, parse_tivo_frame_header, FRAME_AFTER_GAP, FRAME_LATE
 
-ble_packets_array = bytearray()
-ble_packets_array_to_write = bytearray()
+bleQ = queue.Queue() #receiver queue to reassemble adpcm frames from the ble packets
+decoderQ = queue.Queue() #decoder queue to decode adpcm frames into the wav file while streaming
+AUDIO_END_MARK = None #queued after the last packet of an utterance
 
 RCU_VERSION_0_4 = 0
 RCU_VERSION_1_0 = 1
@@ -69,6 +69,9 @@ atv_tx_chrc = None
 adpcm_filename = 'adpcmRecorded.ima'
 wav_filename = 'decoded_out.wav'
 sampleRate = 8000
+playbackSink = None #'alsa[:device]' or 'fifo:path' to play the decoded audio while it streams
+jitterFrames = 3
+live_playback = None
 
 def generic_error_cb(error):
     print('D-Bus call failed: ' + str(error))
@@ -142,8 +145,10 @@ def atv_ctl_changed_cb(iface, changed_props, invalidated_props):
 
     if int(flags) == ATV_CTL_AUDIO_END:
         print('CTL Audio End command received')
-        #To trigger decoder worker to decode
-        decoderQ.put(flags)
+        #Queued behind the pending packets, to flush the frames and finalize the wav file
+        bleQ.put(AUDIO_END_MARK)
+        if live_playback:
+            live_playback.rx_ended()
 
     if int(flags) == ATV_CTL_GET_CAPS_RESP:
         major_ver = int(value[1])
@@ -171,47 +176,76 @@ def atv_ctl_changed_cb(iface, changed_props, invalidated_props):
     if int(flags) == ATV_CTL_MIC_OPEN_RESP:
         print('CTL MIC Open RESP received')
 
+#Decode each reassembled frame as it arrives, adpcm_filename and wav_filename stay open for the
+#whole utterance and the wav header is fixed up once the audio end arrives.
+#decoderQ items are (adpcm data, (predictor, index) from the frame header or None, resync) tuples.
 def decoder_worker():
+    wav_decoder = StreamingWavDecoder(adpcm_filename, wav_filename, sampleRate)
+    state_mismatches = 0
     while True:
         item = decoderQ.get()
-        _adpcmstate = None
-        with open(adpcm_filename, "rb") as f:
-            with wave.open(wav_filename, "wb") as wav:
-                wav.setnchannels(1)  # mono
-                wav.setsampwidth(2)  # 16 bits
-                wav.setframerate(sampleRate)  # SampleRate
-            while True:
-                chunk = f.read(128)
-                if chunk:
-                    pcmData, _adpcmstate = audioop.adpcm2lin(chunk, 2, _adpcmstate)
-                    with open(wav_filename, "ab") as w:
-                        w.write(pcmData)
-                else:
-                    break
+        if item is AUDIO_END_MARK:
+            if wav_decoder.is_open():
+                print(f'write to file: {wav_filename} with {wav_decoder.frames} frames')
+                wav_decoder.close()
+            if state_mismatches > 0:
+                # without any frame loss the decoder must track the encoder state exactly
+                print(f'decoder state differed from the frame header {state_mismatches} times without frame loss, codec problem?')
+            state_mismatches = 0
+            if live_playback:
+                live_playback.end_utterance()
+        else:
+            adpcm_data, header_state, resync = item
+            if resync:
+                # frames were lost, continue from the encoder state carried by this frame
+                pcm = wav_decoder.write_frame(adpcm_data, header_state)
+            else:
+                if header_state is not None and wav_decoder.is_open() and wav_decoder.decoder.get_state() != header_state:
+                    state_mismatches += 1
+                pcm = wav_decoder.write_frame(adpcm_data)
+            if live_playback:
+                live_playback.push(pcm)
         decoderQ.task_done()
 
 
-
 def ble_worker():
-    global ble_packets_array
-    global ble_packets_array_to_write
+    reassembler = FrameReassembler(AUDIO_FRAME_LENGTH)
+    frame_stats = VoiceFrameStats()
+
+    def on_frame(frame):
+        if rcu_version != RCU_VERSION_0_4:
+            decoderQ.put((frame, None, False))
+            return
+        seq, _, predictor, index = parse_tivo_frame_header(frame)
+        frame_status = frame_stats.on_frame(seq)
+        if frame_status == FRAME_LATE:
+            print(f'drop late frame, seq = {seq}')
+            return
+        if frame_status == FRAME_AFTER_GAP:
+            print(f'frame gap before seq = {seq}, resync the decoder from the frame header')
+        decoderQ.put((memoryview(frame)[TIVO_FRAME_HEADER_SIZE:], (predictor, index), # exclude the 6 bytes header
+                      frame_status == FRAME_AFTER_GAP))
+
     while True:
         item = bleQ.get()
-        print(f'Working on item')
-        print(''.join('{:02x}'.format(x) for x in item))
-        print(f'Finished item')
-        ble_packets_array.extend(bytes(item))
-        l = len(ble_packets_array)
-        if l >= AUDIO_FRAME_LENGTH:
-            ble_packets_array_to_write.extend(ble_packets_array[0:AUDIO_FRAME_LENGTH])
-            ble_packets_array = ble_packets_array[AUDIO_FRAME_LENGTH:]
-            print(f'write to file: {adpcm_filename} with{AUDIO_FRAME_LENGTH} bytes')
-            with open(adpcm_filename, 'ab') as w:
-                if rcu_version == RCU_VERSION_0_4:
-                    w.write(ble_packets_array_to_write[6:]) # exclude the 6 bytes header while writing
-                else:
-                    w.write(ble_packets_array_to_write)
-            ble_packets_array_to_write.clear() #clear itself after one complete frame
+        if item is AUDIO_END_MARK:
+            if reassembler.get_pending_length() > 0:
+                print(f'drop incomplete frame with {reassembler.get_pending_length()} bytes')
+            reassembler.reset(AUDIO_FRAME_LENGTH)
+            decoderQ.put(AUDIO_END_MARK)
+            if frame_stats.notifications > 0:
+                print('Utterance stats:\n' + frame_stats.format_report())
+            frame_stats.reset()
+        else:
+            rx_time, packet = item
+            print(f'Working on item')
+            print(packet.hex())
+            frame_stats.on_notification(rx_time, len(packet))
+            if reassembler.frame_length != AUDIO_FRAME_LENGTH:
+                # the frame length has been renegotiated by the get caps response
+                reassembler.reset(AUDIO_FRAME_LENGTH)
+            reassembler.feed(packet, on_frame)
+            print(f'Finished item')
 
         bleQ.task_done()
 
@@ -219,8 +253,8 @@ def ble_worker():
 def process_ble_packets(blePackets):
     dataLen = len(blePackets)
     print('audio data length: ' + str(dataLen))
-    #To trigger ble Queue
-    bleQ.put(blePackets)
+    #To trigger ble Queue, with the arrival time for the jitter stats
+    bleQ.put((time.monotonic(), bytes(blePackets)))
 
 #This callback comes with compressed audio data with headers
 def atv_rx_changed_cb(iface, changed_props, invalidated_props):
@@ -235,6 +269,8 @@ def atv_rx_changed_cb(iface, changed_props, invalidated_props):
         return
 
     print('New RX edata')
+    if live_playback:
+        live_playback.mark_rx()
     process_ble_packets(value)
 
     return
@@ -252,7 +288,7 @@ def start_atv_client():
     # Listen to PropertiesChanged signals from the ATV RX Characteristic.
     atv_rx_prop_iface = dbus.Interface(atv_rx_chrc[0], DBUS_PROP_IFACE)
     atv_rx_prop_iface.connect_to_signal("PropertiesChanged",
-                                          atv_rx_changed_cb)
+                                          atv_rx_changed_cb, byte_arrays=True)
     # Subscribe to ATV CTL notifications.
     atv_rx_chrc[0].StartNotify(reply_handler=atv_rx_notify_cb,
                                  error_handler=generic_error_cb,
@@ -348,6 +384,11 @@ def main():
         print('No ATV Service found')
         sys.exit(1)
 
+    if playbackSink:
+        global live_playback
+        live_playback = LivePlayback(make_playback_sink(playbackSink, sampleRate), jitterFrames)
+        live_playback.start()
+
     # turn-on the receiver worker thread
     threading.Thread(target=ble_worker, daemon=True).start()
 
@@ -360,8 +401,15 @@ def main():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Test Voice from S4K RCU')
     parser.add_argument('-s', dest='SampleRate', nargs='?', type=int,help='Specify the intended sampling rate, 0:8Khz (default), 1:16Khz')
+    parser.add_argument('-p', dest='PlaybackSink', nargs='?', type=str, default=None,
+                        help='Play the audio while it streams, alsa[:device] or fifo:path, and report the first RX to first played sample latency')
+    parser.add_argument('-jb', dest='JitterFrames', nargs='?', type=int, default=3,
+                        help='Specify the number of frames buffered before the live playback starts (default 3)')
     args = parser.parse_args()
 
+    playbackSink = args.PlaybackSink
+    jitterFrames = args.JitterFrames
+
     srChoice = args.SampleRate
 
     if srChoice == 1:
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+"""
+Voice codecs of the ATV voice over BLE protocol and their negotiation.
+
+A codec is known by its protocol id, which is also its bit in the codecs supported mask of
+GET_CAPS and of the caps response:
+
+    0x01 ADPCM 8 kHz/16 bit, 0x02 ADPCM 16 kHz/16 bit, 0x04 Opus 16 kHz
+
+ADPCM is the pure Python adpcm_codec. Opus needs the optional opuslib (pip3 install opuslib,
+with libopus installed); without it the codec is not available and the negotiation falls
+back to ADPCM.
+
+    codec = CODECS.negotiate(tv_codecs_mask, parse_codec_names('opus,adpcm16k'))
+    encoder = codec.create_encoder()
+    packet = encoder.encode(pcm_chunk)  # pcm_chunk is codec.frame_pcm_bytes long
+"""
+from adpcm_codec import AdpcmEncoder, ADPCM_SAMPLE_WIDTH
+from adpcm_asset_cache import ADPCM_FRAME_PAYLOAD_SIZE, FRAME_FORMAT_SHARP
+
+try:
+    import opuslib
+except ImportError:
+    opuslib = None
+
+CODEC_ADPCM_8K = 0x01
+CODEC_ADPCM_16K = 0x02
+CODEC_OPUS = 0x04
+
+VOICE_CHANNELS = 1
+VOICE_SAMPLE_WIDTH = ADPCM_SAMPLE_WIDTH
+# 4 bits per sample, a 128 bytes frame carries 256 samples
+ADPCM_PCM_TO_ADPCM_FAC = 4
+OPUS_SAMPLE_RATE = 16000
+OPUS_FRAME_SECONDS = 0.02
+OPUS_BITRATE = 32000
+
+
+class AdpcmCodec:
+    def __init__(self, codec_id, name, sample_rate):
+        self.codec_id = codec_id
+        self.name = name
+        self.sample_rate = sample_rate
+        # PCM bytes encoded into one frame
+        self.frame_pcm_bytes = ADPCM_FRAME_PAYLOAD_SIZE * ADPCM_PCM_TO_ADPCM_FAC
+        # framing of adpcm_asset_cache, the pre-encoded clips can be sent as they are
+        self.frame_format = FRAME_FORMAT_SHARP
+
+    def is_available(self):
+        return True
+
+    def create_encoder(self):
+        return AdpcmEncoder()
+
+
+class _OpusEncoder:
+    # AdpcmEncoder interface over opuslib.Encoder, one encoded packet per PCM frame
+    def __init__(self, sample_rate, frame_samples, bitrate):
+        self.sample_rate = sample_rate
+        self.frame_samples = frame_samples
+        self.bitrate = bitrate
+        self.reset()
+
+    def reset(self):
+        self.encoder = opuslib.Encoder(self.sample_rate, VOICE_CHANNELS, opuslib.APPLICATION_VOIP)
+        self.encoder.bitrate = self.bitrate
+
+    def encode(self, pcm):
+        return self.encoder.encode(bytes(pcm), self.frame_samples)
+
+
+class OpusCodec:
+    def __init__(self, codec_id=CODEC_OPUS, name='opus', sample_rate=OPUS_SAMPLE_RATE,
+                 frame_seconds=OPUS_FRAME_SECONDS, bitrate=OPUS_BITRATE):
+        self.codec_id = codec_id
+        self.name = name
+        self.sample_rate = sample_rate
+        self.frame_samples = int(sample_rate * frame_seconds)
+        self.frame_pcm_bytes = self.frame_samples * VOICE_SAMPLE_WIDTH * VOICE_CHANNELS
+        self.bitrate = bitrate
+        # variable length packets, no pre-encoded clips
+        self.frame_format = None
+
+    def is_available(self):
+        return opuslib is not None
+
+    def create_encoder(self):
+        if opuslib is None:
+            raise RuntimeError('the opus codec needs opuslib')
+        return _OpusEncoder(self.sample_rate, self.frame_samples, self.bitrate)
+
+
+class CodecRegistry:
+
+    def __init__(self):
+        # {codec id: codec}
+        self.codecs = {}
+
+    def register(self, codec):
+        self.codecs[codec.codec_id] = codec
+        return codec
+
+    def get(self, codec_id):
+        return self.codecs.get(codec_id, None)
+
+    def get_by_name(self, name):
+        for codec in self.codecs.values():
+            if codec.name == name:
+                return codec
+        return None
+
+    def get_mask(self, codec_ids):
+        # codecs supported mask of the available codecs among codec_ids
+        mask = 0
+        for codec_id in codec_ids:
+            codec = self.codecs.get(codec_id, None)
+            if codec is not None and codec.is_available():
+                mask |= codec_id
+        return mask
+
+    def negotiate(self, tv_mask, preference):
+        # First codec of preference supported by both sides, ADPCM 8 kHz is mandatory for
+        # every TV and is the fallback.
+        for codec_id in preference:
+            codec = self.codecs.get(codec_id, None)
+            if codec is not None and codec.is_available() and tv_mask & codec_id:
+                return codec
+        return self.codecs[CODEC_ADPCM_8K]
+
+
+CODECS = CodecRegistry()
+CODECS.register(AdpcmCodec(CODEC_ADPCM_8K, 'adpcm8k', 8000))
+CODECS.register(AdpcmCodec(CODEC_ADPCM_16K, 'adpcm16k', 16000))
+CODECS.register(OpusCodec())
+
+# the best quality first
+DEFAULT_CODEC_PREFERENCE = (CODEC_OPUS, CODEC_ADPCM_16K, CODEC_ADPCM_8K)
+
+
+def parse_codec_names(names):
+    # 'opus,adpcm16k' -> (CODEC_OPUS, CODEC_ADPCM_16K)
+    codec_ids = []
+    for name in names.split(','):
+        codec = CODECS.get_by_name(name.strip())
+        if codec is None:
+            raise ValueError(f'unknown codec {name.strip()!r}, known: {", ".join(c.name for c in CODECS.codecs.values())}')
+        codec_ids.append(codec.codec_id)
+    return tuple(codec_ids)
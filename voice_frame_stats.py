@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""
+Per-utterance analytics of the TiVo voice frames received by voice-main.py: sequence gaps,
+reordering, inter-arrival jitter and throughput.
+"""
+import math
+import struct
+
+# [seq hi, seq lo, rcuid, pre predict hi, pre predict lo, pre index], see tivo_rcu/ble_voice_service.py
+TIVO_FRAME_HEADER = struct.Struct('>HBhB')
+SEQ_MODULO = 0x10000
+
+FRAME_IN_ORDER = 'in_order'
+# one or more frames before this one are missing, the decoder should resync from the header
+FRAME_AFTER_GAP = 'after_gap'
+# an older or repeated sequence number, the stream has already moved past it
+FRAME_LATE = 'late'
+
+# upper bounds of the inter-arrival histogram buckets, in milliseconds
+JITTER_BUCKETS_MS = (2, 5, 10, 20, 30, 40, 60, 100, math.inf)
+
+
+def parse_tivo_frame_header(frame):
+    # returns (seq, rcu id, predicted value, step index)
+    return TIVO_FRAME_HEADER.unpack_from(frame)
+
+
+class VoiceFrameStats:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.notifications = 0
+        self.received_bytes = 0
+        self.first_rx_time = None
+        self.last_rx_time = None
+        self.inter_arrival_sum = 0.0
+        self.inter_arrival_square_sum = 0.0
+        self.inter_arrival_max = 0.0
+        self.jitter_histogram = [0] * len(JITTER_BUCKETS_MS)
+        self.expected_seq = None
+        self.frames = 0
+        self.lost_frames = 0
+        self.gaps = 0
+        self.late_frames = 0
+
+    def on_notification(self, rx_time, size):
+        self.notifications += 1
+        self.received_bytes += size
+        if self.last_rx_time is None:
+            self.first_rx_time = rx_time
+        else:
+            delta = rx_time - self.last_rx_time
+            self.inter_arrival_sum += delta
+            self.inter_arrival_square_sum += delta * delta
+            self.inter_arrival_max = max(self.inter_arrival_max, delta)
+            delta_ms = delta * 1000
+            for bucket, upper_bound in enumerate(JITTER_BUCKETS_MS):
+                if delta_ms <= upper_bound:
+                    self.jitter_histogram[bucket] += 1
+                    break
+        self.last_rx_time = rx_time
+
+    def on_frame(self, seq):
+        # Classify the frame by its 16 bit sequence number, returns one of the FRAME_* values.
+        if self.expected_seq is None:
+            self.expected_seq = (seq + 1) % SEQ_MODULO
+            self.frames += 1
+            return FRAME_IN_ORDER
+
+        distance = (seq - self.expected_seq) % SEQ_MODULO
+        if distance >= SEQ_MODULO // 2:
+            # behind the expected sequence number, reordered or duplicated
+            self.late_frames += 1
+            return FRAME_LATE
+
+        self.frames += 1
+        self.expected_seq = (seq + 1) % SEQ_MODULO
+        if distance == 0:
+            return FRAME_IN_ORDER
+        self.gaps += 1
+        self.lost_frames += distance
+        return FRAME_AFTER_GAP
+
+    def get_loss_rate(self):
+        total = self.frames + self.lost_frames
+        return self.lost_frames / total if total else 0.0
+
+    def get_duration(self):
+        if self.first_rx_time is None:
+            return 0.0
+        return self.last_rx_time - self.first_rx_time
+
+    def get_throughput(self):
+        # bytes per second over the utterance
+        duration = self.get_duration()
+        return self.received_bytes / duration if duration > 0 else 0.0
+
+    def get_jitter(self):
+        # standard deviation of the inter-arrival time, in seconds
+        intervals = self.notifications - 1
+        if intervals < 2:
+            return 0.0
+        mean = self.inter_arrival_sum / intervals
+        return math.sqrt(max(self.inter_arrival_square_sum / intervals - mean * mean, 0.0))
+
+    def format_report(self):
+        intervals = max(self.notifications - 1, 1)
+        lines = [
+            f'notifications: {self.notifications}, bytes: {self.received_bytes}, duration: {self.get_duration() * 1000:.1f} ms',
+            f'frames: {self.frames}, lost: {self.lost_frames} in {self.gaps} gaps, late/duplicated: {self.late_frames}, loss rate: {self.get_loss_rate() * 100:.2f} %',
+            f'throughput: {self.get_throughput() * 8 / 1000:.1f} kbit/s',
+            f'inter-arrival mean: {self.inter_arrival_sum / intervals * 1000:.2f} ms, jitter: {self.get_jitter() * 1000:.2f} ms, max: {self.inter_arrival_max * 1000:.2f} ms',
+            'inter-arrival histogram:',
+        ]
+        lower_bound = 0
+        for upper_bound, count in zip(JITTER_BUCKETS_MS, self.jitter_histogram):
+            lines.append(f'  {lower_bound:>4} - {upper_bound:>4} ms: {count}')
+            lower_bound = upper_bound
+        return '\n'.join(lines)
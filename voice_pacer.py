@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+import time
+
+# PACING_REALTIME releases one voice frame per frame duration, the way a real remote streams.
+# PACING_FAST releases frames as fast as they are produced, for throughput tests.
+PACING_REALTIME = 'realtime'
+PACING_FAST = 'fast'
+PACING_MODES = (PACING_REALTIME, PACING_FAST)
+
+
+class FramePacer:
+    """
+    Releases voice frames at the codec's real-time rate on the monotonic clock.
+
+    Deadlines are absolute (start + n * frame_duration), so sleep overshoot on one frame is
+    absorbed by the next one instead of accumulating as drift. If the caller falls behind by
+    more than max_lag_frames the schedule is re-anchored to now rather than bursting out the
+    backlog.
+    """
+
+    def __init__(self, frame_duration, mode=PACING_REALTIME, max_lag_frames=4):
+        if mode not in PACING_MODES:
+            raise ValueError(f'unknown pacing mode: {mode}')
+        self.frame_duration = frame_duration
+        self.mode = mode
+        self.max_lag = max_lag_frames * frame_duration
+        self.start_time = None
+        self.frame_index = 0
+        self.late_frames = 0
+        self.resyncs = 0
+
+    @staticmethod
+    def for_pcm(pcm_bytes_per_frame, sample_rate, sample_width, channels=1, mode=PACING_REALTIME):
+        frame_duration = pcm_bytes_per_frame / (sample_rate * sample_width * channels)
+        return FramePacer(frame_duration, mode)
+
+    def is_realtime(self):
+        return self.mode == PACING_REALTIME
+
+    def reset(self):
+        self.start_time = None
+        self.frame_index = 0
+        self.late_frames = 0
+        self.resyncs = 0
+
+    def wait(self):
+        # Block until the next frame is due. The first frame is released immediately.
+        if self.mode != PACING_REALTIME:
+            return
+        now = time.monotonic()
+        if self.start_time is None:
+            self.start_time = now
+            self.frame_index = 1
+            return
+
+        deadline = self.start_time + self.frame_index * self.frame_duration
+        self.frame_index += 1
+        remaining = deadline - now
+        if remaining > 0:
+            time.sleep(remaining)
+        elif -remaining > self.max_lag:
+            self.resyncs += 1
+            self.start_time = now
+            self.frame_index = 1
+        elif remaining < 0:
+            self.late_frames += 1
+
+    def get_stats(self):
+        return {'frames': self.frame_index, 'late_frames': self.late_frames, 'resyncs': self.resyncs}
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""
+Packs the voice frames into notifications as large as the negotiated ATT MTU allows.
+
+BlueZ reports the MTU of the link in the 'mtu' option of ReadValue, WriteValue and
+AcquireNotify (ble_base.AcquireNotifyCharacteristic). Until one is seen the default MTU of 23
+applies, 20 bytes per notification.
+Fixed size frames (ADPCM) are streamed, a notification carries the end of a frame and the
+start of the next ones, the receiver reassembles them by length (voice_stream.FrameReassembler).
+Variable size frames (Opus) are sent frame aligned, split only when larger than a notification.
+A protocol that announces the notification size to the TV (TiVo bytes_per_char) fixes it with
+fix_payload_size(), a later MTU update then leaves it as announced.
+
+    packer = VoiceFramePacker(rx_char.Notify)
+    packer.update_mtu(options)
+    packer.add_frame(adpcm_frame)
+    ..
+    packer.flush()
+"""
+import logging
+from bluetooth_constants import ATT_DEFAULT_MTU
+
+logger = logging.getLogger(__name__)
+
+# the largest MTU BlueZ negotiates
+ATT_MAX_MTU = 517
+# opcode and attribute handle of a Handle Value Notification
+ATT_NOTIFICATION_HEADER_SIZE = 3
+
+
+def get_option_mtu(options):
+    # the 'mtu' option of ReadValue, WriteValue and AcquireNotify, None if BlueZ did not send it
+    if options is None or 'mtu' not in options:
+        return None
+    return int(options['mtu'])
+
+
+class VoiceFramePacker:
+    """
+    notify(bytes) sends one notification. The frames are added from the voice consumer thread,
+    the MTU may change from the GLib loop, a new size applies to the next notification.
+    """
+
+    def __init__(self, notify, mtu=ATT_DEFAULT_MTU):
+        self.notify = notify
+        self.buffer = bytearray()
+        self.mtu = ATT_DEFAULT_MTU
+        self.payload_size = ATT_DEFAULT_MTU - ATT_NOTIFICATION_HEADER_SIZE
+        # the payload size announced to the TV, None while it follows the MTU
+        self.fixed_payload_size = None
+        self.set_mtu(mtu)
+
+    def set_mtu(self, mtu):
+        mtu = min(max(int(mtu), ATT_DEFAULT_MTU), ATT_MAX_MTU)
+        if mtu != self.mtu:
+            logger.info('VoiceFramePacker, MTU %s -> %s', self.mtu, mtu)
+        self.mtu = mtu
+        self.payload_size = mtu - ATT_NOTIFICATION_HEADER_SIZE
+        if self.fixed_payload_size is not None:
+            self.payload_size = min(self.payload_size, self.fixed_payload_size)
+
+    def fix_payload_size(self):
+        # Keeps the current payload size whatever the MTU becomes, returns it
+        self.fixed_payload_size = self.mtu - ATT_NOTIFICATION_HEADER_SIZE
+        self.payload_size = self.fixed_payload_size
+        return self.payload_size
+
+    def update_mtu(self, options):
+        # takes the MTU from the options of a BlueZ call, if it has one
+        mtu = get_option_mtu(options)
+        if mtu is not None:
+            self.set_mtu(mtu)
+
+    def get_payload_size(self):
+        return self.payload_size
+
+    def reset(self):
+        # drops what is left of the previous stream
+        self.buffer.clear()
+
+    def add_frame(self, frame):
+        # fixed size frames, every full notification is sent, the rest waits for the next frame
+        self.buffer += frame
+        payload_size = self.payload_size
+        buffered = len(self.buffer)
+        sent = 0
+        while buffered - sent >= payload_size:
+            self.notify(bytes(self.buffer[sent:sent + payload_size]))
+            sent += payload_size
+        if sent:
+            del self.buffer[:sent]
+
+    def send_frame(self, frame):
+        # variable size frames, a notification never carries parts of two frames
+        self.flush()
+        frame = memoryview(frame)
+        payload_size = self.payload_size
+        for offset in range(0, len(frame), payload_size):
+            self.notify(bytes(frame[offset:offset + payload_size]))
+
+    def flush(self):
+        if self.buffer:
+            self.notify(bytes(self.buffer))
+            self.buffer.clear()
@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+"""
+Receiver side helpers of voice-main.py: reassemble notifications into fixed-size voice
+frames, decode them incrementally into a WAV file while the utterance is streaming and
+optionally play them live.
+"""
+import os
+import queue
+import threading
+import time
+import wave
+from adpcm_codec import AdpcmDecoder, ADPCM_SAMPLE_WIDTH
+
+ADPCM_FRAME_PAYLOAD_SIZE = 128
+TIVO_FRAME_HEADER_SIZE = 6
+WRITE_BUFFER_SIZE = 64 * 1024
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+
+class FrameReassembler:
+    """
+    Collects notification payloads into frames of frame_length bytes in a fixed buffer with a
+    fill cursor, a notification may carry a part of a frame or several frames.
+    """
+
+    def __init__(self, frame_length):
+        self.reset(frame_length)
+
+    def reset(self, frame_length=None):
+        if frame_length is not None:
+            self.frame_length = frame_length
+            self.frame = bytearray(frame_length)
+        self.fill = 0
+
+    def get_pending_length(self):
+        return self.fill
+
+    def feed(self, data, on_frame):
+        # Calls on_frame(frame bytes) for every frame completed by data.
+        view = memoryview(data).cast('B')
+        offset = 0
+        while offset < len(view):
+            size = min(self.frame_length - self.fill, len(view) - offset)
+            self.frame[self.fill:self.fill + size] = view[offset:offset + size]
+            self.fill += size
+            offset += size
+            if self.fill == self.frame_length:
+                self.fill = 0
+                on_frame(bytes(self.frame))
+
+
+class StreamingWavDecoder:
+    """
+    Keeps the raw ADPCM dump and the decoded WAV file open for the whole utterance, decodes
+    each frame as it arrives and lets the wave module fix the header sizes up on close().
+    """
+
+    def __init__(self, adpcm_filename, wav_filename, sample_rate, channels=1):
+        self.adpcm_filename = adpcm_filename
+        self.wav_filename = wav_filename
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.adpcm_file = None
+        self.wav = None
+        self.decoder = AdpcmDecoder()
+        self.pcm_buffer = bytearray()
+        self.frames = 0
+
+    def is_open(self):
+        return self.wav is not None
+
+    def open(self):
+        self.close()
+        self.adpcm_file = open(self.adpcm_filename, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.wav = wave.open(self.wav_filename, 'wb')
+        self.wav.setnchannels(self.channels)
+        self.wav.setsampwidth(ADPCM_SAMPLE_WIDTH)
+        self.wav.setframerate(self.sample_rate)
+        self.decoder.reset()
+        self.frames = 0
+
+    def decode(self, adpcm_data, state=None):
+        # Returns a memoryview of the decoded PCM, valid until the next call. state resets the
+        # decoder to a known (predicted value, step index) first, e.g. from a frame header.
+        if state is not None:
+            self.decoder.reset(state)
+        pcm_size = len(adpcm_data) * 2 * ADPCM_SAMPLE_WIDTH
+        if len(self.pcm_buffer) != pcm_size:
+            self.pcm_buffer = bytearray(pcm_size)
+        self.decoder.decode_into(adpcm_data, self.pcm_buffer)
+        return memoryview(self.pcm_buffer)
+
+    def write_frame(self, adpcm_data, state=None):
+        if not self.is_open():
+            self.open()
+        self.adpcm_file.write(adpcm_data)
+        pcm = self.decode(adpcm_data, state)
+        self.wav.writeframesraw(pcm)
+        self.frames += 1
+        return pcm
+
+    def close(self):
+        if self.adpcm_file is not None:
+            self.adpcm_file.close()
+            self.adpcm_file = None
+        if self.wav is not None:
+            # patches the RIFF and data chunk sizes with the number of frames written
+            self.wav.close()
+            self.wav = None
+
+
+class AlsaPlaybackSink:
+    """
+    Writes 16 bit mono PCM to an ALSA playback device.
+    """
+
+    def __init__(self, sample_rate, device='default', period_size=ADPCM_FRAME_PAYLOAD_SIZE * 2):
+        if alsaaudio is None:
+            raise RuntimeError('alsaaudio is not installed, live playback to ALSA is not available')
+        self.pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NORMAL,
+                                 channels=1, rate=sample_rate, format=alsaaudio.PCM_FORMAT_S16_LE,
+                                 periodsize=period_size, device=device)
+
+    def write(self, pcm):
+        self.pcm.write(pcm)
+
+    def close(self):
+        self.pcm.close()
+
+
+class FifoPlaybackSink:
+    """
+    Writes raw 16 bit little endian PCM into a named pipe, e.g. for `aplay -f S16_LE -r 8000 < fifo`.
+    The pipe is created if needed and opened on the first write, which blocks until a reader attaches.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        if not os.path.exists(path):
+            os.mkfifo(path)
+
+    def write(self, pcm):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_WRONLY)
+        view = memoryview(pcm)
+        while len(view) > 0:
+            written = os.write(self.fd, view)
+            view = view[written:]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def make_playback_sink(spec, sample_rate):
+    # spec is 'alsa', 'alsa:<device>' or 'fifo:<path>'
+    kind, _, target = spec.partition(':')
+    if kind == 'alsa':
+        return AlsaPlaybackSink(sample_rate, target or 'default')
+    if kind == 'fifo' and target:
+        return FifoPlaybackSink(target)
+    raise ValueError(f'unknown playback sink: {spec}')
+
+
+class LivePlayback(threading.Thread):
+    """
+    Plays decoded frames while the utterance is still streaming. Playback starts once
+    jitter_frames frames are buffered, and the latency from the first RX notification to the
+    first sample handed to the sink is reported per utterance.
+    """
+    END_OF_UTTERANCE = None
+
+    def __init__(self, sink, jitter_frames=3):
+        threading.Thread.__init__(self, name='LivePlayback', daemon=True)
+        self.sink = sink
+        self.jitter_frames = jitter_frames
+        self.queue = queue.Queue()
+        # written by the D-Bus receiving thread only
+        self.first_rx_time = None
+        # written by the decoding thread only
+        self.utterance_started = False
+        # used by the playback thread only
+        self.utterance_rx_time = None
+        self.first_play_time = None
+
+    def mark_rx(self):
+        # called for every RX notification, only the first one of an utterance counts
+        if self.first_rx_time is None:
+            self.first_rx_time = time.monotonic()
+
+    def rx_ended(self):
+        # called once the audio end is received, the next RX notification starts a new utterance
+        self.first_rx_time = None
+
+    def push(self, pcm):
+        rx_time = None
+        if not self.utterance_started:
+            self.utterance_started = True
+            rx_time = self.first_rx_time
+        self.queue.put((rx_time, bytes(pcm)))
+
+    def end_utterance(self):
+        self.utterance_started = False
+        self.queue.put(self.END_OF_UTTERANCE)
+
+    def get_latency(self):
+        if self.utterance_rx_time is None or self.first_play_time is None:
+            return None
+        return self.first_play_time - self.utterance_rx_time
+
+    def play(self, pcm):
+        self.sink.write(pcm)
+        if self.first_play_time is None:
+            self.first_play_time = time.monotonic()
+            latency = self.get_latency()
+            if latency is not None:
+                print(
+                    f'LivePlayback, first RX to first played sample latency: {latency * 1000:.1f} ms (jitter buffer {self.jitter_frames} frames)')
+
+    def run(self):
+        jitter_buffer = []
+        playing = False
+        while True:
+            item = self.queue.get()
+            if item is self.END_OF_UTTERANCE:
+                # a short utterance may end before the jitter buffer is full
+                for buffered in jitter_buffer:
+                    self.play(buffered)
+                jitter_buffer = []
+                playing = False
+                self.utterance_rx_time = None
+                self.first_play_time = None
+                self.queue.task_done()
+                continue
+
+            rx_time, pcm = item
+            if rx_time is not None:
+                self.utterance_rx_time = rx_time
+            if playing:
+                self.play(pcm)
+            else:
+                jitter_buffer.append(pcm)
+                if len(jitter_buffer) >= self.jitter_frames:
+                    playing = True
+                    for buffered in jitter_buffer:
+                        self.play(buffered)
+                    jitter_buffer = []
+            self.queue.task_done()